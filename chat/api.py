@@ -0,0 +1,269 @@
+"""Lean request path for the JSON API
+
+MIDDLEWARE uses the Browser* subclasses below for the static files,
+session, common, CSRF, auth, messages and clickjacking middleware.
+Requests under CHAT_API['PREFIX'] (/api/) go straight through them: the
+JSON clients use none of those. The HTML pages and the admin keep the
+full stack.
+
+Clients authenticate with the signed token returned when their user is
+created, sent as ``Authorization: Bearer <token>`` (``?token=`` on the
+WebSocket). Verifying a token is an HMAC check and needs no query.
+A request that names a user (user_id in the body or URL, or a persona or
+job of theirs) must carry that user's token. Requests without a token are
+let through as before unless CHAT_API['REQUIRE_TOKEN'] is set.
+
+There is no session on /api/: request.user comes from the token
+alone (TokenUserMiddleware), so the staff-only export and import under
+/api/admin/ need a staff user's token; an admin login does not count.
+
+Responses are rendered by FastJSONRenderer: JSON only (no browsable
+API), serialized with orjson when it is installed.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.middleware.clickjacking import XFrameOptionsMiddleware
+from django.middleware.common import CommonMiddleware
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.functional import SimpleLazyObject
+from rest_framework import exceptions, permissions
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - falls back to DRF's json.dumps
+    orjson = None
+
+
+TOKEN_SALT = 'chat.api.token'
+
+
+def issue_token(user_id):
+    """A bearer token for the user (signed, timestamped; nothing is stored)"""
+    return signing.dumps(user_id, salt=TOKEN_SALT)
+
+
+def read_token(token):
+    """The user id a token was issued for, or None if it is invalid or expired"""
+    try:
+        user_id = signing.loads(token, salt=TOKEN_SALT, max_age=settings.CHAT_API['TOKEN_MAX_AGE'])
+    except signing.BadSignature:
+        return None
+    return user_id if isinstance(user_id, int) else None
+
+
+def bearer_token(request):
+    """The token from an ``Authorization: Bearer`` header, or None"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+    return token.strip()
+
+
+def token_denial(token, user_id):
+    """None if a request with this token (None: none sent) may act for
+    user_id, else (status, detail) for the error response"""
+    if token is None:
+        if settings.CHAT_API['REQUIRE_TOKEN']:
+            return 401, "Authentication token required"
+        return None
+    token_user_id = read_token(token)
+    if token_user_id is None:
+        return 401, "Invalid or expired token"
+    if token_user_id != user_id:
+        return 403, "This token does not belong to that user"
+    return None
+
+
+def _as_user_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _token_user(user_id):
+    if user_id is None:
+        return AnonymousUser()
+    return User.objects.filter(pk=user_id).first() or AnonymousUser()
+
+
+def _lean_prefix():
+    # The path prefix browser-only middleware lets through untouched
+    return settings.CHAT_API['PREFIX'] if settings.CHAT_API['LEAN_PATH'] else None
+
+
+class BrowserOnlyMixin:
+    """Pass /api/ requests straight to the next middleware
+
+    Mixed into the session, CSRF, auth, messages and clickjacking
+    middleware in MIDDLEWARE; does nothing when CHAT_API['LEAN_PATH'] is off.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.api_prefix = _lean_prefix()
+
+    def is_api(self, request):
+        return self.api_prefix is not None and request.path_info.startswith(self.api_prefix)
+
+    def __call__(self, request):
+        if self.is_api(request):
+            # A coroutine when the chain is async; the handler awaits it
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class BrowserSessionMiddleware(BrowserOnlyMixin, SessionMiddleware):
+    pass
+
+
+class BrowserCommonMiddleware(BrowserOnlyMixin, CommonMiddleware):
+    pass
+
+
+class BrowserCsrfViewMiddleware(BrowserOnlyMixin, CsrfViewMiddleware):
+    def process_view(self, request, *args, **kwargs):
+        # Called by the handler itself, not through __call__
+        if self.is_api(request):
+            return None
+        return super().process_view(request, *args, **kwargs)
+
+
+class BrowserAuthenticationMiddleware(BrowserOnlyMixin, AuthenticationMiddleware):
+    pass
+
+
+class BrowserMessageMiddleware(BrowserOnlyMixin, MessageMiddleware):
+    pass
+
+
+class BrowserXFrameOptionsMiddleware(BrowserOnlyMixin, XFrameOptionsMiddleware):
+    pass
+
+
+class BrowserStaticMiddleware(BrowserOnlyMixin, WhiteNoiseMiddleware):
+    """WhiteNoise, skipped by /api/ and usable in an async chain
+
+    WhiteNoiseMiddleware is sync only, which would put every ASGI request
+    through a thread hop; here only serving a file runs in a thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if not self.is_api(request):
+            if self.autorefresh:
+                static_file = await sync_to_async(self.find_file)(request.path_info)
+            else:
+                static_file = self.files.get(request.path_info)
+            if static_file is not None:
+                return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
+
+
+class TokenUserMiddleware:
+    """request.user from the bearer token on /api/, loaded on first use
+
+    Stands in for the session-based AuthenticationMiddleware, which /api/
+    skips (plain views such as the staff export check request.user); a
+    request without a valid token is anonymous even with a session cookie.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.api_prefix = _lean_prefix()
+        if self.api_prefix is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if not request.path_info.startswith(self.api_prefix):
+            return self.get_response(request)
+        token = bearer_token(request)
+        user_id = read_token(token) if token else None
+        request.user = SimpleLazyObject(lambda: _token_user(user_id))
+        # A coroutine when the chain is async; the handler awaits it
+        return self.get_response(request)
+
+
+class TokenAuthentication(BaseAuthentication):
+    """DRF authentication for bearer tokens; request.auth is the user id"""
+
+    def authenticate(self, request):
+        token = bearer_token(request)
+        if token is None:
+            return None
+        user_id = read_token(token)
+        if user_id is None:
+            raise exceptions.AuthenticationFailed("Invalid or expired token")
+        return SimpleLazyObject(lambda: _token_user(user_id)), user_id
+
+    def authenticate_header(self, request):
+        return 'Bearer'
+
+
+class TokenMatchesUser(permissions.BasePermission):
+    """Requests about a user need that user's token
+
+    The user is the ``user_id`` URL kwarg or body field, or the owner of
+    an object a view checks with check_object_permissions().
+    """
+
+    message = "This token does not belong to that user"
+
+    def has_permission(self, request, view):
+        user_id = view.kwargs.get('user_id')
+        if user_id is None and request.method in ('POST', 'PUT', 'PATCH') and isinstance(request.data, dict):
+            user_id = request.data.get('user_id')
+        return self._allowed(request, user_id)
+
+    def has_object_permission(self, request, view, obj):
+        return self._allowed(request, getattr(obj, 'user_id', None))
+
+    def _allowed(self, request, user_id):
+        user_id = _as_user_id(user_id)
+        if user_id is None:
+            return True
+        if request.auth is None:
+            # Raised as 401 by DRF, since the request is not authenticated
+            return not settings.CHAT_API['REQUIRE_TOKEN']
+        return request.auth == user_id
+
+
+def _default(obj):
+    # Whatever orjson does not know natively (Decimal, lazy strings, ...)
+    return JSONEncoder().default(obj)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSON-only renderer using orjson when available"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        return orjson.dumps(data, default=_default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
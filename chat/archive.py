@@ -0,0 +1,196 @@
+"""Archive tiering for long chat histories
+
+`manage.py archive_messages` moves each user's messages older than
+CHAT_ARCHIVE['HORIZON_DAYS'] out of the Message table into MessageArchive
+blocks of up to BATCH_SIZE messages, stored as zlib-compressed JSON lines.
+A block is written and its messages deleted in one transaction, so runs
+are incremental and can stop (max_batches) or crash at any point and
+resume where they left off.
+
+A user's newest KEEP_RECENT messages (at least CHAT_HISTORY_LIMIT) stay
+live, so the prompt window never reads the archive. Neither do messages the
+rolling summary or memory extraction have not processed yet, when enabled.
+Archived messages are always older than the user's live ones; the history
+API continues into the archive once a page runs past the live rows.
+"""
+from datetime import datetime, timedelta
+import json
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .sharding import all_shards, shard_for, use_shard
+
+
+def pack(rows):
+    """Compress message dicts into an archive blob"""
+    lines = (
+        json.dumps([row['id'], row['sender'], row['message'], row['created_at'].isoformat()], ensure_ascii=False)
+        for row in rows
+    )
+    return zlib.compress("\n".join(lines).encode(), 6)
+
+
+def unpack(data):
+    """Message dicts (id, sender, message, created_at) from an archive blob"""
+    rows = []
+    for line in zlib.decompress(bytes(data)).decode().splitlines():
+        message_id, sender, message, created_at = json.loads(line)
+        rows.append({
+            'id': message_id, 'sender': sender, 'message': message,
+            'created_at': datetime.fromisoformat(created_at),
+        })
+    return rows
+
+
+def _up_to(created_at, pk, inclusive=False):
+    """Q for messages before a (created_at, id) key"""
+    tie = Q(created_at=created_at, id__lte=pk) if inclusive else Q(created_at=created_at, id__lt=pk)
+    return Q(created_at__lt=created_at) | tie
+
+
+def archivable(user_id, cutoff, keep_recent):
+    """The user's messages that may be archived, as a Message queryset"""
+    from .models import ConversationSummary, MemoryExtractionState, Message
+
+    messages = Message.objects.filter(user_id=user_id, created_at__lt=cutoff)
+    if keep_recent:
+        # The oldest message that stays live
+        keep_from = (
+            Message.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+            .values_list('created_at', 'id')[keep_recent - 1:keep_recent].first()
+        )
+        if keep_from is None:
+            return messages.none()
+        messages = messages.filter(_up_to(*keep_from))
+
+    if settings.CHAT_ROLLING_SUMMARY['ENABLED']:
+        covered = ConversationSummary.objects.filter(user_id=user_id).values_list(
+            'covered_until', 'covered_until_id'
+        ).first()
+        if not covered or covered[0] is None:
+            return messages.none()
+        messages = messages.filter(_up_to(*covered, inclusive=True))
+    if settings.CHAT_MEMORY_EXTRACTION['ENABLED']:
+        extracted = MemoryExtractionState.objects.filter(user_id=user_id).values_list(
+            'extracted_until', 'extracted_until_id'
+        ).first()
+        if not extracted or extracted[0] is None:
+            return messages.none()
+        # Whole prefix only: archived messages must stay older than live ones
+        messages = messages.filter(_up_to(*extracted, inclusive=True))
+    return messages
+
+
+def archive_batch(user_id, cutoff, batch_size, keep_recent):
+    """Move the user's oldest archivable messages into one block
+
+    Returns how many messages were archived (0 when there is nothing left
+    or another run archived the same rows first).
+    """
+    with use_shard(user_id):
+        return _archive_batch(user_id, cutoff, batch_size, keep_recent)
+
+
+def _archive_batch(user_id, cutoff, batch_size, keep_recent):
+    from .models import Message, MessageArchive
+
+    rows = list(
+        archivable(user_id, cutoff, keep_recent).order_by('created_at', 'id')
+        .values('id', 'sender', 'message', 'created_at')[:batch_size]
+    )
+    if not rows:
+        return 0
+
+    with transaction.atomic(using=shard_for(user_id)):
+        deleted, _ = Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        if deleted != len(rows):
+            # A concurrent run got (some of) them; let it keep the block
+            transaction.set_rollback(True)
+            return 0
+        MessageArchive.objects.create(
+            user_id=user_id,
+            first_created_at=rows[0]['created_at'], first_id=rows[0]['id'],
+            last_created_at=rows[-1]['created_at'], last_id=rows[-1]['id'],
+            count=len(rows), data=pack(rows),
+        )
+    return len(rows)
+
+
+def archive_messages(user_ids=None, horizon_days=None, batch_size=None, keep_recent=None, max_batches=None):
+    """Archive old messages user by user in bounded batches
+
+    Returns (users, messages, batches) processed. Stops after max_batches
+    blocks; the next run picks up from there.
+    """
+    from .models import Message
+
+    config = settings.CHAT_ARCHIVE
+    horizon_days = config['HORIZON_DAYS'] if horizon_days is None else horizon_days
+    batch_size = batch_size or config['BATCH_SIZE']
+    keep_recent = config['KEEP_RECENT'] if keep_recent is None else keep_recent
+    keep_recent = max(keep_recent, settings.CHAT_HISTORY_LIMIT)
+    cutoff = timezone.now() - timedelta(days=horizon_days)
+
+    if user_ids is None:
+        user_ids = sorted({
+            user_id
+            for alias in all_shards()
+            for user_id in Message.objects.using(alias).filter(created_at__lt=cutoff)
+            .values_list('user_id', flat=True).distinct().order_by()
+        })
+
+    users = messages = batches = 0
+    for user_id in user_ids:
+        archived_any = False
+        while max_batches is None or batches < max_batches:
+            count = archive_batch(user_id, cutoff, batch_size, keep_recent)
+            if not count:
+                break
+            archived_any = True
+            messages += count
+            batches += 1
+        users += archived_any
+        if max_batches is not None and batches >= max_batches:
+            break
+    return users, messages, batches
+
+
+def archived_before(user_id, key, limit):
+    """Up to limit archived messages older than a (created_at, id) key, newest first
+
+    key=None starts from the newest archived message.
+    """
+    from .models import MessageArchive
+
+    blocks = MessageArchive.objects.filter(user_id=user_id)
+    if key is not None:
+        blocks = blocks.filter(Q(first_created_at__lt=key[0]) | Q(first_created_at=key[0], first_id__lt=key[1]))
+    rows = []
+    for data in blocks.order_by('-last_created_at', '-last_id').values_list('data', flat=True).iterator(chunk_size=4):
+        block = unpack(data)[::-1]
+        if key is not None:
+            block = [row for row in block if (row['created_at'], row['id']) < key]
+        rows.extend(block[:limit - len(rows)])
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+def archived_after(user_id, key, limit):
+    """Up to limit archived messages newer than a (created_at, id) key, oldest first"""
+    from .models import MessageArchive
+
+    blocks = MessageArchive.objects.filter(user_id=user_id).filter(
+        Q(last_created_at__gt=key[0]) | Q(last_created_at=key[0], last_id__gt=key[1])
+    )
+    rows = []
+    for data in blocks.order_by('last_created_at', 'last_id').values_list('data', flat=True).iterator(chunk_size=4):
+        block = [row for row in unpack(data) if (row['created_at'], row['id']) > key]
+        rows.extend(block[:limit - len(rows)])
+        if len(rows) >= limit:
+            break
+    return rows
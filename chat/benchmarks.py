@@ -0,0 +1,431 @@
+"""Performance benchmarks for the chat hot path
+
+Every scenario runs inside a transaction that is rolled back at the end,
+so seeded users and messages never leak into the configured database.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import statistics
+import time
+import tracemalloc
+import uuid
+
+import httpx
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import Client, override_settings
+from google import genai
+from google.genai import types
+
+from .api import issue_token
+from .fake_llm import FakeGenAIClient
+from .gemini_service import GeminiService, set_shared_client
+from .metrics import capture_turn
+from .provisioning import provision_user, provision_users
+from .prompt_cache import get_prompt_cache
+from .resilience import reset_upstream_guard
+from .response_cache import ResponseCache
+from .write_buffer import MessageWriteBuffer
+from .models import Persona, Memory, Message
+
+
+# Columns identifying a row when diffing against a baseline
+ROW_KEYS = ("mode", "messages", "existing_users", "duplicates", "endpoint", "stack", "path")
+
+# Upstream guard settings that never throttle, retry or trip the breaker
+NO_LIMITS = {
+    "REQUESTS_PER_MINUTE": 0, "TOKENS_PER_MINUTE": 0, "MAX_WAIT": 0,
+    "MAX_ATTEMPTS": 1, "BASE_DELAY": 0, "MAX_DELAY": 0, "TIMEOUT": 30,
+    "FAILURE_THRESHOLD": 1_000_000, "RECOVERY_TIMEOUT": 0,
+}
+
+
+class StubGeminiService(GeminiService):
+    """GeminiService that answers instantly without calling the model"""
+
+    def generate_response(self, prompt, user_message=None):
+        return "ok"
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def seed_user(message_count, batch_size=5000, memory_count=0):
+    """Create a throwaway user with a persona, memories and message_count messages"""
+    user = User.objects.create_user(username=f"bench_{uuid.uuid4().hex[:12]}")
+    Persona.objects.create(
+        user=user, name="Bench", role="friend", personality="caring", tone="sweet"
+    )
+    Memory.objects.bulk_create(
+        Memory(user=user, key=f"fact_{i}", value=f"benchmark memory {i}") for i in range(memory_count)
+    )
+    Message.objects.bulk_create(
+        (
+            Message(user=user, sender="user" if i % 2 == 0 else "ai", message=f"benchmark message {i}")
+            for i in range(message_count)
+        ),
+        batch_size=batch_size,
+    )
+    return user
+
+
+def bench_history(sizes, turns, **options):
+    """Chat turn latency against growing stored histories"""
+    rows = []
+    for size in sizes:
+        with transaction.atomic():
+            user = seed_user(size)
+            service = StubGeminiService()
+
+            timings = []
+            for _ in range(turns):
+                start = time.perf_counter()
+                service.chat(user, "hello")
+                timings.append((time.perf_counter() - start) * 1000)
+
+            # Reference: what loading the whole conversation costs
+            start = time.perf_counter()
+            list(Message.objects.filter(user=user).order_by('created_at'))
+            full_load = (time.perf_counter() - start) * 1000
+
+            transaction.set_rollback(True)
+
+        rows.append({
+            "messages": size,
+            "turn_p50_ms": statistics.median(timings),
+            "turn_p95_ms": percentile(timings, 95),
+            "full_history_load_ms": full_load,
+        })
+    return rows
+
+
+def stub_genai_client():
+    """Real genai.Client whose HTTP transport answers locally"""
+    def handler(request):
+        return httpx.Response(200, json={
+            "candidates": [{"content": {"role": "model", "parts": [{"text": "ok"}]}}],
+        })
+
+    http_client = httpx.Client(transport=httpx.MockTransport(handler))
+    return genai.Client(api_key="benchmark", http_options=types.HttpOptions(httpx_client=http_client))
+
+
+def bench_client(turns, **options):
+    """Service construction plus one model call, per-request vs shared client"""
+    def measure(make_service):
+        timings = []
+        for _ in range(turns):
+            start = time.perf_counter()
+            make_service().generate_response("hello")
+            timings.append((time.perf_counter() - start) * 1000)
+        return {"turn_p50_ms": statistics.median(timings), "turn_p95_ms": percentile(timings, 95)}
+
+    # Previous behaviour: a fresh genai.Client for every request
+    per_request = measure(lambda: GeminiService(client=stub_genai_client()))
+
+    set_shared_client(stub_genai_client())
+    try:
+        shared = measure(GeminiService)
+    finally:
+        set_shared_client(None)
+
+    return [
+        {"mode": "client per request", **per_request},
+        {"mode": "shared client", **shared},
+    ]
+
+
+def bench_dedupe(turns, **options):
+    """Duplicate concurrent submissions of the same prompt through one cache"""
+    rows = []
+    for duplicates in (1, 5, 20):
+        cache = ResponseCache()
+        fake = FakeGenAIClient(latency=0.05)
+        service = GeminiService(client=fake)
+        prompts = [f"prompt {i // duplicates}" for i in range(turns)]
+
+        with ThreadPoolExecutor(max_workers=duplicates) as pool:
+            list(pool.map(
+                lambda prompt: cache.get_or_call(prompt, service.model_name, lambda: service._call_model(prompt)),
+                prompts,
+            ))
+
+        stats = cache.stats()
+        rows.append({
+            "duplicates": duplicates,
+            "requests": stats["requests"],
+            "upstream_calls": fake.call_count,
+            "calls_saved": stats["upstream_calls_saved"],
+            "hit_rate": stats["hit_rate"],
+        })
+    return rows
+
+
+def bench_writes(turns, **options):
+    """Turn persistence: two autocommit inserts vs bulk_create vs write-behind
+
+    Runs outside a transaction (the write-behind flusher uses its own
+    connection); the seeded user and its messages are deleted afterwards.
+    """
+    service = GeminiService()
+
+    def legacy_save(user, user_message, ai_response):
+        Message.objects.create(user=user, sender="user", message=user_message)
+        Message.objects.create(user=user, sender="ai", message=ai_response)
+
+    def measure(save, finish=lambda: None):
+        user = seed_user(0)
+        try:
+            timings = []
+            started = time.perf_counter()
+            for i in range(turns):
+                start = time.perf_counter()
+                save(user, f"user message {i}", f"ai reply {i}")
+                timings.append((time.perf_counter() - start) * 1000)
+            finish()
+            elapsed = time.perf_counter() - started
+            assert Message.objects.filter(user=user).count() == turns * 2
+        finally:
+            user.delete()
+        return {
+            "inserts_per_sec": turns * 2 / elapsed,
+            "turn_p50_ms": statistics.median(timings),
+            "turn_p99_ms": percentile(timings, 99),
+        }
+
+    buffer = MessageWriteBuffer(max_batch=200, flush_interval=0.5)
+
+    def buffered_save(user, user_message, ai_response):
+        buffer.add(service._turn_messages(user, user_message, ai_response))
+
+    return [
+        {"mode": "two inserts", **measure(legacy_save)},
+        {"mode": "bulk_create", **measure(service.save_turn)},
+        {"mode": "write-behind", **measure(buffered_save, finish=buffer.close)},
+    ]
+
+
+def bench_signup(sizes, turns, **options):
+    """Signup latency with many existing users: COUNT(*) handles vs provisioning"""
+    rows = []
+    for size in sizes:
+        with transaction.atomic():
+            provision_users(size, batch_size=5000)
+
+            def legacy_signup():
+                User.objects.create_user(username=f"user_{User.objects.count() + 1}_{uuid.uuid4().hex[:6]}")
+
+            def measure(signup):
+                timings = []
+                for _ in range(turns):
+                    start = time.perf_counter()
+                    signup()
+                    timings.append((time.perf_counter() - start) * 1000)
+                return statistics.median(timings), percentile(timings, 95)
+
+            legacy_p50, legacy_p95 = measure(legacy_signup)
+            new_p50, new_p95 = measure(provision_user)
+            transaction.set_rollback(True)
+
+        rows.append({
+            "existing_users": size,
+            "count_p50_ms": legacy_p50,
+            "count_p95_ms": legacy_p95,
+            "provision_p50_ms": new_p50,
+            "provision_p95_ms": new_p95,
+        })
+    return rows
+
+
+def bench_api(sizes, turns, users=5, latency=0.0, reply_chars=200, **options):
+    """Chat, history and persona endpoints end to end against the fake model
+
+    Requests go through the full Django stack (middleware, DRF, ORM) with
+    the shared client replaced by FakeGenAIClient. Each endpoint is timed
+    sequentially, then a short second pass under tracemalloc measures peak
+    Python memory per request without skewing the latencies.
+    """
+    fake = FakeGenAIClient(reply=("x" * reply_chars), latency=latency)
+    client = Client()
+
+    def measure(request):
+        # Warm up connections, caches and lazily imported code first
+        for i in range(5):
+            request(i)
+
+        timings, queries = [], []
+        started = time.perf_counter()
+        for i in range(turns):
+            start = time.perf_counter()
+            with capture_turn() as turn:
+                response = request(i)
+            timings.append((time.perf_counter() - start) * 1000)
+            queries.append(turn.total_queries)
+            assert response.status_code == 200, response.content[:200]
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        try:
+            peaks = []
+            for i in range(min(turns, 10)):
+                tracemalloc.reset_peak()
+                request(i)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+
+        return {
+            "requests_per_sec": turns / elapsed,
+            "p50_ms": statistics.median(timings),
+            "p95_ms": percentile(timings, 95),
+            "p99_ms": percentile(timings, 99),
+            "queries_per_request": float(statistics.mean(queries)),
+            "peak_kib": max(peaks) / 1024,
+        }
+
+    rows = []
+    set_shared_client(fake)
+    reset_upstream_guard()
+    try:
+        with override_settings(CHAT_UPSTREAM=NO_LIMITS):
+            for size in sizes:
+                with transaction.atomic():
+                    seeded = [seed_user(size, memory_count=20) for _ in range(users)]
+                    get_prompt_cache().clear()
+
+                    def user_for(i):
+                        return seeded[i % len(seeded)].id
+
+                    endpoints = {
+                        "POST /api/chat/": lambda i: client.post(
+                            "/api/chat/", {"user_id": user_for(i), "message": f"hello {i}"},
+                            content_type="application/json",
+                        ),
+                        "GET /api/messages/<id>/": lambda i: client.get(f"/api/messages/{user_for(i)}/"),
+                        "GET /api/personas/<id>/": lambda i: client.get(f"/api/personas/{user_for(i)}/"),
+                        "GET /api/personas/": lambda i: client.get(
+                            "/api/personas/", HTTP_AUTHORIZATION=f"Bearer {issue_token(user_for(i))}",
+                        ),
+                    }
+                    for endpoint, request in endpoints.items():
+                        rows.append({"messages": size, "endpoint": endpoint, **measure(request)})
+
+                    transaction.set_rollback(True)
+    finally:
+        reset_upstream_guard()
+        set_shared_client(None)
+    return rows
+
+
+def bench_overhead(turns, **options):
+    """What the request path adds to POST /api/chat/ around an instant model
+
+    Each iteration runs one turn through the test client (middleware, DRF,
+    token check, parsing, rendering) and one as a direct
+    GeminiService.chat() call on the same user; the difference is the
+    framework overhead per request. Measured on the lean /api/ path
+    (chat/api.py) and on the full MIDDLEWARE stack.
+    """
+    rows = []
+    set_shared_client(FakeGenAIClient(reply="ok"))
+    reset_upstream_guard()
+    try:
+        for stack, lean in (("full", False), ("lean", True)):
+            with override_settings(
+                CHAT_UPSTREAM=NO_LIMITS, CHAT_API={**settings.CHAT_API, "LEAN_PATH": lean}
+            ), transaction.atomic():
+                user = seed_user(50, memory_count=5)
+                client = Client(HTTP_AUTHORIZATION=f"Bearer {issue_token(user.id)}")
+
+                def via_client(i):
+                    response = client.post(
+                        "/api/chat/", {"user_id": user.id, "message": f"hello {i}"},
+                        content_type="application/json",
+                    )
+                    assert response.status_code == 200, response.content[:200]
+
+                def direct(i):
+                    GeminiService().chat(user, f"hello {i}")
+
+                for i in range(20):
+                    via_client(i)
+                    direct(i)
+                requests, calls = [], []
+                # Interleaved so both see the same history growth
+                for i in range(turns):
+                    for call, samples in ((via_client, requests), (direct, calls)):
+                        start = time.perf_counter()
+                        call(i)
+                        samples.append((time.perf_counter() - start) * 1_000_000)
+                transaction.set_rollback(True)
+
+            for path, samples in (("POST /api/chat/", requests), ("GeminiService.chat()", calls)):
+                rows.append({
+                    "stack": stack,
+                    "path": path,
+                    "p50_us": statistics.median(samples),
+                    "mean_us": statistics.mean(samples),
+                    "p95_us": percentile(samples, 95),
+                })
+            rows.append({
+                "stack": stack,
+                "path": "overhead",
+                "p50_us": statistics.median(requests) - statistics.median(calls),
+                "mean_us": statistics.mean(requests) - statistics.mean(calls),
+                "p95_us": percentile(requests, 95) - percentile(calls, 95),
+            })
+    finally:
+        reset_upstream_guard()
+        set_shared_client(None)
+    return rows
+
+
+def row_key(row):
+    return tuple(row[key] for key in ROW_KEYS if key in row)
+
+
+def higher_is_better(column):
+    return column.endswith("_per_sec") or column in ("hit_rate", "calls_saved")
+
+
+def diff_rows(baseline_rows, rows, threshold):
+    """Compare rows against a stored baseline
+
+    Returns (diff_rows, regressions): every numeric column gets a relative
+    change next to it, and regressions lists the (row key, column) pairs
+    that got worse by more than threshold (a fraction).
+    """
+    baseline = {row_key(row): row for row in baseline_rows}
+    diffs, regressions = [], []
+    for row in rows:
+        old = baseline.get(row_key(row))
+        diff = {}
+        for column, value in row.items():
+            diff[column] = value
+            if old is None or column in ROW_KEYS or not isinstance(value, (int, float)):
+                continue
+            before = old.get(column)
+            if not before:
+                continue
+            change = (value - before) / before
+            diff[f"{column}_change"] = f"{change:+.1%}"
+            worse = -change if higher_is_better(column) else change
+            if worse > threshold:
+                regressions.append((row_key(row), column))
+        diffs.append(diff)
+    return diffs, regressions
+
+
+SCENARIOS = {
+    "api": bench_api,
+    "client": bench_client,
+    "dedupe": bench_dedupe,
+    "history": bench_history,
+    "overhead": bench_overhead,
+    "signup": bench_signup,
+    "writes": bench_writes,
+}
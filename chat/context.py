@@ -0,0 +1,122 @@
+"""Rolling conversation summaries for the token-budgeted context window
+
+Turns that fall out of the history window are folded into a per-user
+ConversationSummary in the background, a batch at a time and only once
+MIN_MESSAGES of them are waiting (each fold is a model call), so the prompt
+keeps long-term context at a bounded size and no request ever waits for a
+summarization call. The summary is part of the cached prompt prefix and
+the post_save signal on ConversationSummary refreshes it.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .sharding import shard_for, use_shard
+
+
+logger = logging.getLogger(__name__)
+
+
+class GeminiSummarizer:
+    """Summarizer that asks the chat model to update the running summary"""
+
+    max_words = 200
+
+    def __call__(self, previous_summary, messages):
+        from .gemini_service import GeminiService
+
+        transcript = "".join(f"{msg.sender}: {msg.message}\n" for msg in messages)
+        prompt = f"""Update the running summary of a conversation between a user and their AI companion.
+Keep names, facts, preferences and open topics. Answer with the summary only, in under {self.max_words} words.
+
+Current summary:
+{previous_summary or "(none)"}
+
+New messages:
+{transcript}"""
+        return GeminiService().generate_response(prompt).strip()
+
+
+def get_summarizer():
+    return import_string(settings.CHAT_ROLLING_SUMMARY['SUMMARIZER'])()
+
+
+def fold_history(user_id, before, summarizer=None, min_messages=None):
+    """Fold unsummarized messages older than the (created_at, id) cursor
+    
+    Processes at most BATCH_SIZE messages per call and nothing while fewer
+    than min_messages (default MIN_MESSAGES) are waiting; returns how many
+    were folded so callers can loop until caught up.
+    """
+    with use_shard(user_id):
+        return _fold_history(user_id, before, summarizer, min_messages)
+
+
+def _fold_history(user_id, before, summarizer, min_messages):
+    from .models import ConversationSummary, Message
+
+    config = settings.CHAT_ROLLING_SUMMARY
+    if min_messages is None:
+        min_messages = config['MIN_MESSAGES']
+
+    created_at, message_id = before
+    summary, _ = ConversationSummary.objects.get_or_create(user_id=user_id)
+
+    messages = Message.objects.filter(user_id=user_id).filter(
+        Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+    )
+    if summary.covered_until is not None:
+        messages = messages.filter(
+            Q(created_at__gt=summary.covered_until)
+            | Q(created_at=summary.covered_until, id__gt=summary.covered_until_id)
+        )
+    batch = list(
+        messages.order_by('created_at', 'id')
+        .only('sender', 'message', 'created_at')[:config['BATCH_SIZE']]
+    )
+    if not batch or len(batch) < min_messages:
+        return 0
+
+    text = (summarizer or get_summarizer())(summary.summary, batch)
+    with transaction.atomic(using=shard_for(user_id)):
+        # Another worker may have folded the same range meanwhile
+        current = ConversationSummary.objects.select_for_update().get(pk=summary.pk)
+        if (current.covered_until, current.covered_until_id) != (summary.covered_until, summary.covered_until_id):
+            return 0
+        current.summary = text
+        current.covered_until = batch[-1].created_at
+        current.covered_until_id = batch[-1].id
+        current.save()
+    return len(batch)
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-summary")
+_scheduled = set()
+_scheduled_lock = threading.Lock()
+
+
+def _run_fold(user_id, before):
+    try:
+        while fold_history(user_id, before):
+            pass
+    except Exception:
+        logger.exception("Updating the conversation summary for user %s failed", user_id)
+    finally:
+        with _scheduled_lock:
+            _scheduled.discard(user_id)
+        close_old_connections()
+
+
+def schedule_fold(user_id, before):
+    """Queue a background summary update; at most one pending per user"""
+    with _scheduled_lock:
+        if user_id in _scheduled:
+            return False
+        _scheduled.add(user_id)
+    _executor.submit(_run_fold, user_id, before)
+    return True
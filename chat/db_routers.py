@@ -0,0 +1,88 @@
+"""Database routing for user shards and an optional read replica
+
+ShardRouter (see chat/sharding.py) comes first: with sharding enabled it
+places the per-user chat models on the user's shard. With a 'replica'
+alias configured (DATABASE_REPLICA_URL), reads of the unsharded
+models in CHAT_READ_REPLICA['MODELS'] (history and persona) go there and
+everything else, including all writes and migrations, stays on default.
+Reads inside a transaction on default stay on default so they see its
+writes. Replication lag applies to everything else: a history page or
+prompt window read right after a turn may miss it for that long.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .sharding import (
+    ShardNotSelected, all_shards, is_sharded, model_label, pinned_shard, shard_for, sharding_enabled,
+)
+
+
+class ShardRouter:
+    """Send the sharded models' queries to the shard of the user they belong to"""
+
+    def _shard(self, model, hints):
+        instance = hints.get('instance')
+        if instance is not None:
+            if model_label(type(instance)) == 'auth.user':
+                # A related manager or descriptor on the user, e.g. user.messages
+                return shard_for(instance.pk)
+            if is_sharded(type(instance)):
+                return instance._state.db or shard_for(instance.user_id)
+        alias = pinned_shard()
+        if alias is None:
+            raise ShardNotSelected(
+                f"{model._meta.label} is sharded by user; query it inside use_shard(user_id)"
+            )
+        return alias
+
+    def db_for_read(self, model, **hints):
+        if not sharding_enabled():
+            return None
+        if model_label(model) == 'auth.user':
+            # Shards carry copies of their users for the persona join
+            return pinned_shard()
+        return self._shard(model, hints) if is_sharded(model) else None
+
+    def db_for_write(self, model, **hints):
+        if not sharding_enabled() or not is_sharded(model):
+            return None
+        return self._shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # A row and its user may come from different aliases (a shard's user copy)
+        if sharding_enabled() and {obj1._state.db, obj2._state.db} <= set(all_shards()):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+class ReplicaRouter:
+    """Send history and persona reads to the read replica, when there is one"""
+
+    def db_for_read(self, model, **hints):
+        config = settings.CHAT_READ_REPLICA
+        alias = config['ALIAS']
+        if model_label(model) not in config['MODELS'] or alias not in connections:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        # Also for instances that were read from the replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as default
+        aliases = {DEFAULT_DB_ALIAS, settings.CHAT_READ_REPLICA['ALIAS']}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        # Other aliases (shards) decide for themselves
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.CHAT_READ_REPLICA['ALIAS']:
+            return False
+        return None
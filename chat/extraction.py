@@ -0,0 +1,188 @@
+"""Automatic memory extraction from the user's messages
+
+After a turn is saved, new user messages are mined for durable facts
+(name, location, favourites, pets, ...) in the background, a batch at a
+time, and upserted into Memory keyed by (user, key). A per-user
+(created_at, id) watermark in MemoryExtractionState makes every run look
+only at messages it has not seen, and the chat turn never waits for it.
+
+The extractor is pluggable: RuleBasedExtractor is local and free,
+GeminiExtractor asks the chat model and is worth batching (MIN_MESSAGES).
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import re
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .memory_index import get_memory_index
+from .prompt_cache import invalidate_prompt_prefix
+from .sharding import shard_for, use_shard
+
+
+logger = logging.getLogger(__name__)
+
+_VALUE = r"([^.!?,;\n]{2,60})"
+_SKIP_VALUES = {"you", "it", "that", "this", "them", "him", "her"}
+
+
+def slug(text):
+    return re.sub(r"\W+", "_", text.lower()).strip("_")[:40]
+
+
+class RuleBasedExtractor:
+    """Pattern-matches first-person statements into key/value facts"""
+
+    patterns = [
+        (re.compile(r"\bmy name is ([a-z][\w'-]{0,40})", re.I), lambda m: ("name", m[1])),
+        (re.compile(r"\bcall me ([a-z][\w'-]{0,40})", re.I), lambda m: ("name", m[1])),
+        (re.compile(r"\bi live in " + _VALUE, re.I), lambda m: ("location", m[1])),
+        (re.compile(r"\bi(?: am|'m) from " + _VALUE, re.I), lambda m: ("hometown", m[1])),
+        (re.compile(r"\bi work as (?:an? )?" + _VALUE, re.I), lambda m: ("occupation", m[1])),
+        (re.compile(r"\bmy job is (?:an? )?" + _VALUE, re.I), lambda m: ("occupation", m[1])),
+        (re.compile(r"\bi(?: am|'m) (\d{1,3}) years old", re.I), lambda m: ("age", m[1])),
+        (re.compile(r"\bmy birthday is (?:on )?" + _VALUE, re.I), lambda m: ("birthday", m[1])),
+        (
+            re.compile(r"\bmy favou?rite ([a-z ]{2,30}?) is " + _VALUE, re.I),
+            lambda m: (f"favourite_{slug(m[1])}", m[2]),
+        ),
+        (
+            re.compile(
+                r"\bmy (dog|cat|pet|bird|fish|rabbit|hamster)(?:'s name is| is called| is named) ([a-z][\w'-]{0,30})",
+                re.I,
+            ),
+            lambda m: (f"{m[1].lower()}_name", m[2]),
+        ),
+        (
+            re.compile(r"\bi (?:really )?(?:love|like|enjoy) " + _VALUE, re.I),
+            lambda m: (f"likes_{slug(m[1])}", m[1]),
+        ),
+        (
+            re.compile(r"\bi (?:really )?(?:hate|dislike|can't stand) " + _VALUE, re.I),
+            lambda m: (f"dislikes_{slug(m[1])}", m[1]),
+        ),
+    ]
+
+    def __call__(self, messages):
+        facts = {}
+        for msg in messages:
+            for pattern, to_fact in self.patterns:
+                for match in pattern.finditer(msg.message):
+                    key, value = to_fact(match)
+                    value = value.strip()
+                    if key.strip("_") and value and value.lower() not in _SKIP_VALUES:
+                        # Later messages win, so corrections overwrite
+                        facts[key] = value
+        return facts
+
+
+class GeminiExtractor:
+    """Asks the chat model for durable facts as a JSON object"""
+
+    def __call__(self, messages):
+        from .gemini_service import GeminiService
+
+        transcript = "".join(f"- {msg.message}\n" for msg in messages)
+        prompt = f"""Extract durable personal facts the user states about themselves (name, location, job,
+family, pets, preferences, important dates) from these messages. Ignore moods and one-off events.
+Answer with one JSON object only, mapping short snake_case keys to short values, or {{}} if there are none.
+
+Messages:
+{transcript}"""
+        text = GeminiService().generate_response(prompt).strip()
+        text = text.removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+        try:
+            facts = json.loads(text)
+        except ValueError:
+            logger.warning("Memory extractor returned invalid JSON: %.200s", text)
+            return {}
+        if not isinstance(facts, dict):
+            return {}
+        return {slug(str(key)): str(value) for key, value in facts.items() if slug(str(key)) and value}
+
+
+def get_extractor():
+    return import_string(settings.CHAT_MEMORY_EXTRACTION['EXTRACTOR'])()
+
+
+def extract_memories(user_id, extractor=None, min_messages=None):
+    """Mine the next batch of unprocessed user messages into Memory rows
+
+    Processes at most BATCH_SIZE messages per call and nothing while fewer
+    than min_messages (default MIN_MESSAGES) are waiting; returns how many
+    were processed so callers can loop until caught up.
+    """
+    with use_shard(user_id):
+        return _extract_memories(user_id, extractor, min_messages)
+
+
+def _extract_memories(user_id, extractor, min_messages):
+    from .models import Memory, MemoryExtractionState, Message
+
+    config = settings.CHAT_MEMORY_EXTRACTION
+    if min_messages is None:
+        min_messages = config['MIN_MESSAGES']
+
+    state, _ = MemoryExtractionState.objects.get_or_create(user_id=user_id)
+    messages = Message.objects.filter(user_id=user_id, sender='user')
+    if state.extracted_until is not None:
+        messages = messages.filter(
+            Q(created_at__gt=state.extracted_until)
+            | Q(created_at=state.extracted_until, id__gt=state.extracted_until_id)
+        )
+    batch = list(messages.order_by('created_at', 'id').only('message', 'created_at')[:config['BATCH_SIZE']])
+    if not batch or len(batch) < min_messages:
+        return 0
+
+    facts = (extractor or get_extractor())(batch)
+    with transaction.atomic(using=shard_for(user_id)):
+        # Another worker may have processed the same range meanwhile
+        current = MemoryExtractionState.objects.select_for_update().get(pk=state.pk)
+        if (current.extracted_until, current.extracted_until_id) != (state.extracted_until, state.extracted_until_id):
+            return 0
+        if facts:
+            Memory.objects.bulk_create(
+                [Memory(user_id=user_id, key=key[:100], value=value) for key, value in facts.items()],
+                update_conflicts=True, unique_fields=['user', 'key'], update_fields=['value'],
+            )
+        current.extracted_until = batch[-1].created_at
+        current.extracted_until_id = batch[-1].id
+        current.save()
+
+    if facts:
+        # bulk_create skips the Memory signals
+        invalidate_prompt_prefix(user_id)
+        get_memory_index().discard(user_id)
+    return len(batch)
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-extraction")
+_scheduled = set()
+_scheduled_lock = threading.Lock()
+
+
+def _run_extraction(user_id):
+    try:
+        while extract_memories(user_id):
+            pass
+    except Exception:
+        logger.exception("Extracting memories for user %s failed", user_id)
+    finally:
+        with _scheduled_lock:
+            _scheduled.discard(user_id)
+        close_old_connections()
+
+
+def schedule_extraction(user_id):
+    """Queue a background extraction run; at most one pending per user"""
+    with _scheduled_lock:
+        if user_id in _scheduled:
+            return False
+        _scheduled.add(user_id)
+    _executor.submit(_run_extraction, user_id)
+    return True
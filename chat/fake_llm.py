@@ -0,0 +1,118 @@
+"""Local stand-in for the google-genai client
+
+Mirrors the parts of ``genai.Client`` that GeminiService uses so tests and
+benchmarks can run without network access or an API key.
+"""
+from collections import deque
+import asyncio
+import time
+
+import httpx
+from google.genai import errors
+
+
+class FakeResponse:
+    """Minimal GenerateContentResponse with just the text attribute"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+def raise_fault(fault):
+    """Raise the error a real upstream would for a fault spec
+
+    An int is an HTTP status (429, 500, 503, ...); 'timeout' is a read timeout.
+    """
+    if fault == 'timeout':
+        raise httpx.ReadTimeout("Fake upstream timed out")
+    body = {"error": {"code": fault, "message": "Injected fault", "status": "FAKE"}}
+    if fault >= 500:
+        raise errors.ServerError(fault, body)
+    raise errors.ClientError(fault, body)
+
+
+class FakeModels:
+    """Fake ``client.models`` namespace"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, model, contents, config=None):
+        self._client.record(model, contents)
+        time.sleep(self._client.delay())
+        self._client.next_fault()
+        return FakeResponse(self._client.reply)
+
+    def generate_content_stream(self, model, contents, config=None):
+        self._client.record(model, contents)
+        time.sleep(self._client.delay())
+        self._client.next_fault()
+        for index, chunk in enumerate(self._client.chunks()):
+            if index:
+                time.sleep(self._client.chunk_delay)
+            yield FakeResponse(chunk)
+
+
+class FakeAsyncModels:
+    """Fake ``client.aio.models`` namespace"""
+
+    def __init__(self, client):
+        self._client = client
+
+    async def generate_content(self, model, contents, config=None):
+        self._client.record(model, contents)
+        await asyncio.sleep(self._client.delay())
+        self._client.next_fault()
+        return FakeResponse(self._client.reply)
+
+
+class FakeAsyncClient:
+    """Fake ``client.aio`` namespace"""
+
+    def __init__(self, client):
+        self.models = FakeAsyncModels(client)
+
+
+class FakeGenAIClient:
+    """Fake genai.Client returning a canned reply
+
+    ``latency`` is the delay before the first output (seconds, or a
+    function returning them per call), ``chunk_delay`` the
+    pause between streamed chunks of ``chunk_size`` characters. ``faults``
+    is consumed one entry per call: None succeeds, an HTTP status or
+    'timeout' fails that call (see raise_fault). ``calls`` keeps the last
+    ``max_calls`` requests and ``call_count`` counts them all, so a fake
+    serving a long load test does not grow without bound.
+    """
+
+    def __init__(
+        self, reply="Hello from the fake model!", latency=0.0, chunk_size=8, chunk_delay=0.0, faults=(), max_calls=100,
+    ):
+        self.reply = reply
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.faults = list(faults)
+        self.calls = deque(maxlen=max_calls)
+        self.call_count = 0
+        self.models = FakeModels(self)
+        self.aio = FakeAsyncClient(self)
+
+    def record(self, model, contents):
+        self.calls.append({"model": model, "contents": contents})
+        self.call_count += 1
+
+    def delay(self):
+        return self.latency() if callable(self.latency) else self.latency
+
+    def chunks(self):
+        return [
+            self.reply[i:i + self.chunk_size]
+            for i in range(0, len(self.reply), self.chunk_size)
+        ]
+
+    def next_fault(self):
+        if self.faults:
+            fault = self.faults.pop(0)
+            if fault is not None:
+                raise_fault(fault)
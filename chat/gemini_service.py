@@ -1,42 +1,204 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from google import genai
+from google.genai import types
 import os
+import threading
+
+from .context import schedule_fold
+from .extraction import schedule_extraction
+from .memory_index import get_memory_index
+from .metrics import record, stage
+from .prompt_cache import PromptPrefix, get_prompt_cache
+from .resilience import UpstreamError
+from .response_cache import get_response_cache
+from .routing import build_router
+from .sharding import ause_shard, use_shard
+from .write_buffer import get_write_buffer
+
+
+_client_lock = threading.Lock()
+_shared_client = None
+_shared_client_pid = None
+
+
+def _build_client():
+    """Create the genai client for the configured backend"""
+    if settings.GEMINI_BACKEND == 'fake':
+        # Local fake model for load tests and benchmarks
+        from .fake_llm import FakeGenAIClient
+        latency = settings.GEMINI_FAKE_LATENCY
+        if settings.GEMINI_FAKE_LATENCY_LOG:
+            # Replays (chat/recording.py): latencies as recorded upstream
+            from .recording import upstream_sampler
+            latency = upstream_sampler(settings.GEMINI_FAKE_LATENCY_LOG) or latency
+        return FakeGenAIClient(latency=latency)
+    
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY environment variable is not set. Please provide it in your environment configuration.")
+    # Bounded per-call timeout so a hung upstream surfaces as a retryable error
+    timeout_ms = int(settings.CHAT_UPSTREAM['TIMEOUT'] * 1000)
+    return genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=timeout_ms))
+
+
+def get_shared_client():
+    """Return the process-wide genai client, creating it once per worker
+    
+    The client owns pooled HTTP connections and is safe to share between
+    threads and async tasks. It is keyed by pid so a client created before
+    a fork is not reused by the child unless the child adopts it
+    (adopt_shared_client).
+    """
+    global _shared_client, _shared_client_pid
+    
+    pid = os.getpid()
+    client = _shared_client
+    if client is not None and _shared_client_pid == pid:
+        return client
+    
+    with _client_lock:
+        if _shared_client is None or _shared_client_pid != pid:
+            _shared_client = _build_client()
+            _shared_client_pid = pid
+        return _shared_client
+
+
+def set_shared_client(client):
+    """Install a client for this process (tests, benchmarks); None resets"""
+    global _shared_client, _shared_client_pid
+    
+    with _client_lock:
+        _shared_client = client
+        _shared_client_pid = os.getpid() if client is not None else None
+
+
+def adopt_shared_client():
+    """Keep the client inherited from the parent process after a fork
+
+    Only for a client the parent built but never used (chat.warmup), so it
+    holds no connections yet; otherwise each worker builds its own.
+    """
+    global _shared_client_pid
+
+    with _client_lock:
+        if _shared_client is not None:
+            _shared_client_pid = os.getpid()
+
+
+# Persona columns the prompt reads
+PERSONA_PROMPT_FIELDS = ('name', 'role', 'personality', 'tone', 'likes', 'dislikes')
+
+
+def chat_users():
+    """Users with their persona joined in, restricted to what a turn reads
+    
+    A user fetched from here builds the prompt prefix without another
+    query; user.persona raises Persona.DoesNotExist if none is set up.
+    """
+    from django.contrib.auth.models import User
+    
+    return User.objects.select_related('persona').only(
+        'id', 'username', *(f'persona__{field}' for field in PERSONA_PROMPT_FIELDS)
+    )
+
+
+def estimate_tokens(text):
+    """Rough local token estimate (~4 characters per token)"""
+    return max(1, (len(text) + 3) // 4)
 
 
 class GeminiService:
     """Service for interacting with Gemini AI"""
     
-    def __init__(self):
-        self.api_key = os.getenv("GEMINI_API_KEY")
-        self._client = None
+    model_name = 'gemini-2.5-flash-lite'
+    
+    def __init__(self, client=None, history_limit=None, history_token_budget=None, guard=None, router=None):
+        # An explicit client (e.g. chat.fake_llm.FakeGenAIClient) overrides
+        # the process-wide shared one; an explicit guard replaces the
+        # per-route ones
+        self._client = client
+        self._guard = guard
+        self._router = router
+        self.history_limit = history_limit or settings.CHAT_HISTORY_LIMIT
+        self.history_token_budget = history_token_budget or settings.CHAT_HISTORY_TOKEN_BUDGET
 
     @property
     def client(self):
         if self._client is None:
-            if not self.api_key:
-                raise ValueError("GEMINI_API_KEY environment variable is not set. Please provide it in your environment configuration.")
-            os.environ["GOOGLE_API_KEY"] = self.api_key
-            self._client = genai.Client()
+            self._client = get_shared_client()
         return self._client
     
-    def build_prompt(self, persona, conversation_history, memories):
-        """Build a comprehensive prompt for the AI"""
+    @property
+    def router(self):
+        """Model router (chat.routing) built from CHAT_MODEL_ROUTING"""
+        if self._router is None:
+            self._router = build_router(self.model_name, client=self._client, guard=self._guard)
+        return self._router
+    
+    def get_history_window(self, user, limit=None, token_budget=None):
+        """Fetch only the newest messages for the prompt, oldest first"""
+        limit = limit or self.history_limit
+        newest = list(self._newest_messages(user, limit))
+        newest = self._with_pending(user, newest, limit)
+        window = self._trim_window(newest, token_budget or self.history_token_budget)
+        self._fold_older_turns(user, newest, window, limit)
+        return window
+    
+    def _newest_messages(self, user, limit):
+        """Reversed, limited history query backed by the (user, created_at) index"""
+        from .models import Message
         
-        # Build conversation history (last 10 messages)
-        # Convert QuerySet to list to support negative indexing
-        history_list = list(conversation_history)
-        recent_messages = history_list[-10:] if len(history_list) > 10 else history_list
+        return Message.objects.filter(user=user).order_by('-created_at', '-id')[:limit]
+    
+    def _with_pending(self, user, newest, limit):
+        """Put messages still sitting in the write-behind buffer in front"""
+        buffer = get_write_buffer()
+        if buffer is None:
+            return newest
+        pending = buffer.pending_for(user.id)
+        if not pending:
+            return newest
+        return (pending[::-1] + newest)[:limit]
+    
+    def _trim_window(self, newest, token_budget):
+        """Keep newest messages within the token budget, returned oldest first"""
+        window = []
+        used_tokens = 0
+        for msg in newest:
+            if token_budget:
+                used_tokens += estimate_tokens(msg.message)
+                if used_tokens > token_budget:
+                    break
+            window.append(msg)
         
-        history_text = ""
-        for msg in recent_messages:
-            sender_label = "User" if msg.sender == "user" else persona.name
-            history_text += f"{sender_label}: {msg.message}\n"
+        window.reverse()
+        return window
+    
+    def _fold_older_turns(self, user, newest, window, limit):
+        """Turns left out of the window go to the rolling summary (in the background)"""
+        if not settings.CHAT_ROLLING_SUMMARY['ENABLED'] or not window or window[0].pk is None:
+            return
+        if len(window) < len(newest) or len(newest) >= limit:
+            schedule_fold(user.id, (window[0].created_at, window[0].pk))
+    
+    async def aget_history_window(self, user, limit=None, token_budget=None):
+        """Async variant of get_history_window"""
+        limit = limit or self.history_limit
+        newest = [msg async for msg in self._newest_messages(user, limit)]
+        newest = self._with_pending(user, newest, limit)
+        window = self._trim_window(newest, token_budget or self.history_token_budget)
+        self._fold_older_turns(user, newest, window, limit)
+        return window
+    
+    def build_prompt_prefix(self, persona, memories, summary=None):
+        """Compile the persona, memory and summary part of the prompt (cacheable)"""
         
         # Build memory context
-        memory_text = ""
-        for mem in memories:
-            memory_text += f"{mem.key}: {mem.value}\n"
+        memory_block = self.render_memories((mem.key, mem.value) for mem in memories)
+        summary_block = f"Earlier in this conversation:\n{summary}\n" if summary else ""
         
-        prompt = f"""SYSTEM:
+        head = f"""SYSTEM:
 You are acting as a virtual {persona.role} AI.
 
 Persona:
@@ -54,51 +216,315 @@ Rules:
 {f"Likes: {persona.likes}" if persona.likes else ""}
 {f"Dislikes: {persona.dislikes}" if persona.dislikes else ""}
 
-{f"Memory:\\n{memory_text}" if memory_text else ""}
-
+"""
+        history_head = f"""
+{summary_block}
 Conversation History:
-{history_text}
+"""
+        tail = f"""
 
 TASK:
 Reply naturally as {persona.name} would, based on the personality and tone described above.
 """
-        return prompt
+        return PromptPrefix(persona.name, head, memory_block, history_head, tail)
     
-    def generate_response(self, prompt):
-        """Generate a response using Gemini"""
-        try:
-            response = self.client.models.generate_content(
-                model='gemini-2.5-flash-lite',
-                contents=prompt
-            )
-            return response.text
-        except Exception as e:
-            return f"I'm having trouble responding right now. Error: {str(e)}"
+    def render_memories(self, memories):
+        """Memory section for (key, value) pairs; empty without memories"""
+        memory_text = "".join(f"{key}: {value}\n" for key, value in memories)
+        return f"Memory:\n{memory_text}" if memory_text else ""
+    
+    def render_prompt(self, prefix, conversation_history, memory_block=None):
+        """Append the history window to a compiled prefix
+        
+        memory_block replaces the prefix's own (retrieved per turn).
+        """
+        parts = [prefix.head, prefix.memory_block if memory_block is None else memory_block, prefix.history_head]
+        for msg in conversation_history:
+            sender_label = "User" if msg.sender == "user" else prefix.persona_name
+            parts.append(f"{sender_label}: {msg.message}\n")
+        parts.append(prefix.tail)
+        return "".join(parts)
+    
+    def build_prompt(self, persona, conversation_history, memories):
+        """Build a comprehensive prompt for the AI"""
+        return self.render_prompt(self.build_prompt_prefix(persona, memories), conversation_history)
+    
+    def get_prompt_prefix(self, user):
+        """Cached prompt prefix; persona and memories are only read on a miss
+        
+        Raises Persona.DoesNotExist if the user has not set up a persona.
+        """
+        from .models import ConversationSummary, Memory
+        
+        cache = get_prompt_cache()
+        prefix = cache.get(user.id)
+        if prefix is None:
+            persona = user.persona
+            # With retrieval on, memories are picked per turn instead
+            memories = [] if settings.CHAT_MEMORY_RETRIEVAL['ENABLED'] else Memory.objects.filter(user=user).only('key', 'value')
+            summary = None
+            if settings.CHAT_ROLLING_SUMMARY['ENABLED']:
+                summary = ConversationSummary.objects.filter(user=user).values_list('summary', flat=True).first()
+            prefix = self.build_prompt_prefix(persona, memories, summary)
+            cache.set(user.id, prefix)
+        return prefix
+    
+    async def aget_prompt_prefix(self, user):
+        """Async variant of get_prompt_prefix"""
+        from .models import ConversationSummary, Persona, Memory
+        
+        cache = get_prompt_cache()
+        prefix = await cache.aget(user.id)
+        if prefix is None:
+            if type(user).persona.related.is_cached(user):
+                # Joined in by chat_users(); raises DoesNotExist if there is none
+                persona = user.persona
+            else:
+                persona = await Persona.objects.aget(user=user)
+            memories = []
+            if not settings.CHAT_MEMORY_RETRIEVAL['ENABLED']:
+                memories = [mem async for mem in Memory.objects.filter(user=user).only('key', 'value')]
+            summary = None
+            if settings.CHAT_ROLLING_SUMMARY['ENABLED']:
+                summary = await ConversationSummary.objects.filter(user=user).values_list('summary', flat=True).afirst()
+            prefix = self.build_prompt_prefix(persona, memories, summary)
+            await cache.aset(user.id, prefix)
+        return prefix
+    
+    def _call_model(self, prompt):
+        """Single upstream Gemini call"""
+        response = self.client.models.generate_content(
+            model=self.model_name,
+            contents=prompt
+        )
+        return response.text
+    
+    async def _acall_model(self, prompt):
+        """Single upstream Gemini call through the genai aio client"""
+        response = await self.client.aio.models.generate_content(
+            model=self.model_name,
+            contents=prompt
+        )
+        return response.text
+    
+    def generate_response(self, prompt, user_message=None):
+        """Generate a response using Gemini
+        
+        The model is picked by the router (chat.routing) from the prompt size
+        and the user's message, with failover and hedging between routes.
+        Identical concurrent prompts share one upstream call (see
+        chat.response_cache). Each call is rate limited, retried and
+        circuit-broken (see chat.resilience); raises UpstreamError when it
+        ultimately fails.
+        """
+        tokens = estimate_tokens(prompt)
+        route = self.router.select(tokens, user_message)
+        return get_response_cache().get_or_call(
+            prompt, route.model, lambda: self.router.generate(prompt, route, tokens)
+        )
+    
+    async def agenerate_response(self, prompt, user_message=None):
+        """Async variant of generate_response using the genai aio client"""
+        tokens = estimate_tokens(prompt)
+        route = self.router.select(tokens, user_message)
+        return await get_response_cache().aget_or_call(
+            prompt, route.model, lambda: self.router.agenerate(prompt, route, tokens)
+        )
+    
+    def stream_response(self, prompt, user_message=None):
+        """Yield response text chunks as Gemini produces them
+        
+        Raises UpstreamError if the stream fails; retries and failover only
+        happen before the first chunk.
+        """
+        tokens = estimate_tokens(prompt)
+        yield from self.router.stream(prompt, self.router.select(tokens, user_message), tokens)
+    
+    def get_memory_block(self, user, query):
+        """Memory section with the TOP_K memories most relevant to query
+        
+        Returns None when retrieval is disabled (the prefix then carries
+        every memory).
+        """
+        config = settings.CHAT_MEMORY_RETRIEVAL
+        if not config['ENABLED']:
+            return None
+        index = get_memory_index().for_user(user.id)
+        return self.render_memories(index.search(query, config['TOP_K']))
+    
+    async def aget_memory_block(self, user, query):
+        """Async variant of get_memory_block; only an index rebuild hits the DB"""
+        config = settings.CHAT_MEMORY_RETRIEVAL
+        if not config['ENABLED']:
+            return None
+        store = get_memory_index()
+        index = store.get(user.id)
+        if index is None:
+            index = await sync_to_async(store.load)(user.id)
+        return self.render_memories(index.search(query, config['TOP_K']))
+    
+    def prepare_prompt(self, user, user_message=None):
+        """Build the prompt from the cached prefix and the history window
+        
+        user_message selects which memories are injected (see
+        chat.memory_index). Raises Persona.DoesNotExist if the user has not
+        set up a persona.
+        """
+        # Persona (and memories unless retrieved per turn), cached between turns
+        with stage('prefix'):
+            prefix = self.get_prompt_prefix(user)
+        
+        with stage('memories'):
+            memory_block = self.get_memory_block(user, user_message)
+        
+        # Get conversation history (bounded window, not the whole table)
+        with stage('history'):
+            conversation_history = self.get_history_window(user)
+        
+        with stage('render'):
+            return self.render_prompt(prefix, conversation_history, memory_block)
+    
+    async def aprepare_prompt(self, user, user_message=None):
+        """Async variant of prepare_prompt using the async ORM"""
+        with stage('prefix'):
+            prefix = await self.aget_prompt_prefix(user)
+        with stage('memories'):
+            memory_block = await self.aget_memory_block(user, user_message)
+        with stage('history'):
+            conversation_history = await self.aget_history_window(user)
+        
+        with stage('render'):
+            return self.render_prompt(prefix, conversation_history, memory_block)
+    
+    def _turn_messages(self, user, user_message, ai_response):
+        from .models import Message
+        
+        # By id: assigning the user asks the router for its shard, a
+        # (sync) cache lookup that asave_turn must not make
+        return [
+            Message(user_id=user.pk, sender="user", message=user_message),
+            Message(user_id=user.pk, sender="ai", message=ai_response),
+        ]
+    
+    def save_turn(self, user, user_message, ai_response):
+        """Persist the user message and the AI reply
+        
+        Both rows go in with one INSERT, or into the
+        write-behind buffer when CHAT_WRITE_BEHIND is enabled (their ids are
+        then unset). Returns the (user, ai) messages.
+        """
+        from .models import Message
+        
+        messages = self._turn_messages(user, user_message, ai_response)
+        buffer = get_write_buffer()
+        if buffer is not None:
+            buffer.add(messages)
+        else:
+            # A single INSERT, atomic on its own
+            Message.objects.bulk_create(messages)
+        self._extract_memories(user)
+        return messages
+    
+    async def asave_turn(self, user, user_message, ai_response):
+        """Async variant of save_turn"""
+        from .models import Message
+        
+        messages = self._turn_messages(user, user_message, ai_response)
+        buffer = get_write_buffer()
+        if buffer is not None:
+            # Only appends in memory unless a full batch is due
+            await sync_to_async(buffer.add)(messages)
+        else:
+            await Message.objects.abulk_create(messages)
+        self._extract_memories(user)
+        return messages
+    
+    def _extract_memories(self, user):
+        """Mine the new messages for memories in the background (never blocks)"""
+        if settings.CHAT_MEMORY_EXTRACTION['ENABLED']:
+            schedule_extraction(user.id)
+    
+    def _record_sizes(self, prompt, ai_response):
+        record(
+            prompt_chars=len(prompt), prompt_tokens=estimate_tokens(prompt),
+            reply_chars=len(ai_response), reply_tokens=estimate_tokens(ai_response),
+        )
     
     def chat(self, user, user_message):
-        """Main chat function"""
-        from .models import Persona, Message, Memory
+        """Main chat function (reads and writes go to the user's shard)"""
+        with use_shard(user.pk):
+            return self._chat(user, user_message)
+    
+    def _chat(self, user, user_message):
+        from .models import Persona
         
-        # Get persona
         try:
-            persona = user.persona
+            prompt = self.prepare_prompt(user, user_message)
         except Persona.DoesNotExist:
             return "Please set up your persona first!"
         
-        # Get conversation history
-        conversation_history = Message.objects.filter(user=user).order_by('created_at')
+        # Generate response (UpstreamError propagates; nothing is saved)
+        with stage('model'):
+            ai_response = self.generate_response(prompt, user_message)
+        self._record_sizes(prompt, ai_response)
         
-        # Get memories
-        memories = Memory.objects.filter(user=user)
+        # Save messages
+        with stage('save'):
+            self.save_turn(user, user_message, ai_response)
         
-        # Build prompt
-        prompt = self.build_prompt(persona, conversation_history, memories)
+        return ai_response
+    
+    async def achat(self, user, user_message):
+        """Async chat: the model call awaits instead of blocking a worker"""
+        async with ause_shard(user.pk):
+            return await self._achat(user, user_message)
+    
+    async def _achat(self, user, user_message):
+        from .models import Persona
         
-        # Generate response
-        ai_response = self.generate_response(prompt)
+        try:
+            prompt = await self.aprepare_prompt(user, user_message)
+        except Persona.DoesNotExist:
+            return "Please set up your persona first!"
         
-        # Save messages
-        Message.objects.create(user=user, sender="user", message=user_message)
-        Message.objects.create(user=user, sender="ai", message=ai_response)
+        with stage('model'):
+            ai_response = await self.agenerate_response(prompt, user_message)
+        self._record_sizes(prompt, ai_response)
+        with stage('save'):
+            await self.asave_turn(user, user_message, ai_response)
         
         return ai_response
+    
+    def stream_chat(self, user, user_message):
+        """Streaming variant of chat() that yields reply chunks as they arrive
+        
+        The turn is persisted once the stream ends. If the consumer goes away
+        early (client disconnect closes the generator) the upstream stream is
+        closed and whatever was already delivered is saved. An upstream
+        failure raises UpstreamError and saves nothing.
+        """
+        from .models import Persona
+        
+        # Pinned per block: a generator must not hold the pin across yields
+        try:
+            with use_shard(user.pk):
+                prompt = self.prepare_prompt(user, user_message)
+        except Persona.DoesNotExist:
+            yield "Please set up your persona first!"
+            return
+        
+        chunks = []
+        failed = False
+        upstream = self.stream_response(prompt, user_message)
+        try:
+            for chunk in upstream:
+                chunks.append(chunk)
+                yield chunk
+        except UpstreamError:
+            failed = True
+            raise
+        finally:
+            upstream.close()
+            if chunks and not failed:
+                with use_shard(user.pk):
+                    self.save_turn(user, user_message, "".join(chunks))
@@ -0,0 +1,150 @@
+"""DB-backed queue for chat turns run off the request path
+
+POST /api/chat/ with ``"mode": "queued"`` enqueues a ChatJob and returns at
+once; ``run_chat_workers`` processes jobs with a fixed pool of worker
+processes. Jobs for one user run strictly in order (a user's next job is
+only claimable once the previous one finished), failures are retried with
+exponential backoff, and the queue depth is capped so overload surfaces as
+429 instead of unbounded latency.
+"""
+from datetime import timedelta
+import logging
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Min
+from django.utils import timezone
+
+from .models import ChatJob
+from .sharding import sharding_enabled
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """The job queue is at CHAT_JOB_QUEUE['MAX_DEPTH']"""
+
+
+def queue_depth(limit):
+    """Queued jobs, counting at most limit rows"""
+    return ChatJob.objects.filter(status=ChatJob.QUEUED)[:limit].count()
+
+
+def enqueue_chat_job(user, message):
+    """Queue one chat turn; raises QueueFull when the queue is at capacity"""
+    max_depth = settings.CHAT_JOB_QUEUE['MAX_DEPTH']
+    if queue_depth(max_depth) >= max_depth:
+        raise QueueFull()
+    return ChatJob.objects.create(user=user, message=message)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_next_job(worker=None):
+    """Atomically claim the next runnable job, or return None
+
+    Only each user's oldest queued job is a candidate, and only when that
+    user has no job running, which keeps per-user turns in order.
+    """
+    worker = worker or worker_name()
+    now = timezone.now()
+    heads = (
+        ChatJob.objects.filter(status=ChatJob.QUEUED)
+        .values('user_id').annotate(first_id=Min('id')).values('first_id')
+    )
+    busy_users = ChatJob.objects.filter(status=ChatJob.RUNNING).values('user_id')
+    candidates = (
+        ChatJob.objects.filter(id__in=heads, available_at__lte=now)
+        .exclude(user_id__in=busy_users)
+        .order_by('id')
+        .values_list('id', 'user_id')[:10]
+    )
+
+    for job_id, user_id in candidates:
+        claimed = ChatJob.objects.filter(id=job_id, status=ChatJob.QUEUED).update(
+            status=ChatJob.RUNNING, worker=worker, started_at=now, attempts=F('attempts') + 1
+        )
+        if not claimed:
+            continue
+        # Two workers can claim jobs of the same user at the same instant;
+        # the one holding the newer job backs off
+        if ChatJob.objects.filter(user_id=user_id, status=ChatJob.RUNNING, id__lt=job_id).exists():
+            ChatJob.objects.filter(id=job_id).update(
+                status=ChatJob.QUEUED, worker='', started_at=None, attempts=F('attempts') - 1
+            )
+            continue
+        # The persona is on the user's shard when sharding is on; the turn loads it there
+        return ChatJob.objects.select_related('user' if sharding_enabled() else 'user__persona').get(id=job_id)
+    return None
+
+
+def run_job(job, service=None):
+    """Run a claimed job's chat turn and record the outcome"""
+    from .gemini_service import GeminiService
+
+    config = settings.CHAT_JOB_QUEUE
+    try:
+        reply = (service or GeminiService()).chat(job.user, job.message)
+    except Exception as e:
+        logger.exception("Chat job %s failed (attempt %s)", job.id, job.attempts)
+        job.error = str(e)
+        if job.attempts < config['MAX_ATTEMPTS']:
+            job.status = ChatJob.QUEUED
+            # An open circuit or rate limit says when upstream is worth retrying
+            delay = max(
+                config['RETRY_BACKOFF'] * 2 ** (job.attempts - 1),
+                getattr(e, 'retry_after', None) or 0,
+            )
+            job.available_at = timezone.now() + timedelta(seconds=delay)
+        else:
+            job.status = ChatJob.FAILED
+            job.finished_at = timezone.now()
+    else:
+        job.status = ChatJob.DONE
+        job.reply = reply
+        job.error = ''
+        job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'reply', 'error', 'available_at', 'finished_at'])
+    return job
+
+
+def requeue_stale_jobs(timeout=None):
+    """Put back jobs whose worker died mid-run"""
+    timeout = timeout or settings.CHAT_JOB_QUEUE['JOB_TIMEOUT']
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    return ChatJob.objects.filter(status=ChatJob.RUNNING, started_at__lt=cutoff).update(
+        status=ChatJob.QUEUED, worker='', started_at=None
+    )
+
+
+def work(stop_event, poll_interval=0.5, once=False, requeue_interval=None):
+    """Worker loop: claim and run jobs until stop_event is set
+
+    Stale jobs are put back on start and then every requeue_interval seconds
+    (default half of JOB_TIMEOUT), so a dead worker's jobs do not wait for
+    the next worker to start. With once=True the loop exits as soon as no
+    job is runnable.
+    """
+    if requeue_interval is None:
+        requeue_interval = settings.CHAT_JOB_QUEUE['JOB_TIMEOUT'] / 2
+    next_requeue = 0.0
+    while not stop_event.is_set():
+        if time.monotonic() >= next_requeue:
+            requeued = requeue_stale_jobs()
+            if requeued:
+                logger.warning("Requeued %s chat jobs whose worker stopped responding", requeued)
+            next_requeue = time.monotonic() + requeue_interval
+        job = claim_next_job()
+        if job is None:
+            if once:
+                break
+            stop_event.wait(poll_interval)
+            continue
+        run_job(job)
+        close_old_connections()
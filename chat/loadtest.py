@@ -0,0 +1,151 @@
+"""Async HTTP load generator for the chat API
+
+Used by the ``loadtest`` management command to compare deployments (sync
+WSGI workers vs. an ASGI worker) against the local fake model, by
+``measure_boot`` to time cold starts and by ``replay_traffic`` to replay
+recorded traffic (chat/recording.py).
+"""
+import asyncio
+import time
+
+import httpx
+
+from .benchmarks import percentile
+
+
+async def run_load(url, payload, total_requests, concurrency, timeout=60.0):
+    """POST payload to url total_requests times with bounded concurrency"""
+    latencies = []
+    errors = 0
+    remaining = total_requests
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+
+        async def worker():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, json=payload)
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append((time.perf_counter() - start) * 1000)
+                else:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": total_requests,
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) if latencies else 0.0,
+        "p99_ms": percentile(latencies, 99) if latencies else 0.0,
+    }
+
+
+async def replay_load(base_url, plan, concurrency, speed=1.0, timeout=60.0):
+    """Send a replay plan (chat.recording.replay_plan) with a pool of concurrency clients
+
+    Requests go out at their recorded offsets divided by speed (10 replays
+    ten times faster); with speed 0 they go out as fast as the pool takes
+    them. A request waits for a free client when all are busy, and lag is
+    how late it was sent. Returns summaries per endpoint and for 'all'.
+    """
+    queue = asyncio.Queue()
+    results = []
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+
+        def scheduled(item):
+            return started + (item['offset'] / speed if speed else 0.0)
+
+        async def dispatch():
+            for item in plan:
+                delay = scheduled(item) - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await queue.put(item)
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        async def worker():
+            while (item := await queue.get()) is not None:
+                sent = time.perf_counter()
+                try:
+                    response = await client.request(
+                        item['method'], item['path'], json=item['body'], headers=item['headers']
+                    )
+                    ok = response.status_code < 500
+                except httpx.HTTPError:
+                    ok = False
+                done = time.perf_counter()
+                results.append((item['endpoint'], ok, (done - sent) * 1000, (sent - scheduled(item)) * 1000))
+
+        await asyncio.gather(dispatch(), *(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    summaries = {'all': _summarize(results, elapsed)}
+    for endpoint in sorted({result[0] for result in results}):
+        summaries[endpoint] = _summarize([result for result in results if result[0] == endpoint], elapsed)
+    return summaries
+
+
+def _summarize(results, elapsed):
+    latencies = [latency for _, ok, latency, _ in results if ok]
+    lags = [lag for *_, lag in results]
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(latencies),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) if latencies else 0.0,
+        "p95_ms": percentile(latencies, 95) if latencies else 0.0,
+        "p99_ms": percentile(latencies, 99) if latencies else 0.0,
+        "lag_p99_ms": percentile(lags, 99) if lags else 0.0,
+    }
+
+
+async def first_response(url, payload, timeout=60.0, interval=0.05):
+    """Retry POSTing payload until the server answers 200
+
+    Returns (seconds until then, milliseconds the successful request
+    took), or None on timeout. Used by ``measure_boot`` for
+    boot-to-first-response.
+    """
+    started = time.perf_counter()
+    deadline = started + timeout
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        while time.perf_counter() < deadline:
+            sent = time.perf_counter()
+            try:
+                response = await client.post(url, json=payload)
+            except httpx.HTTPError:
+                response = None
+            now = time.perf_counter()
+            if response is not None and response.status_code == 200:
+                return now - started, (now - sent) * 1000
+            await asyncio.sleep(interval)
+    return None
+
+
+async def wait_until_listening(host, port, timeout=30.0):
+    """Poll until a TCP server accepts connections"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            await asyncio.sleep(0.2)
+            continue
+        writer.close()
+        await writer.wait_closed()
+        return True
+    return False
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.archive import archive_messages
+
+
+class Command(BaseCommand):
+    help = 'Moves messages older than the archive horizon into compressed per-user archive blocks'
+
+    def add_arguments(self, parser):
+        config = settings.CHAT_ARCHIVE
+        parser.add_argument('--user', type=int, action='append', dest='users', help='Only this user id (repeatable)')
+        parser.add_argument('--horizon-days', type=float, default=config['HORIZON_DAYS'])
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'], help='Messages per archive block')
+        parser.add_argument(
+            '--keep-recent', type=int, default=config['KEEP_RECENT'],
+            help='Newest messages per user that always stay live',
+        )
+        parser.add_argument('--max-batches', type=int, help='Stop after this many blocks (rerun to continue)')
+
+    def handle(self, *args, **options):
+        users, messages, batches = archive_messages(
+            user_ids=options['users'],
+            horizon_days=options['horizon_days'],
+            batch_size=options['batch_size'],
+            keep_recent=options['keep_recent'],
+            max_batches=options['max_batches'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {messages} messages for {users} users in {batches} blocks'
+        ))
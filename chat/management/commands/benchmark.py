@@ -0,0 +1,65 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from chat import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Runs a chat performance benchmark against a stubbed model'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(benchmarks.SCENARIOS))
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[100, 10_000, 100_000],
+            help='Stored message counts for the history and api scenarios',
+        )
+        parser.add_argument('--turns', type=int, default=50, help='Chat turns (or calls) per measurement')
+        parser.add_argument('--users', type=int, default=5, help='Seeded users for the api scenario')
+        parser.add_argument('--latency', type=float, default=0.0, help='Fake model latency in seconds (api)')
+        parser.add_argument('--reply-chars', type=int, default=200, help='Fake model reply length (api)')
+        parser.add_argument('--save-baseline', metavar='PATH', help='Store the results as a JSON baseline')
+        parser.add_argument('--baseline', metavar='PATH', help='Diff the results against a stored baseline')
+        parser.add_argument(
+            '--threshold', type=float, default=0.20,
+            help='Relative slowdown that counts as a regression when diffing (default 0.20)',
+        )
+
+    def handle(self, *args, **options):
+        scenario = benchmarks.SCENARIOS[options['scenario']]
+        self.stdout.write(f"{options['scenario']} on {connection.vendor} ({connection.settings_dict['NAME']})")
+        rows = scenario(
+            sizes=options['sizes'], turns=options['turns'], users=options['users'],
+            latency=options['latency'], reply_chars=options['reply_chars'],
+        )
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump({'scenario': options['scenario'], 'vendor': connection.vendor, 'rows': rows}, f, indent=2)
+
+        regressions = []
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            if baseline['scenario'] != options['scenario']:
+                raise CommandError(f"Baseline is for the {baseline['scenario']} scenario")
+            if baseline['vendor'] != connection.vendor:
+                self.stderr.write(f"Warning: baseline was recorded on {baseline['vendor']}")
+            rows, regressions = benchmarks.diff_rows(baseline['rows'], rows, options['threshold'])
+
+        self.write_table(rows)
+
+        if regressions:
+            for key, column in regressions:
+                self.stderr.write(f"Regression: {' / '.join(map(str, key))} {column}")
+            raise CommandError(f"{len(regressions)} metric(s) regressed by more than {options['threshold']:.0%}")
+
+    def write_table(self, rows):
+        headers = list(rows[0].keys())
+        self.stdout.write("  ".join(f"{h:>22}" for h in headers))
+        for row in rows:
+            self.stdout.write("  ".join(
+                f"{row.get(h, ''):>22.2f}" if isinstance(row.get(h), float) else f"{row.get(h, ''):>22}"
+                for h in headers
+            ))
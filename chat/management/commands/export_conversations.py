@@ -0,0 +1,32 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.transfer import export_ndjson_gz
+
+
+class Command(BaseCommand):
+    help = 'Writes users, personas, memories and messages as gzip-compressed NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', help='Only this user id (repeatable)')
+        parser.add_argument('--output', '-o', default='-', help='File to write (default: stdout)')
+        parser.add_argument(
+            '--chunk-size', type=int, default=settings.CHAT_TRANSFER['CHUNK_SIZE'],
+            help='Rows fetched per database round trip',
+        )
+
+    def handle(self, *args, **options):
+        chunks = export_ndjson_gz(options['users'], options['chunk_size'])
+        if options['output'] == '-':
+            out = sys.stdout.buffer
+            for chunk in chunks:
+                out.write(chunk)
+            out.flush()
+            return
+
+        with open(options['output'], 'wb') as out:
+            for chunk in chunks:
+                out.write(chunk)
+        self.stderr.write(f"Exported to {options['output']}")
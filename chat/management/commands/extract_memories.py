@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from chat.extraction import extract_memories
+from chat.models import Message
+from chat.sharding import all_shards
+
+
+class Command(BaseCommand):
+    help = 'Extracts memories from messages not yet processed (backfill or cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', help='Only this user id (repeatable)')
+
+    def handle(self, *args, **options):
+        user_ids = options['users'] or sorted({
+            user_id
+            for alias in all_shards()
+            for user_id in Message.objects.using(alias).values_list('user_id', flat=True).distinct().order_by()
+        })
+        users = processed = 0
+        for user_id in user_ids:
+            # Backfill everything, including batches below MIN_MESSAGES
+            count = 0
+            while batch := extract_memories(user_id, min_messages=1):
+                count += batch
+            users += 1
+            processed += count
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} messages for {users} users'))
@@ -0,0 +1,38 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.transfer import import_ndjson
+
+
+class Command(BaseCommand):
+    help = 'Imports an export_conversations file (gzipped or plain NDJSON)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="Export file, or '-' for stdin")
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.CHAT_TRANSFER['BATCH_SIZE'], help='Rows per bulk insert'
+        )
+        parser.add_argument(
+            '--new-ids', action='store_true',
+            help='Give messages fresh ids instead of keeping (and skipping existing) exported ones',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            if options['input'] == '-':
+                counts = import_ndjson(sys.stdin.buffer, options['batch_size'], options['new_ids'])
+            else:
+                with open(options['input'], 'rb') as stream:
+                    counts = import_ndjson(stream, options['batch_size'], options['new_ids'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            'Imported {user} users, {persona} personas, {memory} memories and {message} messages '
+            '({skipped} already there)'.format(**counts)
+        ))
+        if counts['renumbered']:
+            self.stderr.write(self.style.WARNING(
+                f"{counts['renumbered']} messages got fresh ids: their exported ids belong to other messages"
+            ))
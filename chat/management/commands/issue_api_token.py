@@ -0,0 +1,19 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.api import issue_token
+
+
+class Command(BaseCommand):
+    help = 'Prints an API bearer token for a user (e.g. a staff account for /api/admin/export/)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user', help='User id or username')
+
+    def handle(self, *args, **options):
+        lookup = {'pk': int(options['user'])} if options['user'].isdigit() else {'username': options['user']}
+        try:
+            user = User.objects.get(**lookup)
+        except User.DoesNotExist:
+            raise CommandError(f"No user {options['user']!r}")
+        self.stdout.write(issue_token(user.pk))
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import subprocess
+import sys
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.loadtest import run_load, wait_until_listening
+from chat.models import Persona
+
+
+# Deployment name -> (server command, chat endpoint)
+DEPLOYMENTS = {
+    'wsgi': (
+        ['gunicorn', 'config.wsgi:application'],
+        '/api/chat/',
+    ),
+    'asgi': (
+        ['gunicorn', 'config.asgi:application', '-k', 'uvicorn.workers.UvicornWorker'],
+        '/api/chat/async/',
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = 'Load-tests the chat API against the local fake model (WSGI vs ASGI)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Chat endpoint of an already running server')
+        parser.add_argument(
+            '--deployments', nargs='+', choices=sorted(DEPLOYMENTS), default=['wsgi', 'asgi'],
+            help='Deployments to start and compare when --url is not given',
+        )
+        parser.add_argument('--workers', type=int, default=4, help='gunicorn workers per deployment')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=2.0, help='Fake model latency in seconds')
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--user-id', type=int, help='Existing user to chat as')
+
+    def handle(self, *args, **options):
+        user, created = self._get_user(options['user_id'])
+        payload = {"user_id": user.id, "message": "hello"}
+        try:
+            if options['url']:
+                results = {options['url']: self._drive(options['url'], payload, options)}
+            else:
+                results = {
+                    name: self._run_deployment(name, payload, options)
+                    for name in options['deployments']
+                }
+        finally:
+            if created:
+                user.delete()
+
+        self.stdout.write(f"{'target':>24}  {'requests':>8}  {'errors':>6}  {'req/s':>8}  {'p50 ms':>9}  {'p99 ms':>9}")
+        for target, row in results.items():
+            self.stdout.write(
+                f"{target:>24}  {row['requests']:>8}  {row['errors']:>6}  {row['rps']:>8.1f}  "
+                f"{row['p50_ms']:>9.1f}  {row['p99_ms']:>9.1f}"
+            )
+
+    def _get_user(self, user_id):
+        if user_id:
+            return User.objects.get(id=user_id), False
+        user = User.objects.create_user(username=f"loadtest_{uuid.uuid4().hex[:12]}")
+        Persona.objects.create(
+            user=user, name="Load", role="friend", personality="caring", tone="sweet"
+        )
+        return user, True
+
+    def _drive(self, url, payload, options):
+        self.stdout.write(f"Driving {url} ...")
+        return asyncio.run(run_load(url, payload, options['requests'], options['concurrency']))
+
+    def _run_deployment(self, name, payload, options):
+        command, path = DEPLOYMENTS[name]
+        port = options['port']
+        env = dict(
+            os.environ,
+            GEMINI_BACKEND='fake',
+            GEMINI_FAKE_LATENCY=str(options['latency']),
+        )
+        server = subprocess.Popen(
+            [*command, '--bind', f'127.0.0.1:{port}', '--workers', str(options['workers']),
+             '--timeout', '120', '--log-level', 'warning'],
+            cwd=settings.BASE_DIR, env=env, stdout=sys.stderr, stderr=sys.stderr,
+        )
+        try:
+            if not asyncio.run(wait_until_listening('127.0.0.1', port)):
+                raise CommandError(f"{name} server did not start on port {port}")
+            return self._drive(f"http://127.0.0.1:{port}{path}", payload, options)
+        finally:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.loadtest import first_response, run_load
+from chat.models import Persona
+
+
+PYTHON = sys.executable
+
+# Pipeline name -> (release phase, boot steps, server command). The release
+# phase runs once per deploy; boot steps and the server run on every boot.
+PIPELINES = {
+    # The Procfile before: migrate and create the superuser on every boot;
+    # each worker imports the views and builds the genai client on its
+    # first request
+    'legacy': (
+        [],
+        [[PYTHON, 'manage.py', 'migrate'], [PYTHON, 'manage.py', 'create_default_superuser']],
+        ['gunicorn', 'config.asgi:application', '-k', 'uvicorn.workers.UvicornWorker'],
+    ),
+    # The Procfile now: `release` once, then a preloaded, warmed master
+    'preload': (
+        [[PYTHON, 'manage.py', 'release']],
+        [],
+        ['gunicorn', '-c', 'config/gunicorn_conf.py', 'config.asgi:application'],
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = 'Measures boot-to-first-response of the web process against the local fake model'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pipelines', nargs='+', choices=sorted(PIPELINES), default=['legacy', 'preload'],
+            help='Boot pipelines to start and compare',
+        )
+        parser.add_argument('--runs', type=int, default=3, help='Boots per pipeline')
+        parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+        parser.add_argument('--port', type=int, default=8766)
+        parser.add_argument('--user-id', type=int, help='Existing user to chat as')
+
+    def handle(self, *args, **options):
+        user, created = self._get_user(options['user_id'])
+        payload = {"user_id": user.id, "message": "hello"}
+        try:
+            rows = [
+                (name, run, self._boot(name, payload, options))
+                for name in options['pipelines']
+                for run in range(1, options['runs'] + 1)
+            ]
+        finally:
+            if created:
+                user.delete()
+
+        self.stdout.write(
+            f"{'pipeline':>10}  {'run':>3}  {'release s':>9}  {'boot s':>7}  {'first ms':>9}  "
+            f"{'wave p50 ms':>11}  {'wave p99 ms':>11}"
+        )
+        for name, run, row in rows:
+            self.stdout.write(
+                f"{name:>10}  {run:>3}  {row['release_s']:>9.2f}  {row['boot_s']:>7.2f}  {row['first_ms']:>9.1f}  "
+                f"{row['wave_p50_ms']:>11.1f}  {row['wave_p99_ms']:>11.1f}"
+            )
+
+    def _get_user(self, user_id):
+        if user_id:
+            return User.objects.get(id=user_id), False
+        user = User.objects.create_user(username=f"boottest_{uuid.uuid4().hex[:12]}")
+        Persona.objects.create(
+            user=user, name="Boot", role="friend", personality="caring", tone="sweet"
+        )
+        return user, True
+
+    def _run_steps(self, steps, env):
+        started = time.perf_counter()
+        for step in steps:
+            subprocess.run(step, cwd=settings.BASE_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+        return time.perf_counter() - started
+
+    def _boot(self, name, payload, options):
+        release, boot, command = PIPELINES[name]
+        port = options['port']
+        url = f"http://127.0.0.1:{port}/api/chat/"
+        env = dict(os.environ, GEMINI_BACKEND='fake', GEMINI_FAKE_LATENCY='0')
+
+        release_s = self._run_steps(release, env)
+        started = time.perf_counter()
+        self._run_steps(boot, env)
+        server = subprocess.Popen(
+            [*command, '--bind', f'127.0.0.1:{port}', '--workers', str(options['workers']),
+             '--timeout', '120', '--log-level', 'warning'],
+            cwd=settings.BASE_DIR, env=env, stdout=sys.stderr, stderr=sys.stderr,
+        )
+        try:
+            spawned = time.perf_counter() - started
+            first = asyncio.run(first_response(url, payload))
+            if first is None:
+                raise CommandError(f"{name} server did not answer on port {port}")
+            # One request per worker and then some: workers the first
+            # request did not reach are still cold in the legacy pipeline
+            wave = options['workers'] * 4
+            load = asyncio.run(run_load(url, payload, wave, wave))
+        finally:
+            server.terminate()
+            server.wait()
+        return {
+            'release_s': release_s,
+            'boot_s': spawned + first[0],
+            'first_ms': first[1],
+            'wave_p50_ms': load['p50_ms'],
+            'wave_p99_ms': load['p99_ms'],
+        }
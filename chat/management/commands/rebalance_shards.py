@@ -0,0 +1,55 @@
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from chat.sharding import misplaced_users, move_user, placement, shard_for, sharding_enabled
+
+
+class Command(BaseCommand):
+    help = "Moves users whose rows are not on their hashed shard (or the given users to --to) while they keep chatting"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', help='Only this user id (repeatable)')
+        parser.add_argument('--to', help='Move the --user users to this alias instead of their hashed shard')
+        parser.add_argument(
+            '--settle', type=float, default=settings.CHAT_SHARDING['MOVE_SETTLE'],
+            help='Seconds to wait between switching a user over and the final copy',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages copied per insert')
+        parser.add_argument('--max-users', type=int, help='Stop after moving this many users (rerun to continue)')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the moves')
+
+    def handle(self, *args, **options):
+        if not sharding_enabled():
+            raise CommandError('Sharding is not enabled (set DATABASE_SHARD_URLS)')
+        aliases = settings.CHAT_SHARDING['ALIASES']
+        target = options['to']
+        if target is not None and target not in (*aliases, DEFAULT_DB_ALIAS):
+            raise CommandError(f"Unknown shard {target!r}; expected one of {', '.join(aliases)}")
+        if target is not None and not options['users']:
+            raise CommandError('--to needs --user')
+
+        if options['users']:
+            candidates = ((user_id, shard_for(user_id)) for user_id in options['users'])
+        else:
+            candidates = misplaced_users(aliases)
+        moves = (
+            (user_id, source, target or placement(user_id, aliases)) for user_id, source in candidates
+        )
+        # Read the plan before moving: moves update the assignments being read
+        moves = list(islice(
+            ((user_id, source, destination) for user_id, source, destination in moves if destination != source),
+            options['max_users'],
+        ))
+
+        messages = 0
+        for user_id, source, destination in moves:
+            if options['dry_run']:
+                self.stdout.write(f'{user_id}: {source} -> {destination}')
+            else:
+                messages += move_user(user_id, destination, options['settle'], options['batch_size'])
+
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(moves)} users ({messages} messages)'))
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+
+from chat.sharding import reserve_id_block
+
+
+def pending_migrations(alias):
+    """Unapplied (migration, backwards) steps for a database alias"""
+    executor = MigrationExecutor(connections[alias])
+    return executor.migration_plan(executor.loader.graph.leaf_nodes())
+
+
+class Command(BaseCommand):
+    help = (
+        'Release phase (Procfile): migrates the default database and every shard, '
+        'creates the shared cache table and the default superuser; does almost nothing '
+        'when already up to date'
+    )
+    # The checks import every view (and google.genai); the web process runs them anyway
+    requires_system_checks = []
+
+    def handle(self, *args, **options):
+        # The replica follows the primary and is never migrated directly
+        for alias in (DEFAULT_DB_ALIAS, *settings.CHAT_SHARDING['ALIASES']):
+            plan = pending_migrations(alias)
+            if plan:
+                self.stdout.write(f'{alias}: applying {len(plan)} migrations')
+                call_command('migrate', database=alias, interactive=False, verbosity=options['verbosity'])
+            else:
+                self.stdout.write(f'{alias}: up to date')
+                # Done by migrate otherwise; shards migrated before the blocks need it once
+                reserve_id_block(alias)
+            connections[alias].close()
+        # CACHES['default'] (a no-op for non-database cache backends)
+        call_command('createcachetable', database=DEFAULT_DB_ALIAS, verbosity=options['verbosity'])
+        call_command('create_default_superuser', stdout=self.stdout, stderr=self.stderr)
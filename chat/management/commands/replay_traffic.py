@@ -0,0 +1,106 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.api import issue_token
+from chat.benchmarks import seed_user
+from chat.loadtest import replay_load, wait_until_listening
+from chat.recording import read_log, recorded_users, replay_plan
+
+
+# As the Procfile's web process
+SERVER = ['gunicorn', '-c', 'config/gunicorn_conf.py', 'config.asgi:application']
+
+
+class Command(BaseCommand):
+    help = 'Replays a recorded traffic log (chat/recording.py) against the local fake model'
+
+    def add_arguments(self, parser):
+        parser.add_argument('log', help='Traffic log written by TrafficRecorderMiddleware')
+        parser.add_argument('--url', help='Base URL of an already running server (default: start one)')
+        parser.add_argument(
+            '--workers', type=int, nargs='+', default=[2, 4],
+            help='gunicorn worker counts to start and compare when --url is not given',
+        )
+        parser.add_argument(
+            '--concurrency', type=int, nargs='+', default=[8, 32, 128],
+            help='Client pool sizes to replay with',
+        )
+        parser.add_argument(
+            '--speed', type=float, default=1.0,
+            help='Replay speed (1 as recorded, 10 ten times faster, 0 as fast as possible)',
+        )
+        parser.add_argument('--limit', type=int, help='Only the first N recorded requests')
+        parser.add_argument('--history', type=int, default=50, help='Messages seeded per replayed user')
+        parser.add_argument('--port', type=int, default=8767)
+
+    def handle(self, *args, **options):
+        records = read_log(options['log'])[:options['limit']]
+        if not records:
+            raise CommandError(f"No records in {options['log']}")
+
+        # Every recorded user gets a local stand-in with a persona and history
+        users = {recorded: seed_user(options['history']) for recorded in recorded_users(records)}
+        try:
+            user_ids = {recorded: user.id for recorded, user in users.items()}
+            plan = replay_plan(records, user_ids, {user.id: issue_token(user.id) for user in users.values()})
+            span = plan[-1]['offset'] / options['speed'] if options['speed'] else 0.0
+            self.stdout.write(
+                f"Replaying {len(plan)} requests from {len(users)} users "
+                f"over {span:.1f}s at {options['speed']:g}x"
+            )
+            if options['url']:
+                rows = [(None, *row) for row in self._replay(options['url'], plan, options)]
+            else:
+                rows = [
+                    (workers, *row)
+                    for workers in options['workers']
+                    for row in self._run_server(workers, plan, options)
+                ]
+        finally:
+            for user in users.values():
+                user.delete()
+
+        self.stdout.write(
+            f"{'workers':>7}  {'clients':>7}  {'endpoint':>8}  {'requests':>8}  {'errors':>6}  {'req/s':>8}  "
+            f"{'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}  {'lag p99 ms':>10}"
+        )
+        for workers, concurrency, endpoint, row in rows:
+            self.stdout.write(
+                f"{workers or '-':>7}  {concurrency:>7}  {endpoint:>8}  {row['requests']:>8}  {row['errors']:>6}  "
+                f"{row['rps']:>8.1f}  {row['p50_ms']:>8.1f}  {row['p95_ms']:>8.1f}  {row['p99_ms']:>8.1f}  "
+                f"{row['lag_p99_ms']:>10.1f}"
+            )
+
+    def _replay(self, url, plan, options):
+        for concurrency in options['concurrency']:
+            self.stdout.write(f"Replaying against {url} with {concurrency} clients ...")
+            summaries = asyncio.run(replay_load(url, plan, concurrency, options['speed']))
+            for endpoint, row in summaries.items():
+                yield concurrency, endpoint, row
+
+    def _run_server(self, workers, plan, options):
+        port = options['port']
+        env = dict(
+            os.environ,
+            GEMINI_BACKEND='fake',
+            # The fake model answers as slowly as the recorded upstream calls
+            GEMINI_FAKE_LATENCY_LOG=os.path.abspath(options['log']),
+            CHAT_RECORDING_ENABLED='false',
+        )
+        server = subprocess.Popen(
+            [*SERVER, '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+             '--timeout', '120', '--log-level', 'warning'],
+            cwd=settings.BASE_DIR, env=env, stdout=sys.stderr, stderr=sys.stderr,
+        )
+        try:
+            if not asyncio.run(wait_until_listening('127.0.0.1', port)):
+                raise CommandError(f"Server did not start on port {port}")
+            return list(self._replay(f"http://127.0.0.1:{port}", plan, options))
+        finally:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,56 @@
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from chat.jobs import work
+
+
+def _worker_main(stop_event, poll_interval, once):
+    # Ctrl+C reaches the whole process group; let the parent decide
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    work(stop_event, poll_interval=poll_interval, once=once)
+
+
+class Command(BaseCommand):
+    help = 'Runs a pool of worker processes for queued chat jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=settings.CHAT_JOB_QUEUE['WORKERS'],
+            help='Worker processes, i.e. the number of model calls in flight',
+        )
+        parser.add_argument('--poll-interval', type=float, default=0.5)
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is drained')
+
+    def handle(self, *args, **options):
+        # Children must not inherit the parent's database connections
+        connections.close_all()
+
+        stop_event = multiprocessing.Event()
+
+        def shutdown(signum, frame):
+            self.stdout.write('Stopping workers after their current job...')
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        workers = [
+            multiprocessing.Process(
+                target=_worker_main,
+                args=(stop_event, options['poll_interval'], options['once']),
+                name=f'chat-worker-{i}',
+            )
+            for i in range(options['processes'])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(self.style.SUCCESS(f'Started {len(workers)} chat workers'))
+
+        for worker in workers:
+            worker.join()
+        self.stdout.write(self.style.SUCCESS('Chat workers stopped'))
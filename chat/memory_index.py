@@ -0,0 +1,228 @@
+"""Semantic memory retrieval for the prompt
+
+Instead of pasting every Memory row into the prompt, each turn injects the
+TOP_K memories most similar to the user's message. Memories are embedded
+by a pluggable embedder (default: hashed word and character-trigram
+features, deterministic and local) into a per-user NumPy matrix, so a
+lookup is one matrix-vector product plus an argpartition.
+
+Indexes live in process memory. Memory post_save/post_delete signals
+update the writing process's index in place (see chat/signals.py); other
+workers rebuild theirs from the database once the entry's TTL expires,
+like the in-process prompt cache. bulk_create/update() bypass signals and
+are only picked up on the next rebuild.
+"""
+from collections import OrderedDict
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+class HashedNgramEmbedder:
+    """Feature-hashing embedder over words and character trigrams
+
+    Deterministic across processes and runs (crc32, not hash()), needs no
+    model download, and matches memories that share words or word stems.
+    """
+
+    # 128 buckets keep a 10k-memory scan well under a millisecond
+    dim = 128
+
+    def features(self, text):
+        for word in _WORD.findall(text.lower()):
+            yield word, 1.0
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+
+    def __call__(self, texts):
+        rows, columns, weights = [], [], []
+        for row, text in enumerate(texts):
+            for feature, weight in self.features(text):
+                h = zlib.crc32(feature.encode())
+                rows.append(row)
+                columns.append(h % self.dim)
+                weights.append(weight if h & 0x80000000 else -weight)
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        np.add.at(vectors, (rows, columns), weights)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+def get_embedder():
+    return import_string(settings.CHAT_MEMORY_RETRIEVAL['EMBEDDER'])()
+
+
+def memory_text(key, value):
+    return f"{key.replace('_', ' ')}: {value}"
+
+
+class MemoryIndex:
+    """One user's memories and their embeddings
+
+    Rows are kept in a preallocated matrix that doubles when full; removal
+    moves the last row into the hole, so updates never re-embed the rest.
+    """
+
+    def __init__(self, embedder, rows=(), expires_at=float('inf')):
+        rows = list(rows)
+        self.embedder = embedder
+        self.expires_at = expires_at
+        self.ids = [memory_id for memory_id, _, _ in rows]
+        self.entries = [(key, value) for _, key, value in rows]
+        self.positions = {memory_id: i for i, memory_id in enumerate(self.ids)}
+        self.matrix = np.zeros((max(16, len(rows)), embedder.dim), dtype=np.float32)
+        self._lock = threading.Lock()
+        if rows:
+            self.matrix[:len(rows)] = embedder([memory_text(key, value) for _, key, value in rows])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def upsert(self, memory_id, key, value):
+        vector = self.embedder([memory_text(key, value)])[0]
+        with self._lock:
+            self._upsert(memory_id, key, value, vector)
+
+    def _upsert(self, memory_id, key, value, vector):
+        position = self.positions.get(memory_id)
+        if position is None:
+            position = len(self.ids)
+            if position == len(self.matrix):
+                grown = np.zeros((len(self.matrix) * 2, self.matrix.shape[1]), dtype=np.float32)
+                grown[:position] = self.matrix
+                self.matrix = grown
+            self.ids.append(memory_id)
+            self.entries.append((key, value))
+            self.positions[memory_id] = position
+        else:
+            self.entries[position] = (key, value)
+        self.matrix[position] = vector
+
+    def remove(self, memory_id):
+        with self._lock:
+            self._remove(memory_id)
+
+    def _remove(self, memory_id):
+        position = self.positions.pop(memory_id, None)
+        if position is None:
+            return
+        last = len(self.ids) - 1
+        if position != last:
+            self.ids[position] = self.ids[last]
+            self.entries[position] = self.entries[last]
+            self.matrix[position] = self.matrix[last]
+            self.positions[self.ids[position]] = position
+        self.ids.pop()
+        self.entries.pop()
+
+    def search(self, query, k):
+        """The k memories most similar to query as (key, value) pairs
+
+        With k or fewer memories all of them are returned in insertion order,
+        which is what the prompt contained before retrieval existed. Without
+        a query the k newest are returned.
+        """
+        query_vector = self.embedder([query])[0] if query else None
+        with self._lock:
+            return self._search(query_vector, k)
+
+    def _search(self, query_vector, k):
+        size = len(self.ids)
+        if size <= k:
+            return [self.entries[i] for i in sorted(range(size), key=self.ids.__getitem__)]
+        if query_vector is None:
+            newest = sorted(range(size), key=self.ids.__getitem__)[-k:]
+            return [self.entries[i] for i in newest]
+
+        scores = self.matrix[:size] @ query_vector
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [self.entries[i] for i in top]
+
+
+class MemoryIndexStore:
+    """Per-process LRU of MemoryIndex objects keyed by user id"""
+
+    def __init__(self, max_users=1000, ttl=300, embedder=None):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.embedder = embedder or get_embedder()
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Cached index or None; never touches the database"""
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                return None
+            if index.expires_at < time.monotonic():
+                del self._indexes[user_id]
+                return None
+            self._indexes.move_to_end(user_id)
+            return index
+
+    def load(self, user_id):
+        """Build the user's index from the database and cache it"""
+        from .models import Memory
+        from .sharding import use_shard
+
+        with use_shard(user_id):
+            rows = list(Memory.objects.filter(user_id=user_id).order_by('id').values_list('id', 'key', 'value'))
+        index = MemoryIndex(self.embedder, rows, expires_at=time.monotonic() + self.ttl)
+        with self._lock:
+            self._indexes[user_id] = index
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+        return index
+
+    def for_user(self, user_id):
+        index = self.get(user_id)
+        return index if index is not None else self.load(user_id)
+
+    def upsert(self, memory):
+        """Apply a saved Memory to an already built index (signals)"""
+        index = self.get(memory.user_id)
+        if index is not None:
+            index.upsert(memory.id, memory.key, memory.value)
+
+    def remove(self, memory):
+        index = self.get(memory.user_id)
+        if index is not None:
+            index.remove(memory.id)
+
+    def discard(self, user_id):
+        """Drop a user's index so the next lookup rebuilds it (bulk writes)"""
+        with self._lock:
+            self._indexes.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_memory_index():
+    """Process-wide MemoryIndexStore configured by CHAT_MEMORY_RETRIEVAL"""
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = settings.CHAT_MEMORY_RETRIEVAL
+                _store = MemoryIndexStore(config['MAX_USERS'], config['TTL'])
+    return _store
@@ -0,0 +1,446 @@
+"""Per-request and per-stage metrics for the chat hot path
+
+A request (MetricsMiddleware) or a test (capture_turn) opens a Turn;
+GeminiService marks its stages with stage() and every DB query issued
+meanwhile is counted against the current stage. Finished requests feed the
+histograms exported in the Prometheus text format at /metrics and, with
+CHAT_METRICS_LOG, one structured log line each.
+
+With CHAT_METRICS disabled the middleware is not installed and stage() is a
+shared no-op context manager, so the hot path only pays a ContextVar lookup.
+Each process keeps its own registry. With CHAT_METRICS['MULTIPROCESS_DIR']
+set, every process also writes it to <dir>/<pid>.json (within
+DUMP_INTERVAL of a change, and on exit), and /metrics adds up all the files
+there, so any worker a scrape lands on answers for all of them. The
+files of exited workers keep counting, so totals never go down; the
+gunicorn master empties the directory on start.
+"""
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+logger = logging.getLogger(__name__)
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+_current = ContextVar('chat_metrics_turn', default=None)
+_NO_STAGE = nullcontext()
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=TIME_BUCKETS, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            series[1] += value
+            series[2] += 1
+        _changed()
+
+    def snapshot(self):
+        """{label values: [bucket counts, sum, count]}, a copy"""
+        with self._lock:
+            return {key: [list(counts), total, count] for key, (counts, total, count) in self._series.items()}
+
+    @staticmethod
+    def merge(series, key, value):
+        """Add another process's value for key into a snapshot"""
+        current = series.get(key)
+        if current is None:
+            series[key] = [list(value[0]), value[1], value[2]]
+        else:
+            current[0] = [mine + theirs for mine, theirs in zip(current[0], value[0])]
+            current[1] += value[1]
+            current[2] += value[2]
+
+    def render(self, series=None):
+        series = self.snapshot() if series is None else series
+        for key, (counts, total, count) in sorted(series.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, le=bound)} {bucket_count}"
+            yield f"{self.name}_bucket{_labels(self.labelnames, key, le='+Inf')} {count}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {count}"
+
+
+class Counter:
+    """Prometheus-style monotonic counter"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _changed()
+
+    def value(self, **labels):
+        """This process's value"""
+        return self._values.get(tuple(str(labels.get(name, '')) for name in self.labelnames), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(series, key, value):
+        series[key] = series.get(key, 0) + value
+
+    def render(self, series=None):
+        series = self.snapshot() if series is None else series
+        for key, value in sorted(series.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {value}"
+
+
+def _labels(names, values, le=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = []
+
+REQUEST_DURATION = Histogram(
+    'chat_request_duration_seconds', 'API request latency (time to first byte for streams)',
+    labelnames=('view', 'method', 'status'),
+)
+REQUEST_QUERIES = Histogram(
+    'chat_request_db_queries', 'DB queries per API request', QUERY_BUCKETS, labelnames=('view',)
+)
+STAGE_DURATION = Histogram(
+    'chat_stage_duration_seconds', 'Time spent per chat turn stage', labelnames=('stage',)
+)
+STAGE_QUERIES = Histogram(
+    'chat_stage_db_queries', 'DB queries per chat turn stage', QUERY_BUCKETS, labelnames=('stage',)
+)
+PROMPT_CHARS = Histogram('chat_prompt_chars', 'Prompt size in characters', SIZE_BUCKETS)
+REPLY_CHARS = Histogram('chat_reply_chars', 'Reply size in characters', SIZE_BUCKETS)
+PROMPT_TOKENS = Histogram('chat_prompt_tokens', 'Estimated prompt tokens', TOKEN_BUCKETS)
+REPLY_TOKENS = Histogram('chat_reply_tokens', 'Estimated reply tokens', TOKEN_BUCKETS)
+UPSTREAM_ERRORS = Counter(
+    'chat_upstream_errors_total', 'Failed upstream model calls by error class', labelnames=('kind',)
+)
+ROUTE_LATENCY = Histogram(
+    'chat_route_latency_seconds', 'Successful model call latency per route', labelnames=('route',)
+)
+ROUTE_CALLS = Counter(
+    'chat_route_calls_total', 'Model calls per route by outcome (ok, error, hedged)', labelnames=('route', 'outcome')
+)
+ROUTE_COST = Counter('chat_route_cost_usd_total', 'Estimated model spend per route', labelnames=('route',))
+RESPONSE_CACHE_HITS = Counter('chat_response_cache_hits_total', 'Model calls answered from the response cache')
+RESPONSE_CACHE_MISSES = Counter('chat_response_cache_misses_total', 'Model calls the response cache sent upstream')
+RESPONSE_CACHE_COALESCED = Counter(
+    'chat_response_cache_coalesced_total', 'Model calls that waited on an identical call in flight'
+)
+
+SIZE_HISTOGRAMS = {
+    'prompt_chars': PROMPT_CHARS,
+    'reply_chars': REPLY_CHARS,
+    'prompt_tokens': PROMPT_TOKENS,
+    'reply_tokens': REPLY_TOKENS,
+}
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format, summed over
+    every process with MULTIPROCESS_DIR"""
+    series = {metric.name: metric.snapshot() for metric in REGISTRY}
+    directory = settings.CHAT_METRICS['MULTIPROCESS_DIR']
+    if directory:
+        metrics = {metric.name: metric for metric in REGISTRY}
+        for name, rows in _other_processes(directory):
+            metric = metrics.get(name)
+            if metric is not None:
+                for key, value in rows:
+                    metric.merge(series[name], tuple(key), value)
+
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render(series[metric.name]))
+    return "\n".join(lines) + "\n"
+
+
+def _other_processes(directory):
+    """(metric name, [[label values, value], ...]) from other processes' files"""
+    own = f"{os.getpid()}.json"
+    for entry in os.scandir(directory):
+        if not entry.name.endswith('.json') or entry.name == own:
+            continue
+        try:
+            with open(entry.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # Removed meanwhile; files are replaced whole, never torn
+            continue
+        yield from data.items()
+
+
+_dirty = False
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def _changed():
+    """Note a change; starts this process's file writer with MULTIPROCESS_DIR"""
+    global _dirty
+    _dirty = True
+    # Per pid: threads do not survive the fork of a preloaded app
+    if _writer_pid != os.getpid() and settings.CHAT_METRICS['MULTIPROCESS_DIR']:
+        _start_writer()
+
+
+def _start_writer():
+    global _writer_pid
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        _writer_pid = os.getpid()
+    threading.Thread(target=_write_periodically, name="metrics-writer", daemon=True).start()
+    atexit.register(write_process_metrics)
+
+
+def _write_periodically():
+    global _dirty
+    while True:
+        time.sleep(settings.CHAT_METRICS['DUMP_INTERVAL'])
+        if _dirty:
+            _dirty = False
+            try:
+                write_process_metrics()
+            except OSError:
+                logger.exception("Writing metrics to %s failed", settings.CHAT_METRICS['MULTIPROCESS_DIR'])
+
+
+def write_process_metrics():
+    """Write this process's metrics to <MULTIPROCESS_DIR>/<pid>.json"""
+    directory = settings.CHAT_METRICS['MULTIPROCESS_DIR']
+    if not directory:
+        return
+    data = {
+        metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+        for metric in REGISTRY
+    }
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def clear_process_metrics():
+    """Remove every process's file (gunicorn master start)"""
+    directory = settings.CHAT_METRICS['MULTIPROCESS_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.scandir(directory):
+            if entry.name.endswith(('.json', '.json.tmp')):
+                os.remove(entry.path)
+
+
+class Turn:
+    """Timings, query counts and sizes collected for one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.queries = {}
+        self.sizes = {}
+        self.upstream_errors = []
+        self.current_stage = None
+
+    @property
+    def total_queries(self):
+        return sum(self.queries.values())
+
+    def as_dict(self):
+        return {
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'stages_ms': {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+            'queries': self.total_queries,
+            'stage_queries': dict(self.queries),
+            **self.sizes,
+            'upstream_errors': self.upstream_errors,
+        }
+
+
+class _Stage:
+    __slots__ = ('turn', 'name', 'previous', 'started')
+
+    def __init__(self, turn, name):
+        self.turn = turn
+        self.name = name
+
+    def __enter__(self):
+        self.previous = self.turn.current_stage
+        self.turn.current_stage = self.name
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        turn = self.turn
+        turn.stages[self.name] = turn.stages.get(self.name, 0.0) + time.perf_counter() - self.started
+        turn.current_stage = self.previous
+
+
+def stage(name):
+    """Context manager timing a turn stage; a no-op outside a Turn"""
+    turn = _current.get()
+    if turn is None:
+        return _NO_STAGE
+    return _Stage(turn, name)
+
+
+def current_turn():
+    """The Turn being collected for this request, or None"""
+    return _current.get()
+
+
+def record(**sizes):
+    """Attach prompt/reply sizes to the current Turn, if any"""
+    turn = _current.get()
+    if turn is not None:
+        turn.sizes.update(sizes)
+
+
+def count_upstream_error(kind):
+    """Count one failed upstream attempt"""
+    turn = _current.get()
+    if turn is not None:
+        turn.upstream_errors.append(kind)
+    if settings.CHAT_METRICS['ENABLED']:
+        UPSTREAM_ERRORS.inc(kind=kind)
+
+
+def count_query(execute, sql, params, many, context):
+    """Database execute wrapper charging each query to the current stage"""
+    turn = _current.get()
+    if turn is not None:
+        stage_name = turn.current_stage or 'other'
+        turn.queries[stage_name] = turn.queries.get(stage_name, 0) + 1
+    return execute(sql, params, many, context)
+
+
+@contextmanager
+def capture_turn():
+    """Collect a Turn for the enclosed code without publishing it (tests)
+
+        with capture_turn() as turn:
+            service.chat(user, "hi")
+        assert turn.queries['history'] == 1
+    """
+    turn = Turn()
+    token = _current.set(turn)
+    try:
+        yield turn
+    finally:
+        _current.reset(token)
+
+
+def publish(turn, view, method, status):
+    """Feed a finished request's Turn into the histograms and the log"""
+    duration = time.perf_counter() - turn.started
+    REQUEST_DURATION.observe(duration, view=view, method=method, status=status)
+    REQUEST_QUERIES.observe(turn.total_queries, view=view)
+    for name, seconds in turn.stages.items():
+        STAGE_DURATION.observe(seconds, stage=name)
+    for name, count in turn.queries.items():
+        STAGE_QUERIES.observe(count, stage=name)
+    for name, value in turn.sizes.items():
+        histogram = SIZE_HISTOGRAMS.get(name)
+        if histogram is not None:
+            histogram.observe(value)
+
+    if settings.CHAT_METRICS['LOG_REQUESTS']:
+        logger.info(json.dumps({'view': view, 'method': method, 'status': status, **turn.as_dict()}))
+
+
+class MetricsMiddleware:
+    """Open a Turn for every /api/ request and publish it afterwards"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.CHAT_METRICS['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.prefix = settings.CHAT_METRICS['PATH_PREFIX']
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not request.path.startswith(self.prefix):
+            return self.get_response(request)
+
+        turn = Turn()
+        token = _current.set(turn)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._publish(request, response, turn)
+        return response
+
+    async def __acall__(self, request):
+        if not request.path.startswith(self.prefix):
+            return await self.get_response(request)
+
+        turn = Turn()
+        token = _current.set(turn)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._publish(request, response, turn)
+        return response
+
+    def _publish(self, request, response, turn):
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        publish(turn, view, request.method, response.status_code)
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 
 class Persona(models.Model):
@@ -31,13 +32,40 @@ class Message(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='messages')
     sender = models.CharField(max_length=10, choices=SENDER_CHOICES)
     message = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so imports (chat/transfer.py) can keep the original time
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     def __str__(self):
         return f"{self.sender}: {self.message[:50]}"
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='chat_message_user_created'),
+        ]
+
+
+class MessageArchive(models.Model):
+    """A block of a user's oldest messages moved out of Message (chat/archive.py)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='message_archives')
+    # (created_at, id) of the first and last message in the block
+    first_created_at = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_created_at = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    count = models.PositiveIntegerField()
+    # zlib-compressed JSON lines: [id, sender, message, created_at]
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.count} archived messages for {self.user.username}"
+
+    class Meta:
+        ordering = ['last_created_at', 'last_id']
+        indexes = [
+            models.Index(fields=['user', 'last_created_at', 'last_id'], name='chat_archive_user_last'),
+        ]
 
 
 class Memory(models.Model):
@@ -53,3 +81,87 @@ class Memory(models.Model):
     class Meta:
         verbose_name_plural = "Memories"
         unique_together = ['user', 'key']
+
+
+class ConversationSummary(models.Model):
+    """Rolling summary of the turns that no longer fit in the prompt window"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='conversation_summary')
+    summary = models.TextField(blank=True)
+    # Newest message folded into the summary, as a (created_at, id) watermark
+    covered_until = models.DateTimeField(null=True, blank=True)
+    covered_until_id = models.BigIntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Summary for {self.user.username}"
+
+    class Meta:
+        verbose_name_plural = "Conversation summaries"
+
+
+class MemoryExtractionState(models.Model):
+    """How far the user's messages have been mined for memories"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='memory_extraction')
+    # Newest user message already extracted, as a (created_at, id) watermark
+    extracted_until = models.DateTimeField(null=True, blank=True)
+    extracted_until_id = models.BigIntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Memory extraction for {self.user.username}"
+
+
+class ChatJob(models.Model):
+    """Chat turn queued for a background worker (see run_chat_workers)"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_jobs')
+    message = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    reply = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Job {self.id} ({self.status}) for {self.user.username}"
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'user'], name='chat_job_status_user'),
+        ]
+
+
+class ShardAssignment(models.Model):
+    """The database alias holding a user's sharded rows (chat/sharding.py)"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='shard_assignment')
+    alias = models.CharField(max_length=64)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user_id} on {self.alias}"
+
+
+class RateLimitBucket(models.Model):
+    """Upstream quota shared by every worker (chat/resilience.py TokenBucket)"""
+    name = models.CharField(max_length=128, primary_key=True)
+    tokens = models.FloatField()
+    # time.time() of the last refill
+    updated = models.FloatField()
+
+    def __str__(self):
+        return f"{self.name}: {self.tokens:.1f}"
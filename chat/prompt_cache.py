@@ -0,0 +1,127 @@
+"""Per-user cache of the compiled prompt prefix (persona + memories)
+
+The prefix only changes when a Persona or Memory row is written, so it is
+compiled once and invalidated from model signals (see chat/signals.py).
+Signals only reach the process that performed the write: with the
+in-process LRU backend other workers see the change once their entry's
+TTL expires, while the 'django' backend shares entries between workers.
+"""
+from collections import OrderedDict, namedtuple
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# head: system and persona text, memory_block: the Memory section (empty
+# when memories are retrieved per turn), history_head: summary and history
+# heading, tail: the TASK block after the history lines
+PromptPrefix = namedtuple('PromptPrefix', ['persona_name', 'head', 'memory_block', 'history_head', 'tail'])
+
+
+def cache_key(user_id):
+    return f"chat:prompt-prefix:v2:{user_id}"
+
+
+class LRUPromptCache:
+    """In-process LRU cache with size and TTL eviction"""
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        key = cache_key(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, user_id, value):
+        key = cache_key(user_id)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(cache_key(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Pure in-memory operations, safe to call from the event loop
+    async def aget(self, user_id):
+        return self.get(user_id)
+
+    async def aset(self, user_id, value):
+        self.set(user_id, value)
+
+
+class DjangoPromptCache:
+    """Prompt cache backed by Django's cache framework (shared across workers)"""
+
+    def __init__(self, alias='default', ttl=60):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, user_id):
+        value = self.cache.get(cache_key(user_id))
+        return PromptPrefix(*value) if value is not None else None
+
+    def set(self, user_id, value):
+        self.cache.set(cache_key(user_id), tuple(value), self.ttl)
+
+    def delete(self, user_id):
+        self.cache.delete(cache_key(user_id))
+
+    def clear(self):
+        # Django caches cannot drop keys by prefix, so this clears the alias
+        self.cache.clear()
+
+    async def aget(self, user_id):
+        value = await self.cache.aget(cache_key(user_id))
+        return PromptPrefix(*value) if value is not None else None
+
+    async def aset(self, user_id, value):
+        await self.cache.aset(cache_key(user_id), tuple(value), self.ttl)
+
+
+_prompt_cache = None
+_prompt_cache_lock = threading.Lock()
+
+
+def get_prompt_cache():
+    """Return the process-wide prompt cache configured by CHAT_PROMPT_CACHE"""
+    global _prompt_cache
+
+    if _prompt_cache is None:
+        with _prompt_cache_lock:
+            if _prompt_cache is None:
+                config = settings.CHAT_PROMPT_CACHE
+                if config['BACKEND'] == 'django':
+                    _prompt_cache = DjangoPromptCache(alias=config.get('ALIAS', 'default'), ttl=config['TTL'])
+                else:
+                    _prompt_cache = LRUPromptCache(max_size=config['MAX_SIZE'], ttl=config['TTL'])
+    return _prompt_cache
+
+
+def invalidate_prompt_prefix(user_id):
+    """Drop the cached prefix for a user after persona/memory changes"""
+    get_prompt_cache().delete(user_id)
@@ -0,0 +1,61 @@
+"""Anonymous user provisioning
+
+Handles are random (uuid4-based) rather than derived from a row count, so
+signups never scan the user table and concurrent signups cannot race into
+the same username. Each user gets a default Persona in the same
+transaction (unless it lives on a shard); the persona form later
+overwrites it.
+"""
+import uuid
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .models import Persona
+from .sharding import by_shard, place_users
+
+
+DEFAULT_PERSONA = {
+    'name': 'Companion',
+    'role': 'friend',
+    'personality': 'caring, supportive',
+    'tone': 'friendly',
+}
+
+
+def new_handle():
+    # 64 random bits: collisions are negligible even at hundreds of millions of users
+    return f"user_{uuid.uuid4().hex[:16]}"
+
+
+def _new_user():
+    user = User(username=new_handle())
+    user.set_unusable_password()
+    return user
+
+
+def provision_user():
+    """Create one anonymous user and its default persona"""
+    with transaction.atomic():
+        user = _new_user()
+        user.save()
+        # Saved through the instance so the router finds the user's shard
+        Persona(user=user, **DEFAULT_PERSONA).save()
+    return user
+
+
+def provision_users(count, batch_size=1000):
+    """Create count users (and default personas) with batched inserts"""
+    users = []
+    with transaction.atomic():
+        for start in range(0, count, batch_size):
+            batch = User.objects.bulk_create(
+                [_new_user() for _ in range(min(batch_size, count - start))]
+            )
+            # bulk_create sends no post_save, so place the users here
+            place_users(batch)
+            personas = [Persona(user=user, **DEFAULT_PERSONA) for user in batch]
+            for alias, group in by_shard(personas).items():
+                Persona.objects.using(alias).bulk_create(group)
+            users.extend(batch)
+    return users
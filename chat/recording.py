@@ -0,0 +1,260 @@
+"""Traffic recording for replay load tests
+
+With CHAT_RECORDING['ENABLED'], TrafficRecorderMiddleware samples
+SAMPLE_RATE of the API requests under PATHS (chat, history and personas)
+into an append-only log. Each request becomes one JSON array per line:
+
+    [ts, method, path, status, duration_ms, upstream_ms, body]
+
+- ts is the wall-clock start in seconds.
+- path includes the query string.
+- upstream_ms is the time spent in the model call: the 'model' stage of the
+  request's metrics Turn. It is null when the model was not called (reads,
+  cache hits) and for streamed replies, which are only timed to the first
+  byte.
+- body is the parsed JSON body, or null.
+
+With REDACT (the default), every string in the body is stored as
+[length], so the log keeps the shape of the traffic but none of the text.
+
+Every worker appends through its own O_APPEND descriptor, one write per
+line. A process stops recording once the file reaches MAX_BYTES.
+
+`manage.py replay_traffic` re-drives a log against a local server
+(chat.loadtest.replay_load), mapping the recorded users onto seeded
+ones. With GEMINI_FAKE_LATENCY_LOG, the fake model's latency is drawn
+from the recorded upstream durations (upstream_sampler).
+"""
+from contextlib import contextmanager
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .metrics import capture_turn, current_turn
+from .transfer import open_ndjson
+
+
+# Record fields, in order
+FIELDS = ('ts', 'method', 'path', 'status', 'duration_ms', 'upstream_ms', 'body')
+
+# Paths naming a user, and the body field that does
+USER_PATH = re.compile(r'^(/api/(?:messages|personas)/)(\d+)(/.*)$')
+USER_FIELD = 'user_id'
+
+
+def redact(value):
+    """The body with every string replaced by [its length]"""
+    if isinstance(value, str):
+        return [len(value)]
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def unredact(value, filler="lorem ipsum dolor sit amet "):
+    """Undo redact() with filler text of the recorded lengths"""
+    if isinstance(value, list):
+        if len(value) == 1 and isinstance(value[0], int) and not isinstance(value[0], bool):
+            return (filler * (value[0] // len(filler) + 1))[:value[0]]
+        return [unredact(item, filler) for item in value]
+    if isinstance(value, dict):
+        return {key: unredact(item, filler) for key, item in value.items()}
+    return value
+
+
+class TrafficLog:
+    """Appends records to the log file from any process or thread"""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._fd = None
+        self._pid = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Per process: a descriptor inherited across a fork is not reused
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            self._pid = os.getpid()
+            self._size = os.fstat(self._fd).st_size
+        return self._fd
+
+    def write(self, record):
+        line = (json.dumps(record, separators=(',', ':'), ensure_ascii=False) + "\n").encode()
+        with self._lock:
+            fd = self._open()
+            if self._size + len(line) > self.max_bytes:
+                return False
+            os.write(fd, line)
+            self._size += len(line)
+        return True
+
+
+def read_log(path):
+    """Records from a log (plain or gzipped) in time order, as dicts
+
+    Lines that do not parse (e.g. one cut off by a crash) are skipped.
+    """
+    records = []
+    with open(path, 'rb') as stream:
+        for line in open_ndjson(stream):
+            try:
+                values = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(values, list) and len(values) == len(FIELDS):
+                records.append(dict(zip(FIELDS, values)))
+    records.sort(key=lambda record: record['ts'])
+    return records
+
+
+def recorded_users(records):
+    """Ids of the users the records name, in first-seen order"""
+    seen = {}
+    for record in records:
+        match = USER_PATH.match(record['path'])
+        if match:
+            seen.setdefault(int(match.group(2)), None)
+        body = record['body']
+        if isinstance(body, dict) and isinstance(body.get(USER_FIELD), int):
+            seen.setdefault(body[USER_FIELD], None)
+    return list(seen)
+
+
+def rewrite(record, user_ids):
+    """(path, body, user id) for replaying a record as the mapped user
+
+    user_ids maps recorded user ids to local ones; redacted strings are
+    filled back in.
+    """
+    path, user_id = record['path'], None
+    match = USER_PATH.match(path)
+    if match and int(match.group(2)) in user_ids:
+        user_id = user_ids[int(match.group(2))]
+        path = f"{match.group(1)}{user_id}{match.group(3)}"
+    body = unredact(record['body'])
+    if isinstance(body, dict) and body.get(USER_FIELD) in user_ids:
+        user_id = user_ids[body[USER_FIELD]]
+        body = {**body, USER_FIELD: user_id}
+    return path, body, user_id
+
+
+def replay_plan(records, user_ids, tokens=None):
+    """Requests for chat.loadtest.replay_load, scheduled as recorded
+
+    tokens maps local user ids to API tokens sent as bearer tokens.
+    """
+    if not records:
+        return []
+    first = records[0]['ts']
+    plan = []
+    for record in records:
+        path, body, user_id = rewrite(record, user_ids)
+        token = (tokens or {}).get(user_id)
+        plan.append({
+            'offset': record['ts'] - first,
+            'method': record['method'],
+            'path': path,
+            'body': body,
+            'headers': {'Authorization': f'Bearer {token}'} if token else {},
+            # chat, messages or personas
+            'endpoint': path.split('/')[2],
+        })
+    return plan
+
+
+def upstream_sampler(path):
+    """A function drawing model latencies (seconds) from a log's upstream durations
+
+    None when the log recorded no model calls.
+    """
+    durations = [record['upstream_ms'] / 1000 for record in read_log(path) if record['upstream_ms'] is not None]
+    if not durations:
+        return None
+    return lambda: random.choice(durations)
+
+
+@contextmanager
+def _request_turn():
+    # The metrics Turn when MetricsMiddleware opened one, else a private one
+    turn = current_turn()
+    if turn is not None:
+        yield turn
+    else:
+        with capture_turn() as turn:
+            yield turn
+
+
+class TrafficRecorderMiddleware:
+    """Sample API requests into the traffic log"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = settings.CHAT_RECORDING
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.paths = tuple(config['PATHS'])
+        self.sample_rate = config['SAMPLE_RATE']
+        self.redact = config['REDACT']
+        self.log = TrafficLog(config['LOG'], config['MAX_BYTES'])
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self._sampled(request):
+            return self.get_response(request)
+
+        body = self._body(request)
+        ts, started = time.time(), time.perf_counter()
+        with _request_turn() as turn:
+            response = self.get_response(request)
+        self._write(request, response, body, ts, started, turn)
+        return response
+
+    async def __acall__(self, request):
+        if not self._sampled(request):
+            return await self.get_response(request)
+
+        body = self._body(request)
+        ts, started = time.time(), time.perf_counter()
+        with _request_turn() as turn:
+            response = await self.get_response(request)
+        self._write(request, response, body, ts, started, turn)
+        return response
+
+    def _sampled(self, request):
+        return request.path.startswith(self.paths) and random.random() < self.sample_rate
+
+    def _body(self, request):
+        # Read before the view so the parsers get it from memory afterwards
+        if request.method not in ('POST', 'PUT', 'PATCH'):
+            return None
+        try:
+            body = json.loads(request.body)
+        except ValueError:
+            return None
+        return redact(body) if self.redact else body
+
+    def _write(self, request, response, body, ts, started, turn):
+        duration_ms = (time.perf_counter() - started) * 1000
+        upstream = None if response.streaming else turn.stages.get('model')
+        self.log.write([
+            round(ts, 3), request.method, request.get_full_path(), response.status_code,
+            round(duration_ms, 1), None if upstream is None else round(upstream * 1000, 1), body,
+        ])
@@ -0,0 +1,400 @@
+"""Resilience layer around upstream model calls
+
+* TokenBucket / RateLimiter: request and token quotas kept in the
+  RateLimitBucket table on the default database, so every worker draws
+  from the same buckets.
+* RetryPolicy: jittered exponential backoff for retryable failures
+  (429, 5xx, timeouts).
+* CircuitBreaker: after repeated upstream failures calls fail fast until a
+  trial call succeeds.
+
+Failures surface as UpstreamError so callers can answer 503 instead of
+saving an error message as the AI's reply.
+"""
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Least
+from django.db.models.lookups import GreaterThanOrEqual
+from google.genai import errors as genai_errors
+
+from .metrics import count_upstream_error
+from .models import RateLimitBucket
+
+
+RATE_LIMITED = 'rate_limited'
+SERVER_ERROR = 'server_error'
+TIMEOUT = 'timeout'
+CLIENT_ERROR = 'client_error'
+CIRCUIT_OPEN = 'circuit_open'
+OTHER = 'other'
+
+RETRYABLE = {RATE_LIMITED, SERVER_ERROR, TIMEOUT}
+
+
+class UpstreamError(Exception):
+    """The model call failed; kind is one of the error classes above"""
+
+    def __init__(self, kind, message, retry_after=None):
+        super().__init__(message)
+        self.kind = kind
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.kind in RETRYABLE
+
+
+def classify(error):
+    """Map an exception from the genai client to an error class"""
+    if isinstance(error, UpstreamError):
+        return error.kind
+    if isinstance(error, (httpx.TimeoutException, TimeoutError, asyncio.TimeoutError)):
+        return TIMEOUT
+    if isinstance(error, genai_errors.APIError):
+        if error.code == 429:
+            return RATE_LIMITED
+        if error.code == 408:
+            return TIMEOUT
+        if error.code >= 500:
+            return SERVER_ERROR
+        return CLIENT_ERROR
+    if isinstance(error, httpx.TransportError):
+        return SERVER_ERROR
+    return OTHER
+
+
+class TokenBucket:
+    """Token bucket kept in a RateLimitBucket row on the default database
+
+    Taking tokens is a single conditional UPDATE that refills and spends in
+    one statement, so concurrent workers never double-spend and a granted
+    call costs one query.
+    """
+
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+
+    def _rows(self):
+        return RateLimitBucket.objects.using(DEFAULT_DB_ALIAS).filter(name=self.name)
+
+    def _spend(self, cost, now):
+        """(rows to UPDATE when cost tokens are available, the UPDATE's values)"""
+        available = Least(
+            Value(float(self.capacity)),
+            F('tokens') + Greatest(Value(now) - F('updated'), Value(0.0)) * Value(float(self.rate)),
+        )
+        return self._rows().filter(GreaterThanOrEqual(available, float(cost))), {
+            'tokens': available - Value(float(cost)), 'updated': Value(now),
+        }
+
+    def _full(self, now):
+        """A new, full bucket; created by whichever worker uses it first"""
+        return [RateLimitBucket(name=self.name, tokens=float(self.capacity), updated=now)]
+
+    def _wait(self, state, cost, now):
+        """Seconds until cost tokens are available"""
+        tokens, updated = state
+        tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+        return max((cost - tokens) / self.rate, 0.001)
+
+    def try_acquire(self, cost=1):
+        """Take cost tokens; returns (acquired, seconds until enough tokens)"""
+        cost = min(cost, self.capacity)
+        for _ in range(2):
+            now = time.time()
+            rows, values = self._spend(cost, now)
+            if rows.update(**values):
+                return True, 0.0
+            state = self._rows().values_list('tokens', 'updated').first()
+            if state is not None:
+                return False, self._wait(state, cost, now)
+            RateLimitBucket.objects.using(DEFAULT_DB_ALIAS).bulk_create(self._full(now), ignore_conflicts=True)
+        return False, 0.05
+
+    async def atry_acquire(self, cost=1):
+        """Async variant of try_acquire; never blocks the event loop"""
+        cost = min(cost, self.capacity)
+        for _ in range(2):
+            now = time.time()
+            rows, values = self._spend(cost, now)
+            if await rows.aupdate(**values):
+                return True, 0.0
+            state = await self._rows().values_list('tokens', 'updated').afirst()
+            if state is not None:
+                return False, self._wait(state, cost, now)
+            await RateLimitBucket.objects.using(DEFAULT_DB_ALIAS).abulk_create(self._full(now), ignore_conflicts=True)
+        return False, 0.05
+
+
+class RateLimiter:
+    """Request-per-minute and token-per-minute quotas for the upstream"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_wait=0.0, name='default'):
+        self.buckets = []
+        if requests_per_minute:
+            self.buckets.append(
+                (TokenBucket(f'{name}:requests', requests_per_minute / 60, requests_per_minute), False)
+            )
+        if tokens_per_minute:
+            self.buckets.append(
+                (TokenBucket(f'{name}:tokens', tokens_per_minute / 60, tokens_per_minute), True)
+            )
+        self.max_wait = max_wait
+
+    def _try(self, tokens):
+        for bucket, by_tokens in self.buckets:
+            acquired, wait = bucket.try_acquire(tokens if by_tokens else 1)
+            if not acquired:
+                return wait
+        return 0.0
+
+    async def _atry(self, tokens):
+        for bucket, by_tokens in self.buckets:
+            acquired, wait = await bucket.atry_acquire(tokens if by_tokens else 1)
+            if not acquired:
+                return wait
+        return 0.0
+
+    def acquire(self, tokens=1):
+        """Block up to max_wait for quota, else raise UpstreamError(rate_limited)"""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            wait = self._try(tokens)
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                raise UpstreamError(RATE_LIMITED, "Local rate limit reached", retry_after=wait)
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=1):
+        """Async variant of acquire()"""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            wait = await self._atry(tokens)
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                raise UpstreamError(RATE_LIMITED, "Local rate limit reached", retry_after=wait)
+            await asyncio.sleep(wait)
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter"""
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """Sleep before retry number attempt (1-based)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Closed -> open after failure_threshold consecutive failures -> half-open
+    after recovery_timeout, where one trial call decides"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    # allow() result for the half-open trial call
+    TRIAL = 'trial'
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """False to fail fast; TRIAL for the half-open trial call, else True"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return self.TRIAL
+            return False
+
+    def retry_after(self):
+        return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release(self, allowed):
+        """End an allowed call with no verdict on upstream health (it never
+        reached the upstream or was cancelled); frees the trial if it held it"""
+        if allowed == self.TRIAL:
+            with self._lock:
+                self._trial_running = False
+
+
+class UpstreamGuard:
+    """Rate limit, retry and circuit-break a model call"""
+
+    def __init__(self, limiter, retry_policy, breaker, sleep=time.sleep, async_sleep=asyncio.sleep):
+        self.limiter = limiter
+        self.retry_policy = retry_policy
+        self.breaker = breaker
+        self.sleep = sleep
+        self.async_sleep = async_sleep
+
+    def _before_attempt(self):
+        allowed = self.breaker.allow()
+        if not allowed:
+            raise UpstreamError(
+                CIRCUIT_OPEN, "Upstream is unhealthy, failing fast", retry_after=self.breaker.retry_after()
+            )
+        return allowed
+
+    def _acquire(self, tokens, allowed):
+        # Over our own quota says nothing about upstream health: not a
+        # breaker failure, not an upstream error, and not retried
+        try:
+            self.limiter.acquire(tokens)
+        except UpstreamError:
+            self.breaker.release(allowed)
+            raise
+
+    async def _aacquire(self, tokens, allowed):
+        try:
+            await self.limiter.aacquire(tokens)
+        except (UpstreamError, asyncio.CancelledError):
+            self.breaker.release(allowed)
+            raise
+
+    def _after_failure(self, error, attempt):
+        """Record the failure; returns the UpstreamError to raise, or None to retry"""
+        kind = classify(error)
+        count_upstream_error(kind)
+        if kind == CLIENT_ERROR:
+            # Our request was bad; says nothing about upstream health
+            self.breaker.record_success()
+        elif kind != CIRCUIT_OPEN:
+            self.breaker.record_failure()
+        if kind in RETRYABLE and attempt < self.retry_policy.max_attempts:
+            return None
+        if isinstance(error, UpstreamError):
+            return error
+        return UpstreamError(kind, str(error))
+
+    def call(self, fn, tokens=1):
+        """Run fn() with rate limiting, retries and the circuit breaker"""
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            allowed = self._before_attempt()
+            self._acquire(tokens, allowed)
+            try:
+                result = fn()
+            except Exception as e:
+                failure = self._after_failure(e, attempt)
+                if failure is not None:
+                    raise failure from e
+                self.sleep(self.retry_policy.delay(attempt))
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def acall(self, fn, tokens=1):
+        """Async variant of call(); fn is a coroutine function"""
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            allowed = self._before_attempt()
+            await self._aacquire(tokens, allowed)
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                # e.g. the losing leg of a hedged call (chat.routing)
+                self.breaker.release(allowed)
+                raise
+            except Exception as e:
+                failure = self._after_failure(e, attempt)
+                if failure is not None:
+                    raise failure from e
+                await self.async_sleep(self.retry_policy.delay(attempt))
+            else:
+                self.breaker.record_success()
+                return result
+
+    def stream(self, fn, tokens=1):
+        """Yield from fn(); retries only until the first chunk was delivered"""
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            allowed = self._before_attempt()
+            self._acquire(tokens, allowed)
+            delivered = False
+            try:
+                for chunk in fn():
+                    delivered = True
+                    yield chunk
+            except Exception as e:
+                failure = self._after_failure(e, attempt)
+                if delivered and failure is None:
+                    failure = UpstreamError(classify(e), str(e))
+                if failure is not None:
+                    raise failure from e
+                self.sleep(self.retry_policy.delay(attempt))
+            else:
+                self.breaker.record_success()
+                return
+
+
+_guards = {}
+_guard_lock = threading.Lock()
+
+
+def get_upstream_guard(name='default'):
+    """Process-wide guard configured by CHAT_UPSTREAM
+
+    Each name (one per model route, see chat.routing) gets its own quota
+    buckets and circuit breaker, so one failing model does not trip the
+    others.
+    """
+    guard = _guards.get(name)
+    if guard is None:
+        with _guard_lock:
+            guard = _guards.get(name)
+            if guard is None:
+                config = settings.CHAT_UPSTREAM
+                guard = _guards[name] = UpstreamGuard(
+                    RateLimiter(
+                        config['REQUESTS_PER_MINUTE'],
+                        config['TOKENS_PER_MINUTE'],
+                        max_wait=config['MAX_WAIT'],
+                        name=name,
+                    ),
+                    RetryPolicy(config['MAX_ATTEMPTS'], config['BASE_DELAY'], config['MAX_DELAY']),
+                    CircuitBreaker(config['FAILURE_THRESHOLD'], config['RECOVERY_TIMEOUT']),
+                )
+    return guard
+
+
+def reset_upstream_guard():
+    """Drop the process-wide guards (tests, settings changes)"""
+    with _guard_lock:
+        _guards.clear()
@@ -0,0 +1,164 @@
+"""Content-addressed response cache with in-flight request coalescing
+
+Sits in front of the upstream model call. Identical prompts (same final
+prompt text and model) that arrive while a call is in flight wait for that
+call instead of issuing their own, and results can optionally be kept for a
+short TTL. Upstream errors are shared with waiting callers but never cached.
+Hits, misses and coalesced calls are also counted in chat.metrics.
+"""
+from collections import OrderedDict
+import asyncio
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import RESPONSE_CACHE_COALESCED, RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES
+
+
+def response_key(prompt, model):
+    return hashlib.sha256(f"{model}\0{prompt}".encode()).hexdigest()
+
+
+class _InFlight:
+    """One upstream call that other threads can wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ResponseCache:
+    """Coalesces concurrent identical calls and caches results for ttl seconds"""
+
+    def __init__(self, ttl=0, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._async_inflight = {}
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+
+    def _cached(self, key):
+        """Fresh cached reply or None; caller holds the lock"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_call(self, prompt, model, call):
+        """Return a cached/in-flight reply for (prompt, model) or run call()"""
+        key = response_key(prompt, model)
+        with self._lock:
+            self.requests += 1
+            cached = self._cached(key)
+            if cached is not None:
+                self.hits += 1
+                RESPONSE_CACHE_HITS.inc()
+                return cached
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _InFlight()
+                self.upstream_calls += 1
+                RESPONSE_CACHE_MISSES.inc()
+            else:
+                self.coalesced += 1
+                RESPONSE_CACHE_COALESCED.inc()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = call()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            self._store(key, flight.result)
+            return flight.result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    async def aget_or_call(self, prompt, model, call):
+        """Async variant of get_or_call; call is a coroutine function"""
+        key = response_key(prompt, model)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self.requests += 1
+            cached = self._cached(key)
+            if cached is not None:
+                self.hits += 1
+                RESPONSE_CACHE_HITS.inc()
+                return cached
+            task = self._async_inflight.get(key)
+            if task is not None and task.get_loop() is loop:
+                self.coalesced += 1
+                RESPONSE_CACHE_COALESCED.inc()
+            else:
+                task = self._async_inflight[key] = loop.create_task(call())
+                task.add_done_callback(lambda done: self._finish_async(key, done))
+                self.upstream_calls += 1
+                RESPONSE_CACHE_MISSES.inc()
+
+        # Shield so one cancelled caller does not cancel the shared call
+        return await asyncio.shield(task)
+
+    def _finish_async(self, key, task):
+        with self._lock:
+            if self._async_inflight.get(key) is task:
+                del self._async_inflight[key]
+        if not task.cancelled() and task.exception() is None:
+            self._store(key, task.result())
+
+    def stats(self):
+        saved = self.hits + self.coalesced
+        return {
+            "requests": self.requests,
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "upstream_calls": self.upstream_calls,
+            "upstream_calls_saved": saved,
+            "hit_rate": saved / self.requests if self.requests else 0.0,
+        }
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the process-wide response cache configured by CHAT_RESPONSE_CACHE"""
+    global _response_cache
+
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                config = settings.CHAT_RESPONSE_CACHE
+                _response_cache = ResponseCache(ttl=config['TTL'], max_entries=config['MAX_ENTRIES'])
+    return _response_cache
@@ -0,0 +1,393 @@
+"""Model routing, failover and hedged requests
+
+A Route is a named (provider, model) pair with a price. The Router picks
+one per turn from CHAT_MODEL_ROUTING['POLICY'] (short, simple turns to the
+fast model, long or complex ones to the strong one), fails over along the
+route's FALLBACKS when a call raises UpstreamError, and can hedge: if the
+primary has not answered within its recent latency percentile, the first
+fallback is called too and whichever finishes first wins.
+
+Every route has its own UpstreamGuard (quota, retries, circuit breaker).
+Latency, outcome and estimated cost are kept per route in RouteStats and
+exported through chat.metrics. With routing disabled the router has a
+single route for GeminiService.model_name and behaves like a plain call.
+"""
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+import asyncio
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import ROUTE_CALLS, ROUTE_COST, ROUTE_LATENCY
+from .resilience import UpstreamError, get_upstream_guard
+
+
+class GenAIProvider:
+    """Provider backed by a google-genai style client
+
+    Without an explicit client the process-wide shared client is used, so
+    GEMINI_BACKEND=fake and set_shared_client() keep working.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is not None:
+            return self._client
+        from .gemini_service import get_shared_client
+        return get_shared_client()
+
+    def generate(self, model, prompt):
+        return self.client.models.generate_content(model=model, contents=prompt).text
+
+    async def agenerate(self, model, prompt):
+        response = await self.client.aio.models.generate_content(model=model, contents=prompt)
+        return response.text
+
+    def stream(self, model, prompt):
+        for chunk in self.client.models.generate_content_stream(model=model, contents=prompt):
+            if chunk.text:
+                yield chunk.text
+
+
+class Route:
+    """A model behind a provider, with its price per 1k tokens (USD)"""
+
+    def __init__(self, name, provider, model, cost_per_1k_input=0.0, cost_per_1k_output=0.0):
+        self.name = name
+        self.provider = provider
+        self.model = model
+        self.cost_per_1k_input = cost_per_1k_input
+        self.cost_per_1k_output = cost_per_1k_output
+
+    def cost(self, input_tokens, output_tokens):
+        return (input_tokens * self.cost_per_1k_input + output_tokens * self.cost_per_1k_output) / 1000
+
+    def __repr__(self):
+        return f"Route({self.name!r}, {self.model!r})"
+
+
+class RouteStats:
+    """Recent latencies and running totals for one route"""
+
+    def __init__(self, window=200):
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.failures = 0
+        self.hedges = 0
+        self.cost = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, route, latency, ok, cost=0.0):
+        with self._lock:
+            self.calls += 1
+            if ok:
+                self.latencies.append(latency)
+                self.cost += cost
+            else:
+                self.failures += 1
+        if settings.CHAT_METRICS['ENABLED']:
+            ROUTE_CALLS.inc(route=route, outcome='ok' if ok else 'error')
+            if ok:
+                ROUTE_LATENCY.observe(latency, route=route)
+                ROUTE_COST.inc(cost, route=route)
+
+    def record_hedge(self, route):
+        with self._lock:
+            self.hedges += 1
+        if settings.CHAT_METRICS['ENABLED']:
+            ROUTE_CALLS.inc(route=route, outcome='hedged')
+
+    def percentile(self, pct, min_samples=1):
+        """Latency percentile, or None with fewer than min_samples samples"""
+        with self._lock:
+            samples = sorted(self.latencies)
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[max(0, min(len(samples) - 1, round(pct / 100 * len(samples)) - 1))]
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'hedges': self.hedges,
+            'cost_usd': round(self.cost, 6),
+            'p50_ms': (self.percentile(50) or 0) * 1000,
+            'p95_ms': (self.percentile(95) or 0) * 1000,
+        }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def route_stats(name):
+    """Process-wide RouteStats for a route name"""
+    stats = _stats.get(name)
+    if stats is None:
+        with _stats_lock:
+            stats = _stats.setdefault(name, RouteStats())
+    return stats
+
+
+def reset_route_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class HedgePool:
+    """Threads for hedged sync calls that never queue a call
+
+    A call only goes to the pool while a thread is free for it, so its hedge
+    delay is not spent waiting behind other calls; a losing call still runs
+    to completion.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="model-hedge")
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_submit(self, fn, *args):
+        """Future of fn(*args), or None when every thread is busy"""
+        with self._lock:
+            if self._in_flight >= self.max_workers:
+                return None
+            self._in_flight += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+def get_hedge_pool():
+    """Process-wide HedgePool sized by CHAT_MODEL_ROUTING's HEDGE MAX_WORKERS"""
+    global _hedge_pool
+    if _hedge_pool is None:
+        with _hedge_pool_lock:
+            if _hedge_pool is None:
+                hedge = settings.CHAT_MODEL_ROUTING['POLICY'].get('HEDGE') or {}
+                _hedge_pool = HedgePool(hedge.get('MAX_WORKERS', 64))
+    return _hedge_pool
+
+
+class Router:
+    """Select, fail over and hedge between routes
+
+    policy keys: DEFAULT (route name), LONG_ROUTE and LONG_PROMPT_TOKENS,
+    COMPLEX_ROUTE and COMPLEX_PATTERN (regex on the user's message),
+    FALLBACKS ({route: [route, ...]}) and HEDGE ({ENABLED, PERCENTILE,
+    MIN_SAMPLES}).
+    """
+
+    def __init__(self, routes, policy, guard=None):
+        self.routes = {route.name: route for route in routes}
+        self.policy = policy
+        self._guard = guard
+        pattern = policy.get('COMPLEX_PATTERN')
+        self.complex_pattern = re.compile(pattern, re.I) if pattern else None
+
+    def guard(self, route):
+        return self._guard or get_upstream_guard(route.name)
+
+    def select(self, prompt_tokens, user_message=None):
+        """Route for a turn from its prompt size and the user's message"""
+        policy = self.policy
+        if policy.get('LONG_ROUTE') and prompt_tokens >= policy.get('LONG_PROMPT_TOKENS', float('inf')):
+            return self.routes[policy['LONG_ROUTE']]
+        if user_message and self.complex_pattern and self.complex_pattern.search(user_message):
+            return self.routes[policy['COMPLEX_ROUTE']]
+        return self.routes[policy['DEFAULT']]
+
+    def chain(self, route):
+        """The route followed by its fallbacks"""
+        fallbacks = self.policy.get('FALLBACKS', {}).get(route.name, [])
+        return [route] + [self.routes[name] for name in fallbacks if name != route.name]
+
+    def hedge_delay(self, route):
+        hedge = self.policy.get('HEDGE') or {}
+        if not hedge.get('ENABLED'):
+            return None
+        return route_stats(route.name).percentile(hedge.get('PERCENTILE', 95), hedge.get('MIN_SAMPLES', 20))
+
+    def _record(self, route, started, tokens, reply=None):
+        from .gemini_service import estimate_tokens
+
+        ok = reply is not None
+        cost = route.cost(tokens, estimate_tokens(reply)) if ok else 0.0
+        route_stats(route.name).record(route.name, time.perf_counter() - started, ok, cost)
+
+    def call(self, route, prompt, tokens):
+        """One guarded call to a single route"""
+        started = time.perf_counter()
+        try:
+            reply = self.guard(route).call(lambda: route.provider.generate(route.model, prompt), tokens=tokens)
+        except UpstreamError:
+            self._record(route, started, tokens)
+            raise
+        self._record(route, started, tokens, reply)
+        return reply
+
+    async def acall(self, route, prompt, tokens):
+        started = time.perf_counter()
+        try:
+            reply = await self.guard(route).acall(lambda: route.provider.agenerate(route.model, prompt), tokens=tokens)
+        except UpstreamError:
+            self._record(route, started, tokens)
+            raise
+        self._record(route, started, tokens, reply)
+        return reply
+
+    def generate(self, prompt, route, tokens):
+        """Reply from route, hedged and failing over along its chain"""
+        chain = self.chain(route)
+        error = None
+        index = 0
+        while index < len(chain):
+            primary = chain[index]
+            backup = chain[index + 1] if index + 1 < len(chain) else None
+            delay = self.hedge_delay(primary) if backup is not None else None
+            try:
+                if delay is None:
+                    return self.call(primary, prompt, tokens)
+                return self._hedged(primary, backup, prompt, tokens, delay)
+            except _HedgeFailed as e:
+                error = e.error
+                index += 2
+            except UpstreamError as e:
+                error = e
+                index += 1
+        raise error
+
+    def _hedged(self, primary, backup, prompt, tokens, delay):
+        pool = get_hedge_pool()
+        first = pool.try_submit(self.call, primary, prompt, tokens)
+        if first is None:
+            # Saturated: an unhedged call beats queueing for a thread
+            return self.call(primary, prompt, tokens)
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeout:
+            pass
+
+        second = pool.try_submit(self.call, backup, prompt, tokens)
+        if second is None:
+            return first.result()
+        route_stats(primary.name).record_hedge(primary.name)
+        pending = {first, second}
+        errors = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                errors.append(future.exception())
+        raise _HedgeFailed(errors[0])
+
+    async def agenerate(self, prompt, route, tokens):
+        """Async variant of generate(); the losing hedge is cancelled"""
+        chain = self.chain(route)
+        error = None
+        index = 0
+        while index < len(chain):
+            primary = chain[index]
+            backup = chain[index + 1] if index + 1 < len(chain) else None
+            delay = self.hedge_delay(primary) if backup is not None else None
+            try:
+                if delay is None:
+                    return await self.acall(primary, prompt, tokens)
+                return await self._ahedged(primary, backup, prompt, tokens, delay)
+            except _HedgeFailed as e:
+                error = e.error
+                index += 2
+            except UpstreamError as e:
+                error = e
+                index += 1
+        raise error
+
+    async def _ahedged(self, primary, backup, prompt, tokens, delay):
+        first = asyncio.ensure_future(self.acall(primary, prompt, tokens))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        route_stats(primary.name).record_hedge(primary.name)
+        pending = {first, asyncio.ensure_future(self.acall(backup, prompt, tokens))}
+        errors = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(task.exception())
+        finally:
+            for task in pending:
+                task.cancel()
+        raise _HedgeFailed(errors[0])
+
+    def stream(self, prompt, route, tokens):
+        """Stream from route; fails over only before the first chunk"""
+        chain = self.chain(route)
+        for index, candidate in enumerate(chain):
+            delivered = False
+            try:
+                for chunk in self.guard(candidate).stream(
+                    lambda: candidate.provider.stream(candidate.model, prompt), tokens=tokens
+                ):
+                    delivered = True
+                    yield chunk
+                return
+            except UpstreamError:
+                if delivered or index == len(chain) - 1:
+                    raise
+
+    def stats(self):
+        return {name: route_stats(name).as_dict() for name in self.routes}
+
+
+class _HedgeFailed(Exception):
+    """Both legs of a hedged call failed"""
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+def build_router(default_model, client=None, guard=None):
+    """Router from CHAT_MODEL_ROUTING; a single default_model route when disabled
+
+    An explicit client (tests, benchmarks) backs every route.
+    """
+    config = settings.CHAT_MODEL_ROUTING
+    if not config['ENABLED']:
+        return Router([Route('default', GenAIProvider(client), default_model)], {'DEFAULT': 'default'}, guard)
+
+    providers = {}
+    routes = []
+    for name, route in config['ROUTES'].items():
+        provider_name = route.get('PROVIDER', 'gemini')
+        if provider_name not in providers:
+            providers[provider_name] = (
+                GenAIProvider(client) if client is not None
+                else import_string(config['PROVIDERS'][provider_name])()
+            )
+        routes.append(Route(
+            name, providers[provider_name], route['MODEL'],
+            route.get('COST_PER_1K_INPUT', 0.0), route.get('COST_PER_1K_OUTPUT', 0.0),
+        ))
+    return Router(routes, config['POLICY'], guard)
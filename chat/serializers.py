@@ -1,12 +1,23 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import Persona, Message, Memory
+from .api import issue_token
+from .models import ChatJob, Persona, Message, Memory
 
 
 class UserSerializer(serializers.ModelSerializer):
+    # Bearer token for the API (see chat/api.py)
+    token = serializers.SerializerMethodField()
+
     class Meta:
         model = User
-        fields = ['id', 'username']
+        fields = ['id', 'username', 'token']
+
+    def get_token(self, user):
+        return issue_token(user.pk)
+
+
+class BulkProvisionSerializer(serializers.Serializer):
+    count = serializers.IntegerField(min_value=1, max_value=10000)
 
 
 class PersonaSerializer(serializers.ModelSerializer):
@@ -39,6 +50,8 @@ class MessageSerializer(serializers.ModelSerializer):
 class ChatRequestSerializer(serializers.Serializer):
     user_id = serializers.IntegerField()
     message = serializers.CharField()
+    # 'queued' hands the turn to the background job queue
+    mode = serializers.ChoiceField(choices=['sync', 'queued'], default='sync')
 
 
 class ChatResponseSerializer(serializers.Serializer):
@@ -50,3 +63,12 @@ class MemorySerializer(serializers.ModelSerializer):
         model = Memory
         fields = ['id', 'user', 'key', 'value', 'created_at']
         read_only_fields = ['id', 'created_at']
+
+
+class ChatJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.IntegerField(source='id', read_only=True)
+
+    class Meta:
+        model = ChatJob
+        fields = ['job_id', 'status', 'reply', 'error', 'attempts', 'created_at', 'finished_at']
+        read_only_fields = fields
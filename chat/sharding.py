@@ -0,0 +1,500 @@
+"""User-sharded storage for per-user chat rows
+
+With CHAT_SHARDING['ALIASES'] set (DATABASE_SHARD_URLS), the rows of the
+models in CHAT_SHARDING['MODELS'] (persona, messages, archive, memories,
+summary and extraction state) live on one database alias per user.
+chat.db_routers.ShardRouter sends their queries there:
+
+- instance-bound queries (user.persona, message.save(), related managers)
+  follow the instance;
+- everything else runs inside use_shard(user_id), which pins the sharded
+  models, and reads of User, to that user's shard for the enclosed code.
+  A sharded query with neither raises ShardNotSelected rather than reading
+  the wrong database.
+
+Where a user lives is recorded in ShardAssignment on default. The row is
+written when the user is created, placed by a rendezvous hash of the user id
+over ALIASES, so adding a shard only re-places about 1/N of the users.
+Users without a row live on default, which is where their rows were before
+sharding was enabled. Each shard keeps a copy of its users' auth_user row
+(id and username only) so foreign keys and the user/persona join work there.
+
+`manage.py rebalance_shards` moves users whose shard differs from their
+placement (or to an explicit alias) while they keep chatting: copy, flip the
+assignment, wait MOVE_SETTLE seconds for cached lookups, running turns and
+write-behind batches to drain, catch up on what was written to the source
+meanwhile, then delete the source rows. Copied messages keep their ids, so
+cursors and WebSocket resume points stay valid: each shard hands out
+Message ids from its own block of ID_BLOCK (reserve_id_block, run after
+migrate and by `manage.py release`). A message whose id is taken on the
+target anyway (rows from before the blocks; SQLite and MySQL also move a
+shard's counter past ids inserted into it) gets a new one, and the summary
+and extraction watermarks follow it.
+"""
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+
+from .prompt_cache import invalidate_prompt_prefix
+
+
+logger = logging.getLogger(__name__)
+
+
+_pinned = ContextVar('chat_shard', default=None)
+_NOT_PINNED = nullcontext()
+
+
+class ShardNotSelected(RuntimeError):
+    """A sharded model was queried outside use_shard() and without an instance"""
+
+
+def sharding_enabled():
+    return bool(settings.CHAT_SHARDING['ALIASES'])
+
+
+def model_label(model):
+    """'app_label.model_name', also for the database cache's stand-in model
+    (its _meta has no label_lower)"""
+    return f"{model._meta.app_label}.{model._meta.model_name}"
+
+
+def is_sharded(model):
+    return model_label(model) in settings.CHAT_SHARDING['MODELS']
+
+
+def placement(user_id, aliases=None):
+    """The alias a user belongs on: highest rendezvous hash over aliases"""
+    aliases = aliases or settings.CHAT_SHARDING['ALIASES']
+    return max(
+        aliases,
+        key=lambda alias: hashlib.blake2b(f"{alias}:{user_id}".encode(), digest_size=8).digest(),
+    )
+
+
+def _cache_key(user_id):
+    return f"chat:shard:{user_id}"
+
+
+def shard_for(user_id):
+    """The alias holding the user's rows, or None when sharding is off"""
+    if not sharding_enabled():
+        return None
+    alias = cache.get(_cache_key(user_id))
+    if alias is None:
+        from .models import ShardAssignment
+
+        alias = (
+            ShardAssignment.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id)
+            .values_list('alias', flat=True).first()
+        ) or DEFAULT_DB_ALIAS
+        cache.set(_cache_key(user_id), alias, settings.CHAT_SHARDING['ASSIGNMENT_TTL'])
+    return alias
+
+
+async def ashard_for(user_id):
+    """Async variant of shard_for"""
+    if not sharding_enabled():
+        return None
+    alias = await cache.aget(_cache_key(user_id))
+    if alias is None:
+        from .models import ShardAssignment
+
+        alias = await (
+            ShardAssignment.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id)
+            .values_list('alias', flat=True).afirst()
+        ) or DEFAULT_DB_ALIAS
+        await cache.aset(_cache_key(user_id), alias, settings.CHAT_SHARDING['ASSIGNMENT_TTL'])
+    return alias
+
+
+def pinned_shard():
+    return _pinned.get()
+
+
+@contextmanager
+def _pin(alias):
+    token = _pinned.set(alias)
+    try:
+        yield alias
+    finally:
+        _pinned.reset(token)
+
+
+def use_shard(user_id):
+    """Route sharded queries in the enclosed code to the user's shard
+
+        with use_shard(user.id):
+            Message.objects.filter(user=user).count()
+
+    A no-op without sharding. Do not hold it across a generator's yields.
+    """
+    if not sharding_enabled():
+        return _NOT_PINNED
+    return _pin(shard_for(user_id))
+
+
+@asynccontextmanager
+async def ause_shard(user_id):
+    """Async variant of use_shard (async with); pins the current task only"""
+    if not sharding_enabled():
+        yield None
+        return
+    with _pin(await ashard_for(user_id)) as alias:
+        yield alias
+
+
+def all_shards():
+    """Every alias that can hold sharded rows ([None] without sharding)"""
+    if not sharding_enabled():
+        return [None]
+    return list(dict.fromkeys([DEFAULT_DB_ALIAS, *settings.CHAT_SHARDING['ALIASES']]))
+
+
+def id_block_start(alias):
+    """First Message id the alias hands out: default counts from 1, the Nth
+    shard from N * ID_BLOCK (0 when the alias is not a shard)"""
+    aliases = all_shards()
+    return aliases.index(alias) * settings.CHAT_SHARDING['ID_BLOCK'] if alias in aliases else 0
+
+
+def reserve_id_block(alias):
+    """Move the alias's Message id counter up to its block; idempotent"""
+    from .models import Message
+
+    start = id_block_start(alias)
+    if not start:
+        return
+    connection = connections[alias]
+    table = Message._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(f"SELECT last_value FROM {sequence}")
+            if cursor.fetchone()[0] < start:
+                cursor.execute("SELECT setval(%s, %s, false)", [sequence, start])
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, start - 1])
+            elif row[0] < start - 1:
+                cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [start - 1, table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                "SELECT AUTO_INCREMENT FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                [table],
+            )
+            if (cursor.fetchone()[0] or 0) < start:
+                cursor.execute(f"ALTER TABLE {connection.ops.quote_name(table)} AUTO_INCREMENT = {int(start)}")
+
+
+def by_shard(objects):
+    """Group unsaved objects (with a user_id) by their user's shard"""
+    groups = {}
+    for obj in objects:
+        groups.setdefault(shard_for(obj.user_id), []).append(obj)
+    return groups
+
+
+def _mirror(users, alias):
+    """Copy users' id and username onto a shard (never authenticated against)"""
+    from django.contrib.auth.models import User
+
+    if alias != DEFAULT_DB_ALIAS:
+        User.objects.using(alias).bulk_create(
+            [User(id=user.pk, username=user.username, password=make_password(None)) for user in users],
+            ignore_conflicts=True,
+        )
+
+
+def place_users(users):
+    """Assign newly created users to their shard and mirror them there"""
+    from .models import ShardAssignment
+
+    if not sharding_enabled() or not users:
+        return
+    groups = {}
+    for user in users:
+        groups.setdefault(placement(user.pk), []).append(user)
+    for alias, group in groups.items():
+        _mirror(group, alias)
+    ShardAssignment.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+        [ShardAssignment(user_id=user.pk, alias=alias) for alias, group in groups.items() for user in group],
+        ignore_conflicts=True,
+    )
+    for alias, group in groups.items():
+        cache.set_many({_cache_key(user.pk): alias for user in group}, settings.CHAT_SHARDING['ASSIGNMENT_TTL'])
+
+
+def delete_user_rows(user_id, alias):
+    """Delete a user's sharded rows (and their mirror) on one alias"""
+    from django.apps import apps
+    from django.contrib.auth.models import User
+
+    with transaction.atomic(using=alias):
+        for model in apps.get_models():
+            if is_sharded(model):
+                model.objects.using(alias).filter(user_id=user_id).delete()
+        if alias != DEFAULT_DB_ALIAS:
+            User.objects.using(alias).filter(id=user_id).delete()
+
+
+def misplaced_users(aliases=None):
+    """(user_id, current alias) of users living off their placement"""
+    from django.contrib.auth.models import User
+    from .models import ShardAssignment
+
+    aliases = aliases or settings.CHAT_SHARDING['ALIASES']
+    assignments = ShardAssignment.objects.using(DEFAULT_DB_ALIAS).order_by('user_id').values_list('user_id', 'alias')
+    for user_id, alias in assignments.iterator():
+        if alias != placement(user_id, aliases):
+            yield user_id, alias
+    if DEFAULT_DB_ALIAS not in aliases:
+        # Created before sharding was enabled: everything is still on default
+        legacy = User.objects.using(DEFAULT_DB_ALIAS).filter(shard_assignment__isnull=True).order_by('id')
+        for user_id in legacy.values_list('id', flat=True).iterator():
+            yield user_id, DEFAULT_DB_ALIAS
+
+
+class UserMove:
+    """Copies one user's sharded rows from source to target"""
+
+    def __init__(self, user_id, source, target, batch_size=1000):
+        self.user_id = user_id
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        # Newest message copied by the first pass, as a source (created_at, id) key
+        self.copied_until = None
+        # Highest source message id copied; later passes copy every id above
+        # it, including write-behind rows flushed with an older created_at
+        self.max_id = 0
+        # Source message id -> target id, for messages whose id was taken
+        self.new_ids = {}
+        # Source and target versions of what was last copied, to tell
+        # changes made on the source from those made on the live target
+        self._persona = (None, None)
+        self._memories = {}
+        self.first_pass_done = False
+
+    def copy(self):
+        """Copy everything on the first call, then what changed on the source
+
+        Once the assignment flips, the target is live and may be newer than
+        the source. Later passes copy new messages and archive blocks, apply
+        persona and memory changes made on the source unless the target's
+        copy changed too, and keep whichever summary and extraction
+        watermark is further along. Returns the number of messages copied.
+        """
+        first_pass = not self.first_pass_done
+        copied = self._copy_messages()
+        changed = self._copy_archive()
+        changed |= self._copy_persona()
+        changed |= self._copy_memories()
+        changed |= self._copy_watermarks()
+        self.first_pass_done = True
+        if changed and not first_pass:
+            # Bulk copies send no signals; the live prompt prefix is stale
+            invalidate_prompt_prefix(self.user_id)
+        return copied
+
+    def _copy_messages(self):
+        from .models import Message
+
+        messages = Message.objects.using(self.source).filter(user_id=self.user_id)
+        copied = 0
+        while True:
+            if self.first_pass_done:
+                batch = list(messages.filter(id__gt=self.max_id).order_by('id')[:self.batch_size])
+            else:
+                # The (user, created_at) index keeps a big history cheap to walk
+                page = messages
+                if self.copied_until is not None:
+                    created_at, pk = self.copied_until
+                    page = page.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+                batch = list(page.order_by('created_at', 'id')[:self.batch_size])
+            if not batch:
+                return copied
+            if not self.first_pass_done:
+                self.copied_until = (batch[-1].created_at, batch[-1].pk)
+            self._insert_messages(batch)
+            copied += len(batch)
+
+    def _insert_messages(self, batch):
+        from .models import Message
+
+        old_ids = [message.pk for message in batch]
+        self.max_id = max(self.max_id, *old_ids)
+        taken = set(Message.objects.using(self.target).filter(id__in=old_ids).values_list('id', flat=True))
+        for message in batch:
+            if message.pk in taken:
+                message.pk = None
+        Message.objects.using(self.target).bulk_create(batch)
+        if taken:
+            logger.warning(
+                "Moving user %s to %s renumbered %s messages whose id was taken there",
+                self.user_id, self.target, len(taken),
+            )
+            for old_id, message in zip(old_ids, batch):
+                # pk stays None on backends that cannot return ids; the
+                # watermark then keeps its created_at, which is what orders it
+                if old_id in taken and message.pk is not None:
+                    self.new_ids[old_id] = message.pk
+
+    def _copy_archive(self):
+        """Copy blocks the target lacks, dropping its live copies of their messages"""
+        from .models import Message, MessageArchive
+
+        present = set(
+            MessageArchive.objects.using(self.target).filter(user_id=self.user_id)
+            .values_list('last_created_at', 'last_id')
+        )
+        # Archive blocks are immutable; new ones are made from old messages
+        blocks = [
+            block for block in MessageArchive.objects.using(self.source).filter(user_id=self.user_id)
+            if (block.last_created_at, block.last_id) not in present
+        ]
+        if not blocks:
+            return False
+        with transaction.atomic(using=self.target):
+            for block in blocks:
+                Message.objects.using(self.target).filter(user_id=self.user_id).filter(
+                    Q(created_at__gt=block.first_created_at) | Q(created_at=block.first_created_at, id__gte=block.first_id),
+                    Q(created_at__lt=block.last_created_at) | Q(created_at=block.last_created_at, id__lte=block.last_id),
+                ).delete()
+                block.pk = None
+            MessageArchive.objects.using(self.target).bulk_create(blocks)
+        return True
+
+    def _copy_persona(self):
+        from .models import Persona
+
+        persona = Persona.objects.using(self.source).filter(user_id=self.user_id).first()
+        version = persona.updated_at if persona is not None else None
+        if self.first_pass_done:
+            current = Persona.objects.using(self.target).filter(user_id=self.user_id).first()
+            if version == self._persona[0]:
+                return False
+            if (current.updated_at if current is not None else None) != self._persona[1]:
+                # Changed on the live target too, which is newer
+                return False
+        with transaction.atomic(using=self.target):
+            Persona.objects.using(self.target).filter(user_id=self.user_id).delete()
+            if persona is not None:
+                persona.pk = None
+                persona.save(using=self.target)
+        self._persona = (version, persona.updated_at if persona is not None else None)
+        return True
+
+    def _copy_memories(self):
+        from .models import Memory
+
+        memories = dict(
+            Memory.objects.using(self.source).filter(user_id=self.user_id).values_list('key', 'value')
+        )
+        current = dict(
+            Memory.objects.using(self.target).filter(user_id=self.user_id).values_list('key', 'value')
+        )
+        # Before the flip the target is not live and simply follows the source
+        base = self._memories if self.first_pass_done else current
+        upserts = [
+            Memory(user_id=self.user_id, key=key, value=value) for key, value in memories.items()
+            if base.get(key) != value and current.get(key) == base.get(key)
+        ]
+        removed = [key for key in base if key not in memories and current.get(key) == base[key]]
+        self._memories = memories
+        if not upserts and not removed:
+            return False
+        with transaction.atomic(using=self.target):
+            Memory.objects.using(self.target).filter(user_id=self.user_id, key__in=removed).delete()
+            Memory.objects.using(self.target).bulk_create(
+                upserts, update_conflicts=True, unique_fields=['user', 'key'], update_fields=['value'],
+            )
+        return True
+
+    def _copy_watermarks(self):
+        from .models import ConversationSummary, MemoryExtractionState
+
+        changed = False
+        for model, created_field, id_field in (
+            (ConversationSummary, 'covered_until', 'covered_until_id'),
+            (MemoryExtractionState, 'extracted_until', 'extracted_until_id'),
+        ):
+            row = model.objects.using(self.source).filter(user_id=self.user_id).first()
+            if row is None:
+                continue
+            watermark = getattr(row, id_field)
+            if watermark is not None:
+                # Only messages whose id was taken on the target were renumbered
+                setattr(row, id_field, self.new_ids.get(watermark, watermark))
+            if self.first_pass_done:
+                current = model.objects.using(self.target).filter(user_id=self.user_id).first()
+                if current is not None and not _further(row, current, created_field, id_field):
+                    continue
+            with transaction.atomic(using=self.target):
+                model.objects.using(self.target).filter(user_id=self.user_id).delete()
+                row.pk = None
+                row.save(using=self.target)
+            changed = True
+        return changed
+
+    def run(self, settle=None):
+        """Move the user; returns the number of messages moved"""
+        from django.contrib.auth.models import User
+        from .models import ShardAssignment
+
+        settle = settings.CHAT_SHARDING['MOVE_SETTLE'] if settle is None else settle
+        _flush_write_buffer()
+        _mirror(User.objects.using(DEFAULT_DB_ALIAS).filter(id=self.user_id), self.target)
+        copied = self.copy()
+
+        ShardAssignment.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+            user_id=self.user_id, defaults={'alias': self.target}
+        )
+        cache.set(_cache_key(self.user_id), self.target, settings.CHAT_SHARDING['ASSIGNMENT_TTL'])
+        # Other workers may still route here from a cached lookup, a turn in
+        # flight or a write-behind batch
+        if settle:
+            time.sleep(settle)
+        _flush_write_buffer()
+        copied += self.copy()
+
+        delete_user_rows(self.user_id, self.source)
+        return copied
+
+
+def _further(row, other, created_field, id_field):
+    """Whether row's (created_at, id) watermark is past other's"""
+    created_at, other_created_at = getattr(row, created_field), getattr(other, created_field)
+    if created_at is None:
+        return False
+    if other_created_at is None:
+        return True
+    return (created_at, getattr(row, id_field) or 0) > (other_created_at, getattr(other, id_field) or 0)
+
+
+def _flush_write_buffer():
+    """Write this process's buffered messages, which may belong to the user"""
+    from .write_buffer import get_write_buffer
+
+    buffer = get_write_buffer()
+    if buffer is not None:
+        buffer.flush()
+
+
+def move_user(user_id, target, settle=None, batch_size=1000):
+    """Move a user's rows to the target alias; returns the messages moved"""
+    source = shard_for(user_id)
+    if source == target:
+        return 0
+    return UserMove(user_id, source, target, batch_size).run(settle)
@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
+from django.dispatch import receiver
+
+from .memory_index import get_memory_index
+from .metrics import count_query
+from .models import ConversationSummary, Persona, Memory
+from .prompt_cache import invalidate_prompt_prefix
+from .sharding import delete_user_rows, place_users, reserve_id_block, shard_for, sharding_enabled
+
+
+@receiver([post_save, post_delete], sender=Persona)
+@receiver([post_save, post_delete], sender=Memory)
+@receiver([post_save, post_delete], sender=ConversationSummary)
+def invalidate_prompt_cache(sender, instance, **kwargs):
+    """Persona, memory or summary changed: recompile the user's prompt prefix next turn"""
+    invalidate_prompt_prefix(instance.user_id)
+
+
+@receiver(post_save, sender=Memory)
+def index_memory(sender, instance, **kwargs):
+    """Embed a new or edited memory into this process's retrieval index"""
+    if settings.CHAT_MEMORY_RETRIEVAL['ENABLED']:
+        get_memory_index().upsert(instance)
+
+
+@receiver(post_delete, sender=Memory)
+def unindex_memory(sender, instance, **kwargs):
+    if settings.CHAT_MEMORY_RETRIEVAL['ENABLED']:
+        get_memory_index().remove(instance)
+
+
+@receiver(post_save, sender=User)
+def place_new_user(sender, instance, created, raw=False, using=None, **kwargs):
+    """Put a new user on their shard (bulk-created users go through place_users)"""
+    if created and not raw and using == DEFAULT_DB_ALIAS and sharding_enabled():
+        place_users([instance])
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_rows(sender, instance, using=None, **kwargs):
+    """Deleting a user on default also deletes their rows on their shard"""
+    if using == DEFAULT_DB_ALIAS and sharding_enabled():
+        alias = shard_for(instance.pk)
+        if alias != DEFAULT_DB_ALIAS:
+            delete_user_rows(instance.pk, alias)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    """Charge every query to the current metrics Turn (no-op outside one)"""
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+@receiver(post_migrate)
+def reserve_message_ids(sender, using, **kwargs):
+    """Start a shard's Message ids at its own block, so moved messages keep theirs"""
+    if sender.name == 'chat' and sharding_enabled():
+        reserve_id_block(using)
@@ -1,3 +1,2249 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signals
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, close_old_connections, connection, connections, transaction
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from .api import FastJSONRenderer, issue_token
+from .archive import archive_messages
+from .benchmarks import SCENARIOS, bench_api, bench_overhead, diff_rows
+from .context import GeminiSummarizer, fold_history
+from .extraction import GeminiExtractor, RuleBasedExtractor, extract_memories
+from .fake_llm import FakeGenAIClient
+from .jobs import claim_next_job, run_job, work
+from .memory_index import HashedNgramEmbedder, MemoryIndex, get_memory_index
+from .metrics import (
+    REQUEST_DURATION, RESPONSE_CACHE_COALESCED, RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES, UPSTREAM_ERRORS, capture_turn,
+    clear_process_metrics, render_metrics, write_process_metrics,
+)
+from .gemini_service import (
+    GeminiService, adopt_shared_client, chat_users, estimate_tokens, get_shared_client, set_shared_client,
+)
+from .models import (
+    ChatJob, ConversationSummary, MemoryExtractionState, MessageArchive, Persona, Message, Memory, RateLimitBucket,
+    ShardAssignment,
+)
+from .pagination import encode_cursor
+from .provisioning import provision_user, provision_users
+from .recording import read_log, replay_plan, upstream_sampler
+from .prompt_cache import DjangoPromptCache, LRUPromptCache, get_prompt_cache
+from .resilience import (
+    CircuitBreaker, RateLimiter, RetryPolicy, TokenBucket, UpstreamError, UpstreamGuard, get_upstream_guard,
+)
+from .response_cache import ResponseCache
+from .routing import GenAIProvider, Route, Router, HedgePool, reset_route_stats, route_stats
+from .serializers import PersonaSerializer
+from .sharding import (
+    ShardNotSelected, UserMove, id_block_start, placement, reserve_id_block, shard_for, use_shard,
+)
+from .transfer import export_ndjson_gz, export_records, import_ndjson
+from .views import aiterate, sse_stream
+from .websocket import CLOSE_IDLE, CLOSE_NOT_FOUND, CLOSE_UNAUTHORIZED, ChatConnection, websocket_application
+from .write_buffer import MessageWriteBuffer
+
+
+class HistoryWindowTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="history_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        Message.objects.bulk_create(
+            Message(user=self.user, sender="user", message=f"message {i}") for i in range(30)
+        )
+        self.service = GeminiService()
+
+    def test_returns_newest_messages_oldest_first(self):
+        window = self.service.get_history_window(self.user, limit=5)
+        self.assertEqual(
+            [msg.message for msg in window],
+            [f"message {i}" for i in range(25, 30)],
+        )
+
+    def test_token_budget_trims_oldest_messages(self):
+        per_message = estimate_tokens("message 29")
+        window = self.service.get_history_window(self.user, limit=20, token_budget=per_message * 3)
+        self.assertEqual([msg.message for msg in window], ["message 27", "message 28", "message 29"])
+
+    def test_history_fetch_is_a_single_bounded_query(self):
+        with self.assertNumQueries(1):
+            self.service.get_history_window(self.user)
+
+    def test_prompt_includes_window_and_memory(self):
+        window = self.service.get_history_window(self.user, limit=2)
+        prompt = self.service.build_prompt(self.user.persona, window, [])
+        self.assertIn("User: message 29", prompt)
+        self.assertNotIn("message 27", prompt)
+        self.assertNotIn("Memory:", prompt)
+
+
+class StreamingChatTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="stream_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        self.fake = FakeGenAIClient(reply="Hi there, how was your day?", chunk_size=5, chunk_delay=0.02)
+        patcher = mock.patch("chat.views.GeminiService", lambda: GeminiService(client=self.fake))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_stream(self):
+        return self.client.post(
+            "/api/chat/stream/",
+            {"user_id": self.user.id, "message": "hello"},
+            content_type="application/json",
+        )
+
+    def test_first_chunk_arrives_before_completion(self):
+        start = time.perf_counter()
+        response = self.post_stream()
+        frames = iter(response.streaming_content)
+        first = next(frames).decode()
+        first_chunk_at = time.perf_counter() - start
+        rest = b"".join(frames).decode()
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(json.loads(first.split("data: ", 1)[1]), {"chunk": "Hi th"})
+        self.assertLess(first_chunk_at, self.fake.chunk_delay * (len(self.fake.chunks()) - 1))
+        self.assertIn("event: done", rest)
+
+    def test_turn_is_persisted_once_stream_ends(self):
+        b"".join(self.post_stream().streaming_content)
+        self.assertEqual(
+            list(Message.objects.filter(user=self.user).values_list("sender", "message")),
+            [("user", "hello"), ("ai", self.fake.reply)],
+        )
+
+    def test_client_disconnect_saves_delivered_text(self):
+        # The server closes the response iterator when the client goes away
+        stream = sse_stream(GeminiService(client=self.fake).stream_chat(self.user, "hello"))
+        next(stream)
+        stream.close()
+        self.assertEqual(
+            list(Message.objects.filter(user=self.user).values_list("sender", "message")),
+            [("user", "hello"), ("ai", "Hi th")],
+        )
+
+
+class AsgiStreamingTests(TransactionTestCase):
+    # Stream steps run on their own thread and connection: data must be committed
+    def setUp(self):
+        self.user = User.objects.create_user(username="asgi_stream_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        self.fake = FakeGenAIClient(reply="Hi there, how was your day?", chunk_size=5, chunk_delay=0.05)
+        patcher = mock.patch("chat.views.GeminiService", lambda: GeminiService(client=self.fake))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_frames_are_sent_as_they_arrive(self):
+        start = time.perf_counter()
+        response = await self.async_client.post(
+            "/api/chat/stream/", {"user_id": self.user.id, "message": "hello"}, content_type="application/json"
+        )
+        self.assertTrue(response.is_async)
+        frames = [(time.perf_counter() - start, frame) async for frame in response.streaming_content]
+
+        self.assertEqual(json.loads(frames[0][1].decode().split("data: ", 1)[1]), {"chunk": "Hi th"})
+        self.assertLess(frames[0][0], frames[-1][0] - self.fake.chunk_delay * 3)
+        self.assertIn(b"event: done", frames[-1][1])
+        saved = [(msg.sender, msg.message) async for msg in Message.objects.filter(user=self.user).order_by("id")]
+        self.assertEqual(saved, [("user", "hello"), ("ai", self.fake.reply)])
+
+    async def test_closing_the_stream_closes_the_iterator(self):
+        closed = []
+
+        def chunks():
+            try:
+                yield "a"
+                yield "b"
+            finally:
+                closed.append(True)
+
+        stream = aiterate(chunks())
+        self.assertEqual(await stream.__anext__(), "a")
+        await stream.aclose()
+        self.assertEqual(closed, [True])
+
+    async def test_export_streams_under_asgi(self):
+        staff = await User.objects.acreate(username="asgi_staff", is_staff=True)
+        response = await self.async_client.get(
+            "/api/admin/export/", {"user_id": self.user.id}, headers={"Authorization": f"Bearer {issue_token(staff.id)}"}
+        )
+        self.assertTrue(response.is_async)
+        data = b"".join([chunk async for chunk in response.streaming_content])
+        records = [json.loads(line) for line in gzip.decompress(data).splitlines()]
+        self.assertEqual([record["type"] for record in records], ["user", "persona"])
+
+
+class AsyncChatTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="async_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        self.fake = FakeGenAIClient(reply="Async hello!")
+        patcher = mock.patch("chat.views.GeminiService", lambda: GeminiService(client=self.fake))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_async_chat_replies_and_persists_turn(self):
+        response = await self.async_client.post(
+            "/api/chat/async/",
+            {"user_id": self.user.id, "message": "hello"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"reply": "Async hello!"})
+        saved = [
+            (msg.sender, msg.message)
+            async for msg in Message.objects.filter(user=self.user).order_by("id")
+        ]
+        self.assertEqual(saved, [("user", "hello"), ("ai", "Async hello!")])
+        self.assertIn("Name: Ava", self.fake.calls[0]["contents"])
+
+    async def test_async_chat_unknown_user(self):
+        response = await self.async_client.post(
+            "/api/chat/async/", {"user_id": 999999, "message": "hi"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(GEMINI_BACKEND="fake")
+class SharedClientTests(TestCase):
+    def tearDown(self):
+        set_shared_client(None)
+
+    def test_client_is_built_once_across_threads(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            clients = list(pool.map(lambda _: GeminiService().client, range(32)))
+        self.assertEqual(len({id(client) for client in clients}), 1)
+
+    def test_forked_worker_builds_its_own_client(self):
+        parent_client = get_shared_client()
+        with mock.patch("chat.gemini_service.os.getpid", return_value=-1):
+            self.assertIsNot(get_shared_client(), parent_client)
+
+    def test_explicit_client_overrides_shared_one(self):
+        fake = FakeGenAIClient()
+        self.assertIs(GeminiService(client=fake).client, fake)
+
+    def test_fake_client_keeps_only_recent_calls(self):
+        fake = FakeGenAIClient(max_calls=3)
+        for i in range(5):
+            fake.models.generate_content("model", f"prompt {i}")
+        self.assertEqual([call["contents"] for call in fake.calls], ["prompt 2", "prompt 3", "prompt 4"])
+        self.assertEqual(fake.call_count, 5)
+
+    def test_forked_worker_can_adopt_the_warmed_client(self):
+        parent_client = get_shared_client()
+        with mock.patch("chat.gemini_service.os.getpid", return_value=-1):
+            adopt_shared_client()
+            self.assertIs(get_shared_client(), parent_client)
+
+
+@override_settings(GEMINI_BACKEND="fake")
+class ColdStartTests(TransactionTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(
+            "chat.warmup._state", {"warm": False, "pid": None, "warmed_in_ms": None, "steps": {}, "errors": {}}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(set_shared_client, None)
+
+    def test_release_skips_migrate_when_up_to_date(self):
+        out = StringIO()
+        with mock.patch("chat.management.commands.release.call_command", wraps=call_command) as commands:
+            call_command("release", stdout=out)
+        self.assertIn("default: up to date", out.getvalue())
+        self.assertEqual([c.args[0] for c in commands.call_args_list], ["createcachetable", "create_default_superuser"])
+        self.assertTrue(User.objects.filter(username="adnan", is_superuser=True).exists())
+
+    def test_release_migrates_pending_databases(self):
+        with mock.patch("chat.management.commands.release.pending_migrations", return_value=[("0009", False)]), \
+                mock.patch("chat.management.commands.release.call_command") as commands:
+            call_command("release", stdout=StringIO())
+        self.assertEqual(commands.call_args_list[0].args, ("migrate",))
+        self.assertEqual(commands.call_args_list[0].kwargs["database"], "default")
+
+    def test_ready_warms_once_and_reports_it(self):
+        response = self.client.get("/ready")
+        self.assertEqual(response.status_code, 200)
+        state = response.json()
+        self.assertTrue(state["ready"])
+        self.assertFalse(state["preloaded"])
+        self.assertEqual(set(state["steps"]), {"genai_client", "urls", "templates", "memory_index", "database"})
+        self.assertIsNotNone(get_shared_client())
+
+        # A forked worker inherits the state instead of warming again
+        with mock.patch("chat.warmup.os.getpid", return_value=-1):
+            again = self.client.get("/ready").json()
+        self.assertTrue(again["preloaded"])
+        self.assertEqual(again["warmed_in_ms"], state["warmed_in_ms"])
+
+    @override_settings(GEMINI_BACKEND="genai")
+    def test_ready_is_503_when_warm_up_fails(self):
+        with mock.patch.dict(os.environ, {"GEMINI_API_KEY": ""}), self.assertLogs("chat.warmup", "WARNING"):
+            response = self.client.get("/ready")
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()["ready"])
+        self.assertIn("genai_client", response.json()["errors"])
+
+    @override_settings(GEMINI_BACKEND="genai")
+    def test_ready_retries_failed_steps_until_they_succeed(self):
+        with mock.patch.dict(os.environ, {"GEMINI_API_KEY": ""}), self.assertLogs("chat.warmup", "WARNING"):
+            self.assertEqual(self.client.get("/ready").status_code, 503)
+
+        steps = [(name, mock.Mock()) for name in ("genai_client", "urls", "templates", "memory_index", "database")]
+        with mock.patch("chat.warmup.STEPS", steps):
+            response = self.client.get("/ready")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["errors"], {})
+        # Only the failed step ran again
+        self.assertEqual([step.call_count for name, step in steps], [1, 0, 0, 0, 0])
+
+
+class PromptPrefixCacheTests(TestCase):
+    def setUp(self):
+        get_prompt_cache().clear()
+        get_memory_index().clear()
+        self.user = User.objects.create_user(username="cache_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        Memory.objects.create(user=self.user, key="favourite_food", value="pizza")
+        self.service = GeminiService()
+
+    def test_warm_cache_skips_persona_and_memory_queries(self):
+        self.service.prepare_prompt(self.user)
+        user = User.objects.get(id=self.user.id)
+        with self.assertNumQueries(1):
+            prompt = self.service.prepare_prompt(user)
+        self.assertIn("favourite_food: pizza", prompt)
+
+    def test_memory_write_invalidates_prefix(self):
+        self.service.prepare_prompt(self.user)
+        Memory.objects.create(user=self.user, key="pet", value="cat")
+        self.assertIn("pet: cat", self.service.prepare_prompt(self.user))
+
+    def test_persona_update_invalidates_prefix(self):
+        self.service.prepare_prompt(self.user)
+        persona = self.user.persona
+        persona.name = "Mia"
+        persona.save()
+        self.assertIn("Name: Mia", self.service.prepare_prompt(User.objects.get(id=self.user.id)))
+
+    def test_lru_evicts_by_size_and_ttl(self):
+        cache = LRUPromptCache(max_size=2, ttl=60)
+        for user_id in (1, 2, 3):
+            cache.set(user_id, f"prefix {user_id}")
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(3), "prefix 3")
+
+        expired = LRUPromptCache(max_size=2, ttl=-1)
+        expired.set(1, "prefix")
+        self.assertIsNone(expired.get(1))
+
+    def test_django_cache_backend_round_trip(self):
+        cache = DjangoPromptCache()
+        prefix = self.service.get_prompt_prefix(self.user)
+        cache.set(self.user.id, prefix)
+        self.assertEqual(cache.get(self.user.id), prefix)
+        cache.delete(self.user.id)
+        self.assertIsNone(cache.get(self.user.id))
+
+
+class ResponseCacheTests(TestCase):
+    def test_concurrent_identical_calls_share_one_upstream_call(self):
+        cache = ResponseCache()
+        calls = []
+        barrier = threading.Barrier(8)
+
+        def upstream():
+            calls.append(1)
+            time.sleep(0.05)
+            return "reply"
+
+        def submit(_):
+            barrier.wait()
+            return cache.get_or_call("same prompt", "model", upstream)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            replies = list(pool.map(submit, range(8)))
+
+        self.assertEqual(replies, ["reply"] * 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()["upstream_calls_saved"], 7)
+
+    def test_errors_reach_waiters_and_are_not_cached(self):
+        cache = ResponseCache(ttl=60)
+
+        def failing():
+            raise RuntimeError("upstream down")
+
+        with self.assertRaises(RuntimeError):
+            cache.get_or_call("prompt", "model", failing)
+        self.assertEqual(cache.get_or_call("prompt", "model", lambda: "recovered"), "recovered")
+
+    def test_ttl_cache_hits_skip_upstream(self):
+        cache = ResponseCache(ttl=60)
+        cache.get_or_call("prompt", "model", lambda: "first")
+        self.assertEqual(cache.get_or_call("prompt", "model", lambda: "second"), "first")
+        self.assertEqual(cache.get_or_call("prompt", "other-model", lambda: "second"), "second")
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_hits_misses_and_coalesced_calls_are_exported(self):
+        counters = (RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES, RESPONSE_CACHE_COALESCED)
+        before = [counter.value() for counter in counters]
+        cache = ResponseCache(ttl=60)
+        cache.get_or_call("prompt", "model", lambda: "first")
+        cache.get_or_call("prompt", "model", lambda: "second")
+
+        async def upstream():
+            await asyncio.sleep(0.01)
+            return "reply"
+
+        async def run():
+            return await asyncio.gather(*(cache.aget_or_call("other", "model", upstream) for _ in range(3)))
+
+        asyncio.run(run())
+        self.assertEqual([counter.value() - before[i] for i, counter in enumerate(counters)], [1, 2, 2])
+        self.assertIn("chat_response_cache_coalesced_total", render_metrics())
+
+    def test_async_calls_are_coalesced(self):
+        cache = ResponseCache()
+        calls = []
+
+        async def upstream():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "reply"
+
+        async def run():
+            return await asyncio.gather(
+                *(cache.aget_or_call("prompt", "model", upstream) for _ in range(5))
+            )
+
+        self.assertEqual(asyncio.run(run()), ["reply"] * 5)
+        self.assertEqual(len(calls), 1)
+
+
+class IdempotentChatTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="idempotent_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        self.fake = FakeGenAIClient(reply="Only once")
+        patcher = mock.patch("chat.views.GeminiService", lambda: GeminiService(client=self.fake))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_chat(self, key):
+        return self.client.post(
+            "/api/chat/",
+            {"user_id": self.user.id, "message": "hello"},
+            content_type="application/json",
+            headers={"Idempotency-Key": key},
+        )
+
+    def test_retry_with_same_key_replays_reply(self):
+        first = self.post_chat("retry-1")
+        second = self.post_chat("retry-1")
+
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(len(self.fake.calls), 1)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 2)
+
+    def test_different_keys_run_separate_turns(self):
+        self.post_chat("turn-1")
+        self.post_chat("turn-2")
+        self.assertEqual(len(self.fake.calls), 2)
+
+
+class TurnPersistenceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="writer")
+        self.service = GeminiService()
+
+    def test_turn_is_written_with_a_single_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.service.save_turn(self.user, "hi", "hello")
+        inserts = [q for q in queries.captured_queries if q["sql"].startswith("INSERT")]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(
+            list(Message.objects.filter(user=self.user).values_list("sender", "message")),
+            [("user", "hi"), ("ai", "hello")],
+        )
+
+    def test_write_buffer_flushes_full_batches(self):
+        buffer = MessageWriteBuffer(max_batch=4, flush_interval=None)
+        buffer.add(self.service._turn_messages(self.user, "one", "reply one"))
+        self.assertFalse(Message.objects.filter(user=self.user).exists())
+
+        buffer.add(self.service._turn_messages(self.user, "two", "reply two"))
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 4)
+
+    def test_close_drains_pending_messages(self):
+        buffer = MessageWriteBuffer(max_batch=100, flush_interval=None)
+        buffer.add(self.service._turn_messages(self.user, "hi", "hello"))
+        self.assertEqual(buffer.close(), 2)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 2)
+
+    def test_rows_that_keep_failing_are_dropped_after_retries(self):
+        buffer = MessageWriteBuffer(max_batch=100, flush_interval=None, max_retries=2)
+        bad = Message(user=self.user, sender="user", message="bad")
+        write = buffer._write
+
+        def failing(alias, rows):
+            if any(row is bad for row in rows):
+                raise IntegrityError("FOREIGN KEY constraint failed")
+            write(alias, rows)
+
+        with mock.patch.object(buffer, "_write", side_effect=failing):
+            buffer.add([bad, *self.service._turn_messages(self.user, "one", "reply one")])
+            with self.assertLogs("chat.write_buffer", "ERROR"):
+                self.assertEqual(buffer.flush(), 0)
+            self.assertEqual(len(buffer.pending_for(self.user.id)), 3)
+
+            buffer.add(self.service._turn_messages(self.user, "two", "reply two"))
+            with self.assertLogs("chat.write_buffer", "ERROR") as logs:
+                self.assertEqual(buffer.flush(), 4)
+        self.assertIn("Dropping a buffered message", logs.output[-1])
+        self.assertEqual(buffer.pending_for(self.user.id), [])
+        self.assertEqual(
+            list(Message.objects.filter(user=self.user).values_list("message", flat=True)),
+            ["one", "reply one", "two", "reply two"],
+        )
+
+    def test_history_window_includes_buffered_messages(self):
+        Message.objects.create(user=self.user, sender="user", message="stored")
+        buffer = MessageWriteBuffer(max_batch=100, flush_interval=None)
+        buffer.add(self.service._turn_messages(self.user, "buffered", "buffered reply"))
+        with mock.patch("chat.gemini_service.get_write_buffer", return_value=buffer):
+            window = self.service.get_history_window(self.user, limit=2)
+        self.assertEqual([msg.message for msg in window], ["buffered", "buffered reply"])
+
+
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        get_prompt_cache().clear()
+        get_memory_index().clear()
+        self.user = User.objects.create_user(username="budget_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        Memory.objects.create(user=self.user, key="pet", value="a cat called Miso")
+        Message.objects.bulk_create(
+            Message(user=self.user, sender="user", message=f"message {i}") for i in range(30)
+        )
+        self.fake = FakeGenAIClient(reply="Budget reply")
+        patcher = mock.patch("chat.views.GeminiService", lambda: GeminiService(client=self.fake))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Create the shared quota rows; each turn then takes from them with
+        # one UPDATE per bucket (requests and tokens)
+        get_upstream_guard().limiter.acquire()
+
+    def chat(self, path="/api/chat/"):
+        return self.client.post(path, {"user_id": self.user.id, "message": "hi"}, content_type="application/json")
+
+    def test_chat_turn_has_a_fixed_query_count(self):
+        # User and persona (joined), memory index build, history window,
+        # two quota updates, insert
+        with self.assertNumQueries(6):
+            self.assertEqual(self.chat().status_code, 200)
+        # Warm caches: user and persona, history window, quota, insert
+        with self.assertNumQueries(5):
+            self.chat()
+        Message.objects.bulk_create(
+            Message(user=self.user, sender="ai", message=f"more {i}") for i in range(100)
+        )
+        with self.assertNumQueries(5):
+            self.chat()
+
+    def test_streamed_turn_has_the_same_budget(self):
+        self.chat()
+        with self.assertNumQueries(5):
+            b"".join(self.chat("/api/chat/stream/").streaming_content)
+
+    def test_persona_retrieve_is_one_narrow_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f"/api/personas/{self.user.id}/")
+        self.assertEqual(response.json()["name"], "Ava")
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn("updated_at", queries[0]["sql"])
+
+    def test_chat_users_join_the_persona(self):
+        with self.assertNumQueries(1):
+            user = chat_users().get(id=self.user.id)
+            prefix = GeminiService().build_prompt_prefix(user.persona, [])
+        self.assertEqual(prefix.persona_name, "Ava")
+
+    def test_user_without_persona(self):
+        user = chat_users().get(id=User.objects.create_user(username="no_persona").id)
+        with self.assertNumQueries(0), self.assertRaises(Persona.DoesNotExist):
+            user.persona
+
+
+class ReadReplicaTests(TransactionTestCase):
+    """A second SQLite database stands in for the replica"""
+
+    def setUp(self):
+        handle, path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        databases = connections.configure_settings({
+            "default": dict(settings.DATABASES["default"]),
+            "replica": {"ENGINE": "django.db.backends.sqlite3", "NAME": path},
+        })
+        connections.settings["replica"] = databases["replica"]
+        self.addCleanup(connections.settings.pop, "replica")
+        # Allow the alias for the test body only; teardown flushes default alone
+        self.enterContext(mock.patch.object(type(self), "databases", {"default", "replica"}))
+        self.addCleanup(connections.__delitem__, "replica")
+        self.addCleanup(lambda: connections["replica"].close())
+        with connections["replica"].schema_editor() as editor:
+            for model in (User, Persona, Message, MessageArchive):
+                editor.create_model(model)
+
+        self.user = User.objects.create_user(username="replicated")
+        Persona.objects.create(user=self.user, name="Ava", role="friend", personality="caring", tone="sweet")
+        Message.objects.create(user=self.user, sender="user", message="on primary")
+        # The replica's copy differs, so reads show where they went
+        User.objects.using("replica").create(id=self.user.id, username="replicated")
+        Persona.objects.using("replica").create(
+            user_id=self.user.id, name="Replica Ava", role="friend", personality="caring", tone="sweet"
+        )
+        Message.objects.using("replica").create(user_id=self.user.id, sender="user", message="on replica")
+
+    def test_history_and_persona_reads_use_the_replica(self):
+        # Newest message, page, archive (the page is short)
+        with self.assertNumQueries(3, using="replica"), self.assertNumQueries(0):
+            page = self.client.get(f"/api/messages/{self.user.id}/").json()
+        self.assertEqual([row["message"] for row in page["results"]], ["on replica"])
+        self.assertEqual(self.client.get(f"/api/personas/{self.user.id}/").json()["name"], "Replica Ava")
+        window = GeminiService().get_history_window(self.user)
+        self.assertEqual([msg.message for msg in window], ["on replica"])
+
+    def test_writes_and_transactions_stay_on_default(self):
+        GeminiService().save_turn(self.user, "hi", "hello")
+        self.assertEqual(Message.objects.using("default").filter(user=self.user).count(), 3)
+        self.assertEqual(Message.objects.using("replica").count(), 1)
+        with transaction.atomic():
+            self.assertEqual(Message.objects.filter(user=self.user).db, "default")
+        self.assertEqual(Memory.objects.all().db, "default")
+        self.assertEqual(Message.objects.all().db, "replica")
+
+    def test_without_a_replica_reads_use_default(self):
+        with override_settings(CHAT_READ_REPLICA={"ALIAS": "missing", "MODELS": ["chat.message"]}):
+            self.assertEqual(Message.objects.all().db, "default")
+
+
+SHARDING = {
+    "ALIASES": ["shard_0", "shard_1"],
+    "MODELS": settings.CHAT_SHARDING["MODELS"],
+    "ASSIGNMENT_TTL": 30,
+    "MOVE_SETTLE": 0,
+    "ID_BLOCK": 2 ** 48,
+}
+
+
+class ShardingTests(TransactionTestCase):
+    """Two SQLite files stand in for the shards"""
+
+    @classmethod
+    def setUpClass(cls):
+        # Added here rather than as a class attribute: the runner only knows default
+        cls.directory = tempfile.TemporaryDirectory()
+        databases = connections.configure_settings({
+            "default": dict(settings.DATABASES["default"]),
+            **{
+                alias: {"ENGINE": "django.db.backends.sqlite3", "NAME": os.path.join(cls.directory.name, alias)}
+                for alias in SHARDING["ALIASES"]
+            },
+        })
+        for alias in SHARDING["ALIASES"]:
+            connections.settings[alias] = databases[alias]
+            # Under the shard settings, so each shard's ids start in its own block
+            with override_settings(CHAT_SHARDING=SHARDING):
+                call_command("migrate", database=alias, verbosity=0)
+        cls.databases = {"default", *SHARDING["ALIASES"]}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in SHARDING["ALIASES"]:
+            connections[alias].close()
+            del connections[alias]
+            connections.settings.pop(alias)
+        cls.directory.cleanup()
+
+    def setUp(self):
+        cache.clear()
+        get_prompt_cache().clear()
+        self.enterContext(override_settings(CHAT_SHARDING=SHARDING))
+        self.fake = FakeGenAIClient(reply="Sharded reply")
+        self.enterContext(mock.patch("chat.views.GeminiService", lambda: GeminiService(client=self.fake)))
+
+    def other(self, alias):
+        return next(other for other in SHARDING["ALIASES"] if other != alias)
+
+    def make_user(self, username, messages=0):
+        user = User.objects.create_user(username=username)
+        with use_shard(user.id):
+            Persona.objects.create(user=user, name="Ava", role="friend", personality="caring", tone="sweet")
+            Message.objects.bulk_create(
+                Message(user=user, sender="user", message=f"message {i}") for i in range(messages)
+            )
+        return user
+
+    def chat(self, user_id, message):
+        return self.client.post("/api/chat/", {"user_id": user_id, "message": message}, content_type="application/json")
+
+    def test_placement_is_stable_and_adding_a_shard_moves_few_users(self):
+        two = {user_id: placement(user_id, ["shard_0", "shard_1"]) for user_id in range(1, 601)}
+        self.assertEqual(two, {user_id: placement(user_id, ["shard_1", "shard_0"]) for user_id in two})
+        self.assertGreater(list(two.values()).count("shard_0"), 240)
+        self.assertGreater(list(two.values()).count("shard_1"), 240)
+        three = {user_id: placement(user_id, ["shard_0", "shard_1", "shard_2"]) for user_id in two}
+        moved = [user_id for user_id in two if three[user_id] != two[user_id]]
+        self.assertEqual({three[user_id] for user_id in moved}, {"shard_2"})
+        self.assertLess(len(moved), 260)
+
+    def test_new_users_live_on_their_shard(self):
+        user_id = self.client.post("/api/users/", content_type="application/json").json()["id"]
+        alias = placement(user_id)
+        self.assertEqual(ShardAssignment.objects.get(user_id=user_id).alias, alias)
+        self.assertEqual(User.objects.using(alias).get(id=user_id).username, User.objects.get(id=user_id).username)
+        self.assertTrue(Persona.objects.using(alias).filter(user_id=user_id).exists())
+        self.assertFalse(Persona.objects.using(self.other(alias)).filter(user_id=user_id).exists())
+        self.assertFalse(Persona.objects.using("default").exists())
+
+        for user in provision_users(6):
+            self.assertTrue(Persona.objects.using(placement(user.id)).filter(user_id=user.id).exists())
+
+    def test_chat_history_and_persona_use_the_users_shard(self):
+        user = User.objects.create_user(username="sharded_user")
+        alias = shard_for(user.id)
+        response = self.client.post(
+            "/api/personas/",
+            {"user_id": user.id, "name": "Ava", "role": "friend", "personality": "caring", "tone": "sweet"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.chat(user.id, "hello").json()["reply"], "Sharded reply")
+        response = self.client.post(
+            "/api/chat/async/", {"user_id": user.id, "message": "again"}, content_type="application/json"
+        )
+        self.assertEqual(response.json()["reply"], "Sharded reply")
+
+        self.assertEqual(Message.objects.using(alias).filter(user_id=user.id).count(), 4)
+        self.assertFalse(Message.objects.using("default").exists())
+        self.assertFalse(Message.objects.using(self.other(alias)).exists())
+        page = self.client.get(f"/api/messages/{user.id}/").json()
+        self.assertEqual([row["message"] for row in page["results"]], ["hello", "Sharded reply", "again", "Sharded reply"])
+        self.assertEqual(self.client.get(f"/api/personas/{user.id}/").json()["name"], "Ava")
+
+    def test_persona_routes_use_the_users_shard(self):
+        user = self.make_user("persona_user")
+        alias = shard_for(user.id)
+        auth = {"HTTP_AUTHORIZATION": f"Bearer {issue_token(user.id)}"}
+
+        listed = self.client.get("/api/personas/", **auth)
+        self.assertEqual(listed.status_code, 200)
+        self.assertEqual([persona["name"] for persona in listed.json()], ["Ava"])
+        self.assertEqual(self.client.get("/api/personas/").json(), [])
+
+        response = self.client.patch(f"/api/personas/{user.id}/", {"name": "Mia"}, content_type="application/json", **auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Persona.objects.using(alias).get(user_id=user.id).name, "Mia")
+
+        response = self.client.put(
+            f"/api/personas/{user.id}/",
+            {"user_id": user.id, "name": "Mia", "role": "mentor", "personality": "calm", "tone": "dry"},
+            content_type="application/json", **auth,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Persona.objects.using(alias).get(user_id=user.id).role, "mentor")
+
+        self.assertEqual(self.client.delete(f"/api/personas/{user.id}/", **auth).status_code, 204)
+        self.assertFalse(Persona.objects.using(alias).filter(user_id=user.id).exists())
+        self.assertEqual(self.client.patch(f"/api/personas/{user.id}/", {}, content_type="application/json", **auth).status_code, 404)
+
+    def test_unscoped_queries_are_refused(self):
+        user = self.make_user("scoped_user", messages=3)
+        with self.assertRaises(ShardNotSelected):
+            Message.objects.filter(user=user).count()
+        # Instance-bound queries know the user
+        self.assertEqual(user.messages.count(), 3)
+        with use_shard(user.id):
+            self.assertEqual(Message.objects.filter(user=user).count(), 3)
+
+    def test_rebalance_moves_a_user_and_their_history(self):
+        user = self.make_user("moving_user", messages=12)
+        source = shard_for(user.id)
+        target = self.other(source)
+        with use_shard(user.id):
+            Memory.objects.create(user=user, key="likes", value="tea")
+            before = list(Message.objects.filter(user=user).order_by("created_at", "id").values_list("message", "created_at"))
+            covered = Message.objects.filter(user=user).order_by("created_at", "id")[3]
+            ConversationSummary.objects.create(
+                user=user, summary="...", covered_until=covered.created_at, covered_until_id=covered.id
+            )
+
+        out = StringIO()
+        call_command("rebalance_shards", "--user", str(user.id), "--to", target, "--settle", "0", stdout=out)
+        self.assertIn("Moved 1 users (12 messages)", out.getvalue())
+        self.assertEqual(shard_for(user.id), target)
+        for model in (Persona, Message, Memory, ConversationSummary):
+            self.assertFalse(model.objects.using(source).filter(user_id=user.id).exists(), model)
+        self.assertFalse(User.objects.using(source).filter(id=user.id).exists())
+
+        with use_shard(user.id):
+            moved = Message.objects.filter(user=user).order_by("created_at", "id")
+            self.assertEqual(list(moved.values_list("message", "created_at")), before)
+            summary = ConversationSummary.objects.get(user=user)
+            self.assertEqual(summary.covered_until_id, moved[3].id)
+            self.assertEqual(Memory.objects.get(user=user).value, "tea")
+        self.chat(user.id, "still here")
+        self.assertEqual(Message.objects.using(target).filter(user_id=user.id).count(), 14)
+
+    def test_move_delta_pass_keeps_the_targets_newer_rows(self):
+        user = self.make_user("delta_user", messages=3)
+        source = shard_for(user.id)
+        target = self.other(source)
+        with use_shard(user.id):
+            Memory.objects.create(user=user, key="likes", value="tea")
+        User.objects.using(target).create(id=user.id, username=user.username)
+        move = UserMove(user.id, source, target)
+        self.assertEqual(move.copy(), 3)
+
+        # After the flip the target is live; a late turn still lands on the source
+        Persona.objects.using(target).filter(user_id=user.id).update(name="Mia")
+        Memory.objects.using(target).filter(user_id=user.id).update(value="coffee")
+        Message.objects.using(source).create(user_id=user.id, sender="user", message="late")
+        self.assertEqual(move.copy(), 1)
+
+        self.assertEqual(Persona.objects.using(target).get(user_id=user.id).name, "Mia")
+        self.assertEqual(Memory.objects.using(target).get(user_id=user.id).value, "coffee")
+        self.assertEqual(Message.objects.using(target).filter(user_id=user.id).count(), 4)
+
+    def test_moved_messages_keep_their_ids(self):
+        # SQLite moves a counter past ids inserted into the table, which
+        # earlier moves did; start both shards at their block again
+        for alias in SHARDING["ALIASES"]:
+            with connections[alias].cursor() as cursor:
+                cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'chat_message'")
+            reserve_id_block(alias)
+        user = self.make_user("kept_ids_user", messages=5)
+        source = shard_for(user.id)
+        target = self.other(source)
+        with use_shard(user.id):
+            ids = list(Message.objects.filter(user=user).order_by("id").values_list("id", flat=True))
+        self.assertGreaterEqual(ids[0], id_block_start(source))
+        # The target's own messages count from another block
+        next(
+            neighbour for neighbour in (self.make_user(f"neighbour_{i}", messages=5) for i in range(20))
+            if shard_for(neighbour.id) == target
+        )
+
+        UserMove(user.id, source, target).run(settle=0)
+        with use_shard(user.id):
+            self.assertEqual(list(Message.objects.filter(user=user).order_by("id").values_list("id", flat=True)), ids)
+        self.assertEqual(Message.objects.using(target).count(), 10)
+
+    def test_move_catches_up_on_source_writes_after_the_first_pass(self):
+        user = self.make_user("catch_up_user", messages=3)
+        source = shard_for(user.id)
+        target = self.other(source)
+        with use_shard(user.id):
+            Memory.objects.create(user=user, key="likes", value="tea")
+            Memory.objects.create(user=user, key="city", value="Oslo")
+        User.objects.using(target).create(id=user.id, username=user.username)
+        move = UserMove(user.id, source, target)
+        move.copy()
+
+        # Written to the source before the flip reached every worker
+        with use_shard(user.id):
+            persona = Persona.objects.get(user=user)
+            persona.name = "Mia"
+            persona.save()
+            Memory.objects.filter(user=user, key="likes").update(value="coffee")
+            Memory.objects.filter(user=user, key="city").delete()
+            Memory.objects.create(user=user, key="pet", value="a cat")
+            oldest = Message.objects.filter(user=user).order_by("created_at", "id").first()
+            # A write-behind row flushed late, older than what was copied
+            late = Message.objects.create(user=user, sender="user", message="late", created_at=oldest.created_at)
+            ConversationSummary.objects.create(
+                user=user, summary="...", covered_until=late.created_at, covered_until_id=late.id
+            )
+        self.assertEqual(move.copy(), 1)
+
+        self.assertEqual(Persona.objects.using(target).get(user_id=user.id).name, "Mia")
+        self.assertEqual(
+            dict(Memory.objects.using(target).filter(user_id=user.id).values_list("key", "value")),
+            {"likes": "coffee", "pet": "a cat"},
+        )
+        self.assertTrue(Message.objects.using(target).filter(id=late.id, message="late").exists())
+        self.assertEqual(ConversationSummary.objects.using(target).get(user_id=user.id).covered_until_id, late.id)
+
+    def test_move_flushes_the_write_buffer_before_reading_the_source(self):
+        user = self.make_user("buffered_move_user", messages=1)
+        buffer = mock.Mock()
+        with mock.patch("chat.write_buffer.get_write_buffer", return_value=buffer):
+            UserMove(user.id, shard_for(user.id), self.other(shard_for(user.id))).run(settle=0)
+        self.assertEqual(buffer.flush.call_count, 2)
+
+    def test_rebalance_moves_users_from_before_sharding(self):
+        with override_settings(CHAT_SHARDING={**SHARDING, "ALIASES": []}):
+            user = self.make_user("legacy_user", messages=5)
+        self.assertEqual(shard_for(user.id), "default")
+
+        out = StringIO()
+        call_command("rebalance_shards", "--dry-run", stdout=out)
+        self.assertIn(f"{user.id}: default -> {placement(user.id)}", out.getvalue())
+        call_command("rebalance_shards", stdout=out)
+        self.assertEqual(shard_for(user.id), placement(user.id))
+        self.assertFalse(Message.objects.using("default").exists())
+        self.assertTrue(User.objects.using("default").filter(id=user.id).exists())
+        page = self.client.get(f"/api/messages/{user.id}/").json()
+        self.assertEqual(len(page["results"]), 5)
+
+    def test_deleting_a_user_deletes_their_shard_rows(self):
+        user = self.make_user("deleted_user", messages=2)
+        alias = shard_for(user.id)
+        user.delete()
+        self.assertFalse(Message.objects.using(alias).exists())
+        self.assertFalse(User.objects.using(alias).exists())
+
+
+class MessageHistoryApiTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="paged_user")
+        Message.objects.bulk_create(
+            Message(user=self.user, sender="user", message=f"message {i}") for i in range(25)
+        )
+        self.url = f"/api/messages/{self.user.id}/"
+
+    def messages(self, response):
+        return [row["message"] for row in response.json()["results"]]
+
+    def test_default_page_is_newest_messages_oldest_first(self):
+        response = self.client.get(self.url, {"limit": 10})
+        self.assertEqual(self.messages(response), [f"message {i}" for i in range(15, 25)])
+        self.assertIsNotNone(response.json()["before"])
+
+    def test_before_cursor_walks_back_to_the_start(self):
+        seen = []
+        params = {"limit": 10}
+        while True:
+            page = self.client.get(self.url, params).json()
+            seen = [row["message"] for row in page["results"]] + seen
+            if not page["before"]:
+                break
+            params = {"limit": 10, "before": page["before"]}
+        self.assertEqual(seen, [f"message {i}" for i in range(25)])
+
+    def test_after_cursor_returns_only_new_messages(self):
+        cursor = self.client.get(self.url, {"limit": 5}).json()["after"]
+        Message.objects.create(user=self.user, sender="ai", message="fresh")
+        response = self.client.get(self.url, {"after": cursor})
+        self.assertEqual(self.messages(response), ["fresh"])
+
+    def test_unchanged_history_returns_304(self):
+        first = self.client.get(self.url)
+        with self.assertNumQueries(1):
+            cached = self.client.get(self.url, headers={"If-None-Match": first["ETag"]})
+        self.assertEqual(cached.status_code, 304)
+
+        Message.objects.create(user=self.user, sender="ai", message="fresh")
+        changed = self.client.get(self.url, headers={"If-None-Match": first["ETag"]})
+        self.assertEqual(changed.status_code, 200)
+
+    def test_page_size_does_not_grow_with_history(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, {"limit": 5})
+        self.assertEqual(len(response.json()["results"]), 5)
+
+    def test_invalid_cursor_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {"before": "not-a-cursor"}).status_code, 400)
+
+
+@override_settings(CHAT_HISTORY_LIMIT=10, CHAT_ARCHIVE={"HORIZON_DAYS": 90, "BATCH_SIZE": 1000, "KEEP_RECENT": 0})
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="archived_user")
+        messages = Message.objects.bulk_create(
+            Message(user=self.user, sender="user" if i % 2 == 0 else "ai", message=f"message {i}")
+            for i in range(120)
+        )
+        now = timezone.now()
+        for i, msg in enumerate(messages):
+            # 100 messages from 200..101 days ago, then 20 from the last hour
+            msg.created_at = now - timedelta(days=200 - i) if i < 100 else now - timedelta(minutes=120 - i)
+        Message.objects.bulk_update(messages, ["created_at"])
+        self.url = f"/api/messages/{self.user.id}/"
+
+    def walk_back(self, limit=30):
+        seen = []
+        params = {"limit": limit}
+        while True:
+            page = self.client.get(self.url, params).json()
+            seen = page["results"] + seen
+            if not page["before"]:
+                return seen
+            params = {"limit": limit, "before": page["before"]}
+
+    def test_old_messages_move_into_compressed_blocks(self):
+        self.assertEqual(archive_messages(horizon_days=90, batch_size=25), (1, 100, 4))
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 20)
+        blocks = list(MessageArchive.objects.filter(user=self.user))
+        self.assertEqual([block.count for block in blocks], [25, 25, 25, 25])
+        self.assertLess(sum(len(block.data) for block in blocks), sum(len(f"message {i}") for i in range(100)) * 2)
+        self.assertEqual(archive_messages(horizon_days=90, batch_size=25), (0, 0, 0))
+
+    def test_runs_are_bounded_and_resumable(self):
+        out = StringIO()
+        call_command("archive_messages", "--batch-size", "30", "--max-batches", "2", stdout=out)
+        self.assertIn("Archived 60 messages", out.getvalue())
+        call_command("archive_messages", "--batch-size", "30", stdout=out)
+        self.assertEqual(MessageArchive.objects.filter(user=self.user).count(), 4)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 20)
+
+    def test_recent_messages_stay_live(self):
+        archive_messages(horizon_days=0, keep_recent=15)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 15)
+        window = GeminiService().get_history_window(self.user)
+        self.assertEqual([msg.message for msg in window], [f"message {i}" for i in range(110, 120)])
+
+    @override_settings(CHAT_ROLLING_SUMMARY={
+        "ENABLED": True, "SUMMARIZER": "chat.tests.StubSummarizer", "BATCH_SIZE": 200, "MIN_MESSAGES": 1,
+    })
+    def test_unsummarized_messages_are_not_archived(self):
+        self.assertEqual(archive_messages(horizon_days=90), (0, 0, 0))
+        covered = Message.objects.filter(user=self.user).order_by("created_at", "id")[39]
+        ConversationSummary.objects.create(
+            user=self.user, summary="...", covered_until=covered.created_at, covered_until_id=covered.id
+        )
+        self.assertEqual(archive_messages(horizon_days=90)[1], 40)
+
+    def test_history_api_pages_through_the_archive(self):
+        before = self.walk_back()
+        archive_messages(horizon_days=90, batch_size=25)
+        after = self.walk_back()
+        self.assertEqual([row["message"] for row in after], [f"message {i}" for i in range(120)])
+        self.assertEqual([row["id"] for row in after], [row["id"] for row in before])
+
+        cursor = encode_cursor(datetime.fromisoformat(after[89]["created_at"].replace("Z", "+00:00")), after[89]["id"])
+        page = self.client.get(self.url, {"limit": 20, "after": cursor}).json()
+        self.assertEqual([row["message"] for row in page["results"]], [f"message {i}" for i in range(90, 110)])
+        self.assertTrue(page["has_newer"])
+
+
+@override_settings(CHAT_HISTORY_LIMIT=10, CHAT_ARCHIVE={"HORIZON_DAYS": 90, "BATCH_SIZE": 1000, "KEEP_RECENT": 0})
+class TransferTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="exported_user")
+        Persona.objects.create(user=self.user, name="Ava", role="friend", personality="caring", tone="sweet")
+        Memory.objects.create(user=self.user, key="likes", value="tea")
+        messages = Message.objects.bulk_create(
+            Message(user=self.user, sender="user" if i % 2 == 0 else "ai", message=f"message {i} ✓")
+            for i in range(30)
+        )
+        now = timezone.now()
+        for i, msg in enumerate(messages):
+            msg.created_at = now - timedelta(days=200 - i)
+        Message.objects.bulk_update(messages, ["created_at"])
+        self.other = User.objects.create_user(username="other_user")
+        Message.objects.create(user=self.other, sender="user", message="not exported")
+
+    def snapshot(self):
+        return list(
+            Message.objects.filter(user__username="exported_user").order_by("created_at", "id")
+            .values_list("id", "sender", "message", "created_at")
+        )
+
+    def export(self):
+        return b"".join(export_ndjson_gz([self.user.id], chunk_size=7))
+
+    def test_export_is_lazy(self):
+        records = export_records()
+        with self.assertNumQueries(1):
+            self.assertEqual(next(records)["type"], "user")
+
+    def test_round_trip_restores_messages_persona_and_memories(self):
+        expected = self.snapshot()
+        data = self.export()
+        self.assertEqual(data[:2], b"\x1f\x8b")
+        User.objects.filter(id=self.user.id).delete()
+
+        counts = import_ndjson(BytesIO(data), batch_size=4)
+        self.assertEqual(counts, {"user": 1, "persona": 1, "memory": 1, "message": 30, "skipped": 0, "renumbered": 0})
+        self.assertEqual(self.snapshot(), expected)
+        user = User.objects.get(username="exported_user")
+        self.assertEqual(user.persona.name, "Ava")
+        self.assertEqual(dict(user.memories.values_list("key", "value")), {"likes": "tea"})
+        self.assertFalse(user.has_usable_password())
+        self.assertEqual(Message.objects.filter(user=self.other).count(), 1)
+
+    def test_reimport_is_idempotent_and_plain_ndjson_works(self):
+        expected = self.snapshot()
+        plain = gzip.decompress(self.export())
+        import_ndjson(BytesIO(plain))
+        counts = import_ndjson(BytesIO(plain))
+        self.assertEqual((counts["message"], counts["skipped"], counts["renumbered"]), (0, 30, 0))
+        self.assertEqual(self.snapshot(), expected)
+        self.assertEqual(Persona.objects.filter(user=self.user).count(), 1)
+
+    def test_taken_ids_are_renumbered_and_reimports_skip_them(self):
+        expected = [row[1:] for row in self.snapshot()]
+        data = self.export()
+        first = Message.objects.filter(user=self.user).order_by("id").first()
+        Message.objects.filter(user=self.user).delete()
+        Message.objects.create(id=first.id, user=self.other, sender="user", message="holds the id")
+
+        with self.assertLogs("chat.transfer", "WARNING") as logs:
+            counts = import_ndjson(BytesIO(data))
+        self.assertEqual((counts["message"], counts["skipped"], counts["renumbered"]), (30, 0, 1))
+        self.assertIn(str(self.user.id), logs.output[0])
+        self.assertEqual([row[1:] for row in self.snapshot()], expected)
+        self.assertEqual(Message.objects.get(id=first.id).message, "holds the id")
+
+        counts = import_ndjson(BytesIO(data))
+        self.assertEqual((counts["message"], counts["skipped"], counts["renumbered"]), (0, 30, 0))
+
+    def test_same_ids_from_different_shards_are_all_imported(self):
+        # Each shard numbers its own messages
+        lines = [
+            {"type": "user", "id": 1, "username": "shard_a_user"},
+            {"type": "user", "id": 2, "username": "shard_b_user"},
+            {"type": "message", "user": 1, "id": 900, "sender": "user", "message": "a", "created_at": "2025-01-01T00:00:00+00:00"},
+            {"type": "message", "user": 2, "id": 900, "sender": "user", "message": "b", "created_at": "2025-01-01T00:00:01+00:00"},
+        ]
+        with self.assertLogs("chat.transfer", "WARNING"):
+            counts = import_ndjson(BytesIO("".join(json.dumps(line) + "\n" for line in lines).encode()))
+        self.assertEqual((counts["message"], counts["renumbered"]), (2, 1))
+        self.assertEqual(
+            sorted(Message.objects.filter(user__username__startswith="shard_").values_list("message", flat=True)), ["a", "b"]
+        )
+
+    def test_new_ids_append_a_copy(self):
+        import_ndjson(BytesIO(self.export()), new_ids=True)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 60)
+
+    def test_archived_messages_are_exported_in_order(self):
+        expected = self.snapshot()
+        archive_messages(horizon_days=90, batch_size=8)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 10)
+        data = self.export()
+        MessageArchive.objects.all().delete()
+        import_ndjson(BytesIO(data))
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_bad_line_reports_its_number(self):
+        with self.assertRaisesMessage(ValueError, "Line 2"):
+            import_ndjson(BytesIO(b'{"type": "user", "id": 1, "username": "x"}\n{"type": "bogus"}\n'))
+
+    def test_endpoints_are_staff_only(self):
+        self.client.defaults["HTTP_AUTHORIZATION"] = f"Bearer {issue_token(self.other.id)}"
+        self.assertEqual(self.client.get("/api/admin/export/").status_code, 403)
+        self.assertEqual(self.client.post("/api/admin/import/", b"", content_type="application/gzip").status_code, 403)
+
+    def test_endpoints_ignore_a_staff_session(self):
+        # The lean API chain has no sessions: only a staff token counts
+        self.client.force_login(User.objects.create_user(username="staff", is_staff=True))
+        self.assertEqual(self.client.get("/api/admin/export/").status_code, 403)
+
+    def test_endpoints_stream_an_export_back_in(self):
+        staff = User.objects.create_user(username="staff", is_staff=True)
+        self.client.defaults["HTTP_AUTHORIZATION"] = f"Bearer {issue_token(staff.id)}"
+        response = self.client.get("/api/admin/export/", {"user_id": self.user.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        data = b"".join(response.streaming_content)
+
+        Message.objects.filter(user=self.user).delete()
+        response = self.client.post("/api/admin/import/", data, content_type="application/gzip")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["imported"]["message"], 30)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 30)
+
+    def test_commands_round_trip_through_a_file(self):
+        expected = self.snapshot()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "export.ndjson.gz")
+            call_command("export_conversations", "--user", str(self.user.id), "--output", path, stderr=StringIO())
+            User.objects.filter(id=self.user.id).delete()
+            out = StringIO()
+            call_command("import_conversations", path, stdout=out)
+        self.assertIn("30 messages", out.getvalue())
+        self.assertEqual(self.snapshot(), expected)
+
+
+class ProvisioningTests(TestCase):
+    def test_signup_creates_user_with_default_persona(self):
+        response = self.client.post("/api/users/", content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        user = User.objects.get(id=response.json()["id"])
+        self.assertTrue(user.username.startswith("user_"))
+        self.assertEqual(user.persona.name, "Companion")
+
+    def test_signup_does_not_count_users(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post("/api/users/", content_type="application/json")
+        self.assertFalse(any("COUNT(" in q["sql"] for q in queries.captured_queries))
+
+    @override_settings(CHAT_BULK_PROVISIONING=True)
+    def test_bulk_endpoint_provisions_users_and_personas(self):
+        response = self.client.post("/api/users/bulk/", {"count": 25}, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        ids = response.json()["ids"]
+        self.assertEqual(len(set(ids)), 25)
+        self.assertEqual(Persona.objects.filter(user_id__in=ids).count(), 25)
+
+    def test_bulk_endpoint_is_disabled_by_default(self):
+        response = self.client.post("/api/users/bulk/", {"count": 5}, content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+
+
+class LeanApiTests(TestCase):
+    def setUp(self):
+        get_prompt_cache().clear()
+        self.fake = FakeGenAIClient(reply="Token reply")
+        patcher = mock.patch("chat.views.GeminiService", lambda: GeminiService(client=self.fake))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = self.client.post("/api/users/", content_type="application/json").json()
+        self.other = self.client.post("/api/users/", content_type="application/json").json()
+
+    def auth(self, user):
+        return {"HTTP_AUTHORIZATION": f"Bearer {user['token']}"}
+
+    def chat(self, user_id, **headers):
+        return self.client.post(
+            "/api/chat/", {"user_id": user_id, "message": "hi"}, content_type="application/json", **headers
+        )
+
+    def test_api_skips_the_session_stack(self):
+        response = self.client.get(
+            f"/api/personas/{self.user['id']}/", HTTP_ACCEPT="text/html,*/*;q=0.8", **self.auth(self.user)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertNotIn("X-Frame-Options", response)
+        self.assertEqual(response["X-Content-Type-Options"], "nosniff")
+        self.assertFalse(response.cookies)
+
+        persona = Persona.objects.get(user_id=self.user["id"])
+        self.assertEqual(response.json(), json.loads(JSONRenderer().render(PersonaSerializer(persona).data)))
+
+        # The HTML pages keep theirs
+        response = self.client.get("/login/")
+        self.assertEqual(response["X-Frame-Options"], "DENY")
+        self.assertIn("csrftoken", response.cookies)
+
+    def test_token_must_belong_to_the_user(self):
+        self.assertEqual(self.chat(self.user["id"], **self.auth(self.user)).json()["reply"], "Token reply")
+        self.assertEqual(self.chat(self.user["id"], **self.auth(self.other)).status_code, 403)
+        self.assertEqual(self.chat(self.user["id"], HTTP_AUTHORIZATION="Bearer forged").status_code, 401)
+        for url in (f"/api/messages/{self.user['id']}/", f"/api/personas/{self.user['id']}/"):
+            self.assertEqual(self.client.get(url, **self.auth(self.user)).status_code, 200)
+            self.assertEqual(self.client.get(url, **self.auth(self.other)).status_code, 403)
+        response = self.client.post(
+            "/api/chat/async/", {"user_id": self.user["id"], "message": "hi"},
+            content_type="application/json", **self.auth(self.other),
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Message.objects.filter(user_id=self.user["id"]).count(), 2)
+
+    def test_tokens_are_optional_unless_required(self):
+        self.assertEqual(self.chat(self.user["id"]).status_code, 200)
+        with override_settings(CHAT_API={**settings.CHAT_API, "REQUIRE_TOKEN": True}):
+            self.assertEqual(self.chat(self.user["id"]).status_code, 401)
+            self.assertEqual(self.client.get(f"/api/messages/{self.user['id']}/").status_code, 401)
+            self.assertEqual(self.chat(self.user["id"], **self.auth(self.user)).status_code, 200)
+            # Signing up is how clients get a token
+            self.assertEqual(self.client.post("/api/users/", content_type="application/json").status_code, 201)
+
+    def test_full_stack_when_the_lean_path_is_off(self):
+        with override_settings(CHAT_API={**settings.CHAT_API, "LEAN_PATH": False}):
+            client = Client()
+            response = client.post(
+                "/api/chat/", {"user_id": self.user["id"], "message": "hi"},
+                content_type="application/json", **self.auth(self.user),
+            )
+            self.assertEqual(response.json()["reply"], "Token reply")
+            self.assertEqual(response["X-Frame-Options"], "DENY")
+
+    def test_command_issues_tokens_for_existing_users(self):
+        out = StringIO()
+        call_command("issue_api_token", self.user["username"], stdout=out)
+        token = out.getvalue().strip()
+        response = self.client.get(f"/api/messages/{self.user['id']}/", HTTP_AUTHORIZATION=f"Bearer {token}")
+        self.assertEqual(response.status_code, 200)
+
+    def test_fast_renderer_matches_drf_json(self):
+        data = {
+            "created_at": datetime(2025, 1, 2, 3, 4, 5, 678901, tzinfo=dt_timezone.utc),
+            "text": "caf\u00e9 \U0001f600", "count": 3, "nested": [None, True, 1.5],
+        }
+        self.assertEqual(json.loads(FastJSONRenderer().render(data)), json.loads(JSONRenderer().render(data)))
+
+
+class TrafficRecordingTests(TestCase):
+    def setUp(self):
+        self.fake = FakeGenAIClient(reply="Recorded reply", latency=0.01)
+        patcher = mock.patch("chat.views.GeminiService", lambda: GeminiService(client=self.fake))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = self.client.post("/api/users/", content_type="application/json").json()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = os.path.join(directory.name, "traffic.log")
+
+    def recording(self, **overrides):
+        return override_settings(CHAT_RECORDING={
+            **settings.CHAT_RECORDING, "ENABLED": True, "LOG": self.log, "SAMPLE_RATE": 1.0, **overrides,
+        })
+
+    def test_records_sampled_requests_with_upstream_time(self):
+        auth = {"HTTP_AUTHORIZATION": f"Bearer {self.user['token']}"}
+        with self.recording():
+            client = Client()
+            client.post(
+                "/api/chat/", {"user_id": self.user["id"], "message": "hi"}, content_type="application/json", **auth
+            )
+            client.get(f"/api/messages/{self.user['id']}/?limit=5", **auth)
+            client.post("/api/users/", content_type="application/json")
+
+        chat, history = read_log(self.log)
+        self.assertEqual((chat["method"], chat["path"], chat["status"]), ("POST", "/api/chat/", 200))
+        # Strings are stored as their length only
+        self.assertEqual(chat["body"], {"user_id": self.user["id"], "message": [2]})
+        self.assertGreaterEqual(chat["upstream_ms"], 10)
+        self.assertGreaterEqual(chat["duration_ms"], chat["upstream_ms"])
+        self.assertEqual(history["path"], f"/api/messages/{self.user['id']}/?limit=5")
+        self.assertIsNone(history["upstream_ms"])
+        self.assertIsNone(history["body"])
+
+    def test_stops_at_max_bytes(self):
+        with self.recording(MAX_BYTES=1):
+            Client().get(f"/api/personas/{self.user['id']}/")
+        self.assertEqual(read_log(self.log), [])
+
+    def test_replay_plan_maps_users_and_fills_in_text(self):
+        records = [
+            {"ts": 100.0, "method": "POST", "path": "/api/chat/", "status": 200, "duration_ms": 900.0,
+             "upstream_ms": 850.0, "body": {"user_id": 7, "message": [12]}},
+            {"ts": 101.5, "method": "GET", "path": "/api/personas/7/", "status": 200, "duration_ms": 3.0,
+             "upstream_ms": None, "body": None},
+        ]
+        chat, persona = replay_plan(records, {7: 42}, {42: "token"})
+        self.assertEqual(chat["body"]["user_id"], 42)
+        self.assertEqual(len(chat["body"]["message"]), 12)
+        self.assertEqual(chat["headers"], {"Authorization": "Bearer token"})
+        self.assertEqual((chat["endpoint"], chat["offset"]), ("chat", 0.0))
+        self.assertEqual((persona["path"], persona["endpoint"], persona["offset"]), ("/api/personas/42/", "personas", 1.5))
+
+    def test_fake_latency_follows_recorded_upstream(self):
+        with open(self.log, "w") as log:
+            log.write('[1.0,"POST","/api/chat/",200,260.0,250.0,null]\n')
+            log.write('[2.0,"GET","/api/messages/1/",200,4.0,null,null]\n')
+            log.write('[3.0,"POST","/api/chat/",200,510.0,500.0,null]\n')
+            log.write('[4.0,"POST","/api/ch')
+        sampler = upstream_sampler(self.log)
+        self.assertEqual({FakeGenAIClient(latency=sampler).delay() for _ in range(50)}, {0.25, 0.5})
+
+        with override_settings(GEMINI_BACKEND="fake", GEMINI_FAKE_LATENCY_LOG=self.log):
+            set_shared_client(None)
+            self.addCleanup(set_shared_client, None)
+            self.assertIn(get_shared_client().delay(), {0.25, 0.5})
+
+
+class ConcurrentSignupTests(TransactionTestCase):
+    def test_parallel_signups_get_unique_handles(self):
+        def signup(_):
+            try:
+                return provision_user().username
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            usernames = list(pool.map(signup, range(100)))
+
+        self.assertEqual(len(set(usernames)), 100)
+        self.assertEqual(User.objects.count(), 100)
+        self.assertEqual(Persona.objects.count(), 100)
+
+
+class StubSummarizer:
+    """Deterministic summarizer: appends folded messages to the summary"""
+
+    def __call__(self, previous_summary, messages):
+        return " | ".join(filter(None, [previous_summary] + [msg.message for msg in messages]))
+
+
+ROLLING_SUMMARY = {"ENABLED": True, "SUMMARIZER": "chat.tests.StubSummarizer", "BATCH_SIZE": 200, "MIN_MESSAGES": 1}
+
+
+@override_settings(CHAT_ROLLING_SUMMARY=ROLLING_SUMMARY)
+class RollingSummaryTests(TestCase):
+    def setUp(self):
+        get_prompt_cache().clear()
+        self.user = User.objects.create_user(username="summary_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        Message.objects.bulk_create(
+            Message(user=self.user, sender="user", message=f"m{i}") for i in range(10)
+        )
+        self.service = GeminiService(history_limit=4)
+
+    def boundary(self):
+        window = self.service.get_history_window(self.user)
+        return window[0].created_at, window[0].pk
+
+    def test_fold_summarizes_only_turns_outside_the_window(self):
+        with mock.patch("chat.gemini_service.schedule_fold"):
+            before = self.boundary()
+        self.assertEqual(fold_history(self.user.id, before), 6)
+        summary = ConversationSummary.objects.get(user=self.user)
+        self.assertEqual(summary.summary, "m0 | m1 | m2 | m3 | m4 | m5")
+
+    def test_fold_is_incremental(self):
+        with mock.patch("chat.gemini_service.schedule_fold"):
+            fold_history(self.user.id, self.boundary())
+            Message.objects.bulk_create(
+                Message(user=self.user, sender="ai", message=f"n{i}") for i in range(2)
+            )
+            before = self.boundary()
+        self.assertEqual(fold_history(self.user.id, before), 2)
+        self.assertEqual(fold_history(self.user.id, before), 0)
+        self.assertTrue(ConversationSummary.objects.get(user=self.user).summary.endswith("m5 | m6 | m7"))
+
+    def test_fold_waits_for_min_messages(self):
+        with mock.patch("chat.gemini_service.schedule_fold"):
+            fold_history(self.user.id, self.boundary())
+            Message.objects.bulk_create(
+                Message(user=self.user, sender="ai", message=f"n{i}") for i in range(2)
+            )
+            before = self.boundary()
+        # Two turns out of the window are not worth a model call yet
+        self.assertEqual(fold_history(self.user.id, before, min_messages=3), 0)
+        Message.objects.create(user=self.user, sender="user", message="n2")
+        with mock.patch("chat.gemini_service.schedule_fold"):
+            before = self.boundary()
+        self.assertEqual(fold_history(self.user.id, before, min_messages=3), 3)
+
+    def test_trimmed_window_schedules_background_fold(self):
+        with mock.patch("chat.gemini_service.schedule_fold") as schedule:
+            window = self.service.get_history_window(self.user)
+        schedule.assert_called_once_with(self.user.id, (window[0].created_at, window[0].pk))
+
+    def test_summary_is_added_to_the_prompt(self):
+        with mock.patch("chat.gemini_service.schedule_fold"):
+            fold_history(self.user.id, self.boundary())
+            prompt = self.service.prepare_prompt(User.objects.get(id=self.user.id))
+        self.assertIn("Earlier in this conversation:\nm0 | m1", prompt)
+        self.assertIn("User: m9", prompt)
+        self.assertNotIn("User: m5", prompt)
+
+    def test_gemini_summarizer_goes_through_the_guarded_path(self):
+        fake = FakeGenAIClient(reply=" Likes tea. ")
+        with mock.patch("chat.gemini_service.get_shared_client", return_value=fake), \
+                mock.patch.object(UpstreamGuard, "call", autospec=True, side_effect=lambda guard, fn, tokens=1: fn()) as call:
+            summary = GeminiSummarizer()("", [Message(sender="user", message="I like tea")])
+        self.assertEqual(summary, "Likes tea.")
+        call.assert_called_once()
+
+
+class ChatJobQueueTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="queued_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        self.other = User.objects.create_user(username="other_queued_user")
+        self.service = GeminiService(client=FakeGenAIClient(reply="Queued hello"))
+
+    def enqueue(self, user, message="hello"):
+        return self.client.post(
+            "/api/chat/",
+            {"user_id": user.id, "message": message, "mode": "queued"},
+            content_type="application/json",
+        )
+
+    def test_queued_mode_returns_job_immediately(self):
+        response = self.enqueue(self.user)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], ChatJob.QUEUED)
+        self.assertFalse(Message.objects.filter(user=self.user).exists())
+
+    @override_settings(CHAT_JOB_QUEUE={**settings.CHAT_JOB_QUEUE, "MAX_DEPTH": 2})
+    def test_full_queue_applies_backpressure(self):
+        self.enqueue(self.user)
+        self.enqueue(self.user)
+        response = self.enqueue(self.user)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+
+    def test_jobs_for_one_user_run_in_order(self):
+        first = self.enqueue(self.user, "first").json()["job_id"]
+        second = self.enqueue(self.user, "second").json()["job_id"]
+        other = self.enqueue(self.other, "other").json()["job_id"]
+
+        self.assertEqual(claim_next_job("w1").id, first)
+        # The user's second turn waits until the first one finished
+        self.assertEqual(claim_next_job("w2").id, other)
+        self.assertIsNone(claim_next_job("w3"))
+
+        run_job(ChatJob.objects.get(id=first), service=self.service)
+        self.assertEqual(claim_next_job("w3").id, second)
+
+    def test_completed_job_is_visible_to_polling(self):
+        job_id = self.enqueue(self.user).json()["job_id"]
+        run_job(claim_next_job(), service=self.service)
+
+        response = self.client.get(f"/api/chat/jobs/{job_id}/")
+        self.assertEqual(response.json()["status"], ChatJob.DONE)
+        self.assertEqual(response.json()["reply"], "Queued hello")
+
+    def test_failed_job_is_retried_with_backoff_then_fails(self):
+        job_id = self.enqueue(self.user).json()["job_id"]
+        broken = mock.Mock()
+        broken.chat.side_effect = RuntimeError("boom")
+
+        job = run_job(claim_next_job(), service=broken)
+        self.assertEqual(job.status, ChatJob.QUEUED)
+        self.assertGreater(job.available_at, job.started_at)
+        self.assertIsNone(claim_next_job())
+
+        ChatJob.objects.filter(id=job_id).update(
+            attempts=settings.CHAT_JOB_QUEUE["MAX_ATTEMPTS"] - 1, available_at=job.started_at
+        )
+        self.assertEqual(run_job(claim_next_job(), service=broken).status, ChatJob.FAILED)
+
+    def test_worker_requeues_stale_jobs_while_running(self):
+        stop = threading.Event()
+        with mock.patch("chat.jobs.claim_next_job", return_value=None), \
+                mock.patch("chat.jobs.requeue_stale_jobs", return_value=0) as requeue:
+            worker = threading.Thread(target=work, args=(stop,), kwargs={"poll_interval": 0.01, "requeue_interval": 0.02})
+            worker.start()
+            time.sleep(0.2)
+            stop.set()
+            worker.join()
+        # Not only when the worker started
+        self.assertGreater(requeue.call_count, 2)
+
+
+def make_guard(max_attempts=3, failure_threshold=5, recovery_timeout=30.0, requests_per_minute=0):
+    """Guard without real sleeps"""
+    async def no_sleep(_):
+        pass
+
+    return UpstreamGuard(
+        RateLimiter(requests_per_minute, 0),
+        RetryPolicy(max_attempts, base_delay=0.01),
+        CircuitBreaker(failure_threshold, recovery_timeout),
+        sleep=lambda _: None,
+        async_sleep=no_sleep,
+    )
+
+
+class UpstreamResilienceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="resilience_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        self.fake = FakeGenAIClient(reply="Recovered reply")
+        self.guard = make_guard()
+        patcher = mock.patch(
+            "chat.views.GeminiService", lambda: GeminiService(client=self.fake, guard=self.guard)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_chat(self):
+        return self.client.post(
+            "/api/chat/", {"user_id": self.user.id, "message": "hello"}, content_type="application/json"
+        )
+
+    def test_retryable_errors_are_retried(self):
+        self.fake.faults = [429, 503]
+        response = self.post_chat()
+        self.assertEqual(response.json(), {"reply": "Recovered reply"})
+        self.assertEqual(len(self.fake.calls), 3)
+
+    def test_exhausted_retries_return_503_and_persist_nothing(self):
+        self.fake.faults = [500, "timeout", 503]
+        response = self.post_chat()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()["error"], "server_error")
+        self.assertIn("Retry-After", response)
+        self.assertFalse(Message.objects.filter(user=self.user).exists())
+
+    def test_client_errors_are_not_retried(self):
+        self.fake.faults = [400]
+        with self.assertRaises(UpstreamError) as raised:
+            GeminiService(client=self.fake, guard=self.guard).generate_response("prompt")
+        self.assertEqual(raised.exception.kind, "client_error")
+        self.assertEqual(len(self.fake.calls), 1)
+
+    def test_circuit_opens_and_fails_fast(self):
+        self.guard = make_guard(max_attempts=1, failure_threshold=2)
+        self.fake.faults = [503, 503]
+        service = GeminiService(client=self.fake, guard=self.guard)
+        for prompt in ("a", "b"):
+            with self.assertRaises(UpstreamError):
+                service.generate_response(prompt)
+
+        with self.assertRaises(UpstreamError) as raised:
+            service.generate_response("c")
+        self.assertEqual(raised.exception.kind, "circuit_open")
+        self.assertEqual(len(self.fake.calls), 2)
+
+    def test_circuit_closes_after_successful_trial_call(self):
+        guard = make_guard(max_attempts=1, failure_threshold=1, recovery_timeout=0)
+        self.fake.faults = [503]
+        service = GeminiService(client=self.fake, guard=guard)
+        with self.assertRaises(UpstreamError):
+            service.generate_response("a")
+        self.assertEqual(guard.breaker.state, CircuitBreaker.OPEN)
+
+        self.assertEqual(service.generate_response("b"), "Recovered reply")
+        self.assertEqual(guard.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_rate_limiter_rejects_over_quota(self):
+        limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=0)
+        limiter.acquire()
+        limiter.acquire()
+        with self.assertRaises(UpstreamError) as raised:
+            limiter.acquire()
+        self.assertEqual(raised.exception.kind, "rate_limited")
+        self.assertGreater(raised.exception.retry_after, 0)
+
+    def test_local_rate_limit_does_not_trip_the_breaker(self):
+        guard = make_guard(failure_threshold=1, requests_per_minute=1)
+        service = GeminiService(client=self.fake, guard=guard)
+        service.generate_response("a")
+        before = UPSTREAM_ERRORS.value(kind="rate_limited")
+        with self.assertRaises(UpstreamError) as raised:
+            service.generate_response("b")
+        self.assertEqual(raised.exception.kind, "rate_limited")
+        self.assertEqual(guard.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(UPSTREAM_ERRORS.value(kind="rate_limited"), before)
+        self.assertEqual(len(self.fake.calls), 1)
+
+    def test_rate_limit_buckets_are_shared_rows_taken_in_one_query(self):
+        RateLimiter(requests_per_minute=2, tokens_per_minute=0).acquire()
+        # Another worker's limiter draws from the same row
+        limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=0)
+        with self.assertNumQueries(1):
+            limiter.acquire()
+        with self.assertRaises(UpstreamError):
+            limiter.acquire()
+        self.assertEqual(RateLimitBucket.objects.get().name, "default:requests")
+
+    async def test_async_rate_limiter_uses_the_async_orm(self):
+        limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=0)
+        with mock.patch.object(TokenBucket, "try_acquire", side_effect=AssertionError("blocking call")):
+            await limiter.aacquire()
+            await limiter.aacquire()
+            with self.assertRaises(UpstreamError) as raised:
+                await limiter.aacquire()
+        self.assertEqual(raised.exception.kind, "rate_limited")
+        # Both APIs draw from the same bucket
+        with self.assertRaises(UpstreamError):
+            await sync_to_async(limiter.acquire)()
+
+    async def test_cancelled_half_open_trial_releases_the_breaker(self):
+        guard = make_guard(failure_threshold=1, recovery_timeout=0.0)
+        guard.breaker.record_failure()
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(10)
+
+        # The losing leg of a hedged call is cancelled mid-trial
+        trial = asyncio.ensure_future(guard.acall(slow))
+        await started.wait()
+        self.assertEqual(guard.breaker.state, CircuitBreaker.HALF_OPEN)
+        trial.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await trial
+        self.assertEqual(guard.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(guard.breaker.failures, 1)
+
+        async def ok():
+            return "ok"
+
+        self.assertEqual(await guard.acall(ok), "ok")
+        self.assertEqual(guard.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_stream_retries_before_first_chunk(self):
+        self.fake.faults = ["timeout"]
+        chunks = list(GeminiService(client=self.fake, guard=self.guard).stream_chat(self.user, "hello"))
+        self.assertEqual("".join(chunks), "Recovered reply")
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 2)
+
+    def test_stream_failure_sends_error_event_and_persists_nothing(self):
+        self.fake.faults = [503, 503, 503]
+        response = self.client.post(
+            "/api/chat/stream/", {"user_id": self.user.id, "message": "hello"}, content_type="application/json"
+        )
+        body = b"".join(response.streaming_content).decode()
+        self.assertIn("event: error", body)
+        self.assertNotIn("event: done", body)
+        self.assertFalse(Message.objects.filter(user=self.user).exists())
+
+    async def test_async_chat_returns_503(self):
+        self.fake.faults = [429, 429, 429]
+        response = await self.async_client.post(
+            "/api/chat/async/", {"user_id": self.user.id, "message": "hello"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(await Message.objects.filter(user=self.user).aexists())
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="metrics_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        self.fake = FakeGenAIClient(reply="Measured reply")
+        patcher = mock.patch("chat.views.GeminiService", lambda: GeminiService(client=self.fake, guard=make_guard()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_chat(self):
+        return self.client.post(
+            "/api/chat/", {"user_id": self.user.id, "message": "hello"}, content_type="application/json"
+        )
+
+    def test_turn_query_budget_per_stage(self):
+        get_prompt_cache().clear()
+        get_memory_index().clear()
+        user = User.objects.get(id=self.user.id)
+        with capture_turn() as turn:
+            GeminiService(client=self.fake, guard=make_guard()).chat(user, "hello")
+
+        self.assertEqual(set(turn.stages), {"prefix", "memories", "history", "render", "model", "save"})
+        # Persona and the memory index are cached after the first turn
+        self.assertEqual(turn.queries["prefix"], 1)
+        self.assertEqual(turn.queries["memories"], 1)
+        self.assertEqual(turn.queries["history"], 1)
+        self.assertNotIn("model", turn.queries)
+        self.assertEqual(turn.sizes["reply_chars"], len("Measured reply"))
+
+        with capture_turn() as turn:
+            GeminiService(client=self.fake, guard=make_guard()).chat(self.user, "again")
+        self.assertNotIn("prefix", turn.queries)
+        self.assertNotIn("memories", turn.queries)
+
+    @override_settings(CHAT_METRICS={**settings.CHAT_METRICS, "ENABLED": True, "LOG_REQUESTS": True})
+    def test_requests_are_exported_and_logged(self):
+        with self.assertLogs("chat.metrics", level="INFO") as logs:
+            self.post_chat()
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line["view"], "chat-list")
+        self.assertEqual(line["status"], 200)
+        self.assertIn("model", line["stages_ms"])
+        self.assertEqual(line["queries"], sum(line["stage_queries"].values()))
+
+        body = self.client.get("/metrics").content.decode()
+        self.assertIn('chat_stage_duration_seconds_count{stage="model"}', body)
+        self.assertIn('chat_request_duration_seconds_count{view="chat-list",method="POST",status="200"}', body)
+        self.assertIn("# TYPE chat_prompt_tokens histogram", body)
+
+    @override_settings(CHAT_METRICS={**settings.CHAT_METRICS, "ENABLED": True, "LOG_REQUESTS": False})
+    def test_upstream_errors_are_counted_by_class(self):
+        before = UPSTREAM_ERRORS.value(kind="rate_limited")
+        self.fake.faults = [429]
+        self.post_chat()
+        self.assertEqual(UPSTREAM_ERRORS.value(kind="rate_limited"), before + 1)
+
+    def test_metrics_are_summed_over_worker_processes(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(CHAT_METRICS={
+            **settings.CHAT_METRICS, "ENABLED": True, "LOG_REQUESTS": False, "MULTIPROCESS_DIR": directory,
+        }))
+        self.post_chat()
+        count = REQUEST_DURATION.snapshot()[("chat-list", "POST", "200")][2]
+        # Another worker that served the same requests
+        write_process_metrics()
+        os.replace(os.path.join(directory, f"{os.getpid()}.json"), os.path.join(directory, "1.json"))
+
+        body = self.client.get("/metrics").content.decode()
+        self.assertIn(
+            f'chat_request_duration_seconds_count{{view="chat-list",method="POST",status="200"}} {2 * count}', body
+        )
+        clear_process_metrics()
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_metrics_endpoint_disabled_by_default(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+
+class BenchmarkSmokeTests(TransactionTestCase):
+    """Every `manage.py benchmark` scenario runs (the writes one commits, hence no TestCase)"""
+
+    def test_every_scenario_runs_once(self):
+        for name, scenario in SCENARIOS.items():
+            with self.subTest(scenario=name):
+                rows = scenario(sizes=[5], turns=2, users=1, latency=0.0, reply_chars=20)
+                self.assertTrue(rows)
+
+
+class BenchmarkSuiteTests(TestCase):
+    def test_api_scenario_reports_every_endpoint(self):
+        rows = bench_api(sizes=[10], turns=2, users=2, reply_chars=50)
+        self.assertEqual(
+            [row["endpoint"] for row in rows],
+            ["POST /api/chat/", "GET /api/messages/<id>/", "GET /api/personas/<id>/", "GET /api/personas/"],
+        )
+        for row in rows:
+            self.assertGreater(row["requests_per_sec"], 0)
+            self.assertGreaterEqual(row["p99_ms"], row["p50_ms"])
+            self.assertGreaterEqual(row["queries_per_request"], 1)
+        self.assertFalse(User.objects.filter(username__startswith="bench_").exists())
+
+    def test_overhead_scenario_compares_request_and_direct_call(self):
+        rows = bench_overhead(turns=3)
+        self.assertEqual(
+            [(row["stack"], row["path"]) for row in rows],
+            [
+                (stack, path) for stack in ("full", "lean")
+                for path in ("POST /api/chat/", "GeminiService.chat()", "overhead")
+            ],
+        )
+        self.assertAlmostEqual(rows[2]["p50_us"], rows[0]["p50_us"] - rows[1]["p50_us"])
+        self.assertFalse(User.objects.filter(username__startswith="bench_").exists())
+
+    def test_baseline_diff_flags_regressions(self):
+        baseline = [{"messages": 10, "endpoint": "GET /x", "requests_per_sec": 100.0, "p50_ms": 2.0}]
+        current = [{"messages": 10, "endpoint": "GET /x", "requests_per_sec": 70.0, "p50_ms": 2.1}]
+        rows, regressions = diff_rows(baseline, current, threshold=0.2)
+        self.assertEqual(rows[0]["p50_ms_change"], "+5.0%")
+        self.assertEqual(regressions, [((10, "GET /x"), "requests_per_sec")])
+
+
+class MemoryRetrievalTests(TestCase):
+    def setUp(self):
+        get_prompt_cache().clear()
+        get_memory_index().clear()
+        self.user = User.objects.create_user(username="memory_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        Memory.objects.bulk_create(
+            Memory(user=self.user, key=f"fact_{i}", value=f"unrelated detail number {i}") for i in range(50)
+        )
+        Memory.objects.create(user=self.user, key="favourite_food", value="spicy ramen noodles")
+        Memory.objects.create(user=self.user, key="pet", value="a grey cat called Miso")
+        self.service = GeminiService()
+
+    @override_settings(CHAT_MEMORY_RETRIEVAL={**settings.CHAT_MEMORY_RETRIEVAL, "TOP_K": 3})
+    def test_only_relevant_memories_are_injected(self):
+        prompt = self.service.prepare_prompt(self.user, "I want to cook ramen noodles tonight")
+        self.assertIn("favourite_food: spicy ramen noodles", prompt)
+        memory_lines = prompt.split("Memory:\n", 1)[1].split("\n\n", 1)[0].splitlines()
+        self.assertEqual(len(memory_lines), 3)
+        self.assertEqual(memory_lines[0], "favourite_food: spicy ramen noodles")
+
+        prompt = self.service.prepare_prompt(self.user, "my cat Miso knocked over a glass")
+        self.assertIn("pet: a grey cat called Miso", prompt)
+        self.assertNotIn("ramen", prompt)
+
+    @override_settings(CHAT_MEMORY_RETRIEVAL={**settings.CHAT_MEMORY_RETRIEVAL, "TOP_K": 1})
+    def test_index_follows_memory_saves_and_deletes(self):
+        self.service.prepare_prompt(self.user, "warm up")
+        memory = Memory.objects.create(user=self.user, key="hobby", value="bouldering at the climbing gym")
+        with self.assertNumQueries(0):
+            get_memory_index().for_user(self.user.id)
+        self.assertIn("hobby: bouldering", self.service.prepare_prompt(self.user, "going climbing"))
+
+        memory.value = "oil painting landscapes"
+        memory.save()
+        self.assertIn("hobby: oil painting", self.service.prepare_prompt(self.user, "painting landscapes"))
+
+        memory.delete()
+        self.assertNotIn("hobby", self.service.prepare_prompt(self.user, "painting landscapes"))
+
+    def test_small_memory_sets_are_injected_whole_in_order(self):
+        index = MemoryIndex(HashedNgramEmbedder(), [(1, "a", "first"), (2, "b", "second")])
+        self.assertEqual(index.search("second", 8), [("a", "first"), ("b", "second")])
+
+    def test_retrieval_under_a_millisecond_at_10k_memories(self):
+        rows = [(i, f"fact_{i}", f"the user mentioned topic {i} on day {i % 365}") for i in range(10_000)]
+        index = MemoryIndex(HashedNgramEmbedder(), rows)
+        index.search("what about topic 42", 8)
+        timings = []
+        for _ in range(50):
+            start = time.perf_counter()
+            index.search("what about topic 42", 8)
+            timings.append(time.perf_counter() - start)
+        self.assertLess(sorted(timings)[len(timings) // 2], 0.001)
+
+    @override_settings(CHAT_MEMORY_RETRIEVAL={**settings.CHAT_MEMORY_RETRIEVAL, "ENABLED": False})
+    def test_disabled_retrieval_keeps_every_memory_in_the_prefix(self):
+        prompt = self.service.prepare_prompt(self.user, "ramen")
+        self.assertIn("fact_49: unrelated detail number 49", prompt)
+        self.assertIn("pet: a grey cat called Miso", prompt)
+
+
+class MemoryExtractionTests(TestCase):
+    def setUp(self):
+        get_prompt_cache().clear()
+        get_memory_index().clear()
+        self.user = User.objects.create_user(username="extraction_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+
+    def say(self, *texts):
+        Message.objects.bulk_create(Message(user=self.user, sender="user", message=text) for text in texts)
+
+    def memories(self):
+        return dict(Memory.objects.filter(user=self.user).values_list("key", "value"))
+
+    def test_rule_based_extractor(self):
+        facts = RuleBasedExtractor()([
+            Message(message="Hi! My name is Sam and I live in Lisbon."),
+            Message(message="My favourite food is spicy ramen, and my cat is called Miso."),
+            Message(message="I'm 29 years old. I really love hiking. I like you!"),
+        ])
+        self.assertEqual(facts, {
+            "name": "Sam",
+            "location": "Lisbon",
+            "favourite_food": "spicy ramen",
+            "cat_name": "Miso",
+            "age": "29",
+            "likes_hiking": "hiking",
+        })
+
+    def test_extraction_upserts_and_only_reads_new_messages(self):
+        Memory.objects.create(user=self.user, key="location", value="Porto")
+        self.say("I live in Lisbon", "how are you?")
+        self.assertEqual(extract_memories(self.user.id), 2)
+        self.assertEqual(self.memories(), {"location": "Lisbon"})
+        self.assertEqual(extract_memories(self.user.id), 0)
+
+        Message.objects.create(user=self.user, sender="ai", message="My name is Ava")
+        self.say("Actually I live in Madrid. My name is Sam")
+        self.assertEqual(extract_memories(self.user.id), 1)
+        self.assertEqual(self.memories(), {"location": "Madrid", "name": "Sam"})
+
+    def test_extracted_memories_reach_the_next_prompt(self):
+        service = GeminiService()
+        service.prepare_prompt(self.user, "hi")
+        self.say("My dog is called Rex")
+        extract_memories(self.user.id)
+        self.assertIn("dog_name: Rex", service.prepare_prompt(User.objects.get(id=self.user.id), "walk the dog"))
+
+    @override_settings(CHAT_MEMORY_EXTRACTION={**settings.CHAT_MEMORY_EXTRACTION, "MIN_MESSAGES": 3})
+    def test_waits_for_a_full_batch(self):
+        self.say("I live in Lisbon", "ok")
+        self.assertEqual(extract_memories(self.user.id), 0)
+        self.assertFalse(MemoryExtractionState.objects.get(user=self.user).extracted_until)
+        self.say("cool")
+        self.assertEqual(extract_memories(self.user.id), 3)
+
+    @override_settings(CHAT_MEMORY_EXTRACTION={**settings.CHAT_MEMORY_EXTRACTION, "ENABLED": True})
+    def test_turns_schedule_extraction_off_the_request_path(self):
+        with mock.patch("chat.gemini_service.schedule_extraction") as schedule:
+            GeminiService(client=FakeGenAIClient(), guard=make_guard()).chat(self.user, "I live in Lisbon")
+        schedule.assert_called_once_with(self.user.id)
+
+    def test_gemini_extractor_parses_json_reply(self):
+        fake = FakeGenAIClient(reply='```json\n{"Home City": "Lisbon", "pet": ""}\n```')
+        with mock.patch("chat.gemini_service.get_shared_client", return_value=fake):
+            facts = GeminiExtractor()([Message(message="I live in Lisbon")])
+        self.assertEqual(facts, {"home_city": "Lisbon"})
+
+
+class ModelRoutingTests(TestCase):
+    def setUp(self):
+        reset_route_stats()
+        self.fast = FakeGenAIClient(reply="fast reply")
+        self.strong = FakeGenAIClient(reply="strong reply")
+        self.router = Router(
+            [
+                Route("fast", GenAIProvider(self.fast), "fast-model", 0.1, 0.4),
+                Route("strong", GenAIProvider(self.strong), "strong-model", 1.0, 4.0),
+            ],
+            {
+                "DEFAULT": "fast",
+                "LONG_ROUTE": "strong",
+                "LONG_PROMPT_TOKENS": 100,
+                "COMPLEX_ROUTE": "strong",
+                "COMPLEX_PATTERN": r"\bexplain\b",
+                "FALLBACKS": {"fast": ["strong"], "strong": ["fast"]},
+                "HEDGE": {"ENABLED": True, "PERCENTILE": 95, "MIN_SAMPLES": 5},
+            },
+            guard=make_guard(max_attempts=1),
+        )
+        self.service = GeminiService(router=self.router)
+
+    def test_policy_routes_by_size_and_complexity(self):
+        self.assertEqual(self.service.generate_response("short prompt", "hi"), "fast reply")
+        self.assertEqual(self.service.generate_response("x" * 500, "hi"), "strong reply")
+        self.assertEqual(self.service.generate_response("short prompt", "Explain tides?"), "strong reply")
+        self.assertEqual(self.fast.calls[0]["model"], "fast-model")
+        self.assertEqual(self.strong.calls[0]["model"], "strong-model")
+
+    def test_fails_over_to_the_fallback_route(self):
+        self.fast.faults = [503]
+        self.assertEqual(self.service.generate_response("prompt"), "strong reply")
+        stats = self.router.stats()
+        self.assertEqual((stats["fast"]["failures"], stats["strong"]["calls"]), (1, 1))
+
+    def test_all_routes_failing_raises(self):
+        self.fast.faults = [503]
+        self.strong.faults = [500]
+        with self.assertRaises(UpstreamError):
+            self.service.generate_response("prompt")
+
+    def test_slow_primary_is_hedged(self):
+        for _ in range(5):
+            route_stats("fast").record("fast", 0.01, True)
+        self.fast.latency = 0.5
+        start = time.perf_counter()
+        self.assertEqual(self.service.generate_response("prompt"), "strong reply")
+        self.assertLess(time.perf_counter() - start, 0.4)
+        self.assertEqual(route_stats("fast").hedges, 1)
+
+    def test_busy_hedge_pool_calls_without_queueing(self):
+        for _ in range(5):
+            route_stats("fast").record("fast", 0.01, True)
+        self.fast.latency = 0.2
+        # No thread free for the primary: it runs on the calling thread
+        with mock.patch("chat.routing._hedge_pool", HedgePool(0)):
+            self.assertEqual(self.service.generate_response("prompt"), "fast reply")
+        # One thread, taken by the primary: the backup is not started
+        with mock.patch("chat.routing._hedge_pool", HedgePool(1)):
+            self.assertEqual(self.service.generate_response("prompt"), "fast reply")
+        self.assertEqual(route_stats("fast").hedges, 0)
+        self.assertFalse(self.strong.calls)
+
+    async def test_async_hedge_cancels_the_slow_call(self):
+        for _ in range(5):
+            route_stats("fast").record("fast", 0.01, True)
+        self.fast.latency = 5
+        start = time.perf_counter()
+        self.assertEqual(await self.service.agenerate_response("prompt"), "strong reply")
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_cost_is_tracked_per_route(self):
+        self.service.generate_response("p" * 400)
+        self.assertAlmostEqual(route_stats("strong").cost, (100 * 1.0 + 3 * 4.0) / 1000)
+
+    def test_stream_fails_over_before_first_chunk(self):
+        self.fast.faults = ["timeout"]
+        self.assertEqual("".join(self.service.stream_response("prompt")), "strong reply")
+
+
+class FakeSocket:
+    """In-memory ASGI websocket peer"""
+
+    def __init__(self, query=""):
+        self.scope = {"type": "websocket", "path": "/ws/chat/", "query_string": query.encode()}
+        self.inbox = asyncio.Queue()
+        self.outbox = asyncio.Queue()
+        self.inbox.put_nowait({"type": "websocket.connect"})
+
+    async def receive(self):
+        return await self.inbox.get()
+
+    async def send(self, event):
+        await self.outbox.put(event)
+
+    def push(self, frame):
+        self.inbox.put_nowait({"type": "websocket.receive", "text": json.dumps(frame)})
+
+    def disconnect(self):
+        self.inbox.put_nowait({"type": "websocket.disconnect", "code": 1000})
+
+    async def event(self):
+        return await asyncio.wait_for(self.outbox.get(), timeout=5)
+
+    async def frame(self):
+        return json.loads((await self.event())["text"])
+
+    async def reply(self):
+        """Chunks until the turn's done (or error) frame"""
+        chunks = []
+        while (frame := await self.frame())["type"] == "chunk":
+            chunks.append(frame["chunk"])
+        return "".join(chunks), frame
+
+
+@override_settings(CHAT_WEBSOCKET={"PATH": "/ws/chat/", "HEARTBEAT": 5, "IDLE_TIMEOUT": 10, "REPLAY_LIMIT": 50})
+class WebSocketChatTests(TestCase):
+    def setUp(self):
+        get_prompt_cache().clear()
+        get_memory_index().clear()
+        self.user = User.objects.create_user(username="socket_user")
+        Persona.objects.create(
+            user=self.user, name="Ava", role="friend", personality="caring", tone="sweet"
+        )
+        self.history = Message.objects.bulk_create(
+            Message(user=self.user, sender="user" if i % 2 == 0 else "ai", message=f"earlier {i}") for i in range(5)
+        )
+        self.fake = FakeGenAIClient(reply="Hi from the socket")
+        self.service = GeminiService(client=self.fake, guard=make_guard(max_attempts=1))
+        # Like django.test.Client: keep the test transaction's connection open
+        for signal in (signals.request_started, signals.request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+
+    async def connect(self, query=None):
+        socket = FakeSocket(f"user_id={self.user.id}" if query is None else query)
+        self.task = asyncio.ensure_future(ChatConnection(socket.scope, socket.receive, socket.send, self.service).run())
+        self.assertEqual((await socket.event())["type"], "websocket.accept")
+        return socket
+
+    async def close(self, socket):
+        socket.disconnect()
+        await asyncio.wait_for(self.task, timeout=5)
+
+    async def test_streams_turns_from_the_session(self):
+        socket = await self.connect()
+        ready = await socket.frame()
+        self.assertEqual([msg["message"] for msg in ready["messages"]], [f"earlier {i}" for i in range(5)])
+        self.assertTrue(ready["complete"])
+
+        socket.push({"type": "message", "message": "first"})
+        reply, done = await socket.reply()
+        self.assertEqual((reply, done["type"], done["reply"]), ("Hi from the socket", "done", "Hi from the socket"))
+        self.assertEqual([msg["sender"] for msg in done["messages"]], ["user", "ai"])
+        self.assertTrue(all(msg["id"] for msg in done["messages"]))
+
+        socket.push({"type": "message", "message": "second"})
+        await socket.reply()
+        # The second prompt comes from the in-memory window, first turn included
+        self.assertIn("User: first\nAva: Hi from the socket\n", self.fake.calls[-1]["contents"])
+        await self.close(socket)
+        self.assertEqual(await Message.objects.filter(user=self.user).acount(), 9)
+
+    async def test_turn_costs_one_insert(self):
+        with capture_turn() as turn:
+            socket = await self.connect()
+            await socket.frame()
+            before = turn.total_queries
+            socket.push({"type": "message", "message": "hello"})
+            await socket.reply()
+            self.assertEqual(turn.total_queries - before, 1)
+            await self.close(socket)
+
+    async def test_token_must_belong_to_the_user(self):
+        socket = await self.connect(f"user_id={self.user.id}&token={issue_token(self.user.id)}")
+        self.assertEqual((await socket.frame())["type"], "ready")
+        await self.close(socket)
+
+        socket = await self.connect(f"user_id={self.user.id}&token={issue_token(self.user.id + 1)}")
+        self.assertEqual(await socket.frame(), {"type": "error", "detail": "This token does not belong to that user"})
+        self.assertEqual(await socket.event(), {"type": "websocket.close", "code": CLOSE_UNAUTHORIZED})
+        await asyncio.wait_for(self.task, timeout=5)
+
+    async def test_resume_replays_only_unseen_messages(self):
+        socket = await self.connect(f"user_id={self.user.id}&after={self.history[2].id}")
+        ready = await socket.frame()
+        self.assertEqual([msg["id"] for msg in ready["messages"]], [msg.id for msg in self.history[3:]])
+        self.assertTrue(ready["complete"])
+        await self.close(socket)
+
+    @override_settings(CHAT_WEBSOCKET={"PATH": "/ws/chat/", "HEARTBEAT": 5, "IDLE_TIMEOUT": 10, "REPLAY_LIMIT": 2})
+    async def test_resume_reports_a_gap_beyond_the_replay_limit(self):
+        socket = await self.connect(f"user_id={self.user.id}&after={self.history[0].id}")
+        ready = await socket.frame()
+        self.assertEqual([msg["id"] for msg in ready["messages"]], [msg.id for msg in self.history[3:]])
+        self.assertFalse(ready["complete"])
+        await self.close(socket)
+
+    @override_settings(CHAT_WEBSOCKET={"PATH": "/ws/chat/", "HEARTBEAT": 0.05, "IDLE_TIMEOUT": 0.1, "REPLAY_LIMIT": 50})
+    async def test_heartbeat_and_idle_close(self):
+        socket = await self.connect()
+        await socket.frame()
+        socket.push({"type": "ping"})
+        self.assertEqual(await socket.frame(), {"type": "pong"})
+        self.assertEqual(await socket.frame(), {"type": "ping"})
+        self.assertEqual(await socket.event(), {"type": "websocket.close", "code": CLOSE_IDLE})
+        await asyncio.wait_for(self.task, timeout=5)
+
+    async def test_upstream_error_keeps_the_socket_open(self):
+        self.fake.faults = [503]
+        socket = await self.connect()
+        await socket.frame()
+        socket.push({"type": "message", "message": "hello"})
+        _, error = await socket.reply()
+        self.assertEqual((error["type"], error["error"]), ("error", "server_error"))
+
+        socket.push({"type": "message", "message": "again"})
+        reply, _ = await socket.reply()
+        self.assertEqual(reply, "Hi from the socket")
+        await self.close(socket)
+        self.assertEqual(await Message.objects.filter(user=self.user).acount(), 7)
+
+    async def test_unknown_user_is_closed(self):
+        socket = await self.connect("user_id=999999")
+        self.assertEqual((await socket.frame())["type"], "error")
+        self.assertEqual(await socket.event(), {"type": "websocket.close", "code": CLOSE_NOT_FOUND})
+        await asyncio.wait_for(self.task, timeout=5)
+
+    def test_each_connection_gets_its_own_orm_thread(self):
+        threads = []
+
+        async def run(connection):
+            threads.append(await sync_to_async(threading.get_ident)())
+            # Still connected while the other socket runs its queries
+            await asyncio.sleep(0.05)
+            threads.append(await sync_to_async(threading.get_ident)())
+
+        async def serve_two():
+            await asyncio.gather(*(
+                websocket_application(socket.scope, socket.receive, socket.send)
+                for socket in (FakeSocket(), FakeSocket())
+            ))
+
+        # A loop of its own, like the server's: under an async test the
+        # test's thread would take every thread-sensitive call
+        with mock.patch.object(ChatConnection, "run", run), ThreadPoolExecutor(1) as loop_thread:
+            loop_thread.submit(asyncio.run, serve_two()).result()
+        first, second, first_again, second_again = threads
+        self.assertNotEqual(first, second)
+        self.assertEqual((first, second), (first_again, second_again))
+
+    async def test_other_paths_are_rejected(self):
+        socket = FakeSocket()
+        socket.scope["path"] = "/ws/other/"
+        await websocket_application(socket.scope, socket.receive, socket.send)
+        self.assertEqual(await socket.event(), {"type": "websocket.close"})
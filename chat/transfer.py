@@ -0,0 +1,283 @@
+"""Streaming NDJSON export and import of conversations
+
+One JSON object per line, tagged with its "type": user, persona, memory,
+then message (archived messages first, see chat/archive.py), each grouped
+by user (per shard, see chat/sharding.py) and in history order. Every
+table is read with a server-side cursor (.iterator(chunk_size)), and the
+output is gzip-compressed incrementally, so memory stays flat however many
+rows are exported.
+
+Import reads the same format (gzip or plain) line by line and writes
+bulk_create batches. Users are matched by username and created if
+missing. Personas and memories are upserted. Messages keep their exported
+id, and a message already there (same user, created_at and sender) is
+skipped, so re-running an interrupted import is safe. Every shard has its
+own id sequence, so an id can also belong to another message (another
+user's, or one from another shard in the same export); such messages get
+a fresh id instead, and the users they belong to are logged. With new_ids
+every message gets a fresh id, for merging into a database that already
+uses those ids.
+"""
+import gzip
+import io
+import json
+import logging
+import zlib
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, reset_queries
+from django.utils.dateparse import parse_datetime
+
+from .archive import unpack
+from .models import Memory, Message, MessageArchive, Persona
+from .sharding import all_shards, by_shard, place_users
+
+
+logger = logging.getLogger(__name__)
+
+PERSONA_FIELDS = ('name', 'role', 'personality', 'tone', 'likes', 'dislikes')
+
+
+def export_records(user_ids=None, chunk_size=None):
+    """Yield every exported record as a dict, table by table"""
+    chunk_size = chunk_size or settings.CHAT_TRANSFER['CHUNK_SIZE']
+
+    def scoped(queryset, field='user_id'):
+        return queryset.filter(**{f'{field}__in': user_ids}) if user_ids is not None else queryset
+
+    for user_id, username in scoped(User.objects.order_by('id'), 'id').values_list('id', 'username').iterator(chunk_size):
+        yield {'type': 'user', 'id': user_id, 'username': username}
+
+    shards = all_shards()
+    for alias in shards:
+        personas = scoped(Persona.objects.using(alias).order_by('user_id')).values('user_id', *PERSONA_FIELDS)
+        for row in personas.iterator(chunk_size):
+            yield {'type': 'persona', 'user': row.pop('user_id'), **row}
+
+    for alias in shards:
+        memories = scoped(Memory.objects.using(alias).order_by('user_id', 'id')).values_list('user_id', 'key', 'value')
+        for user_id, key, value in memories.iterator(chunk_size):
+            yield {'type': 'memory', 'user': user_id, 'key': key, 'value': value}
+
+    for alias in shards:
+        # Blocks are a few hundred KB each; fetch them a handful at a time
+        blocks = scoped(MessageArchive.objects.using(alias).order_by('user_id', 'last_created_at', 'last_id'))
+        for user_id, data in blocks.values_list('user_id', 'data').iterator(chunk_size=4):
+            for row in unpack(data):
+                yield {'type': 'message', 'user': user_id, **row}
+
+    for alias in shards:
+        messages = scoped(Message.objects.using(alias).order_by('user_id', 'created_at', 'id'))
+        for row in messages.values('id', 'user_id', 'sender', 'message', 'created_at').iterator(chunk_size):
+            yield {'type': 'message', 'user': row.pop('user_id'), **row}
+
+
+def _isoformat(value):
+    # Full precision: DjangoJSONEncoder drops microseconds, which order messages
+    return value.isoformat()
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield (json.dumps(record, default=_isoformat, ensure_ascii=False) + "\n").encode()
+
+
+def gzip_stream(chunks, flush_bytes=64 * 1024):
+    """Gzip a byte stream incrementally, yielding roughly flush_bytes pieces"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    pending = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= flush_bytes:
+            out = compressor.compress(b"".join(pending))
+            pending, size = [], 0
+            if out:
+                yield out
+    yield compressor.compress(b"".join(pending)) + compressor.flush()
+
+
+def export_ndjson_gz(user_ids=None, chunk_size=None):
+    """The export as gzip-compressed NDJSON chunks"""
+    return gzip_stream(ndjson_lines(export_records(user_ids, chunk_size)))
+
+
+def open_ndjson(stream):
+    """Line iterator over a binary stream, gunzipping it if needed"""
+    head = stream.read(2)
+    stream = io.BufferedReader(_Prefixed(head, stream))
+    if head == b"\x1f\x8b":
+        stream = gzip.GzipFile(fileobj=stream)
+    for line in stream:
+        if line.strip():
+            yield line
+
+
+class _Prefixed(io.RawIOBase):
+    """A stream with bytes already read from it put back in front"""
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.head:
+            data, self.head = self.head[:len(buffer)], self.head[len(buffer):]
+        else:
+            data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class Importer:
+    """Writes exported records back in bulk_create batches"""
+
+    def __init__(self, batch_size=None, new_ids=False):
+        self.batch_size = batch_size or settings.CHAT_TRANSFER['BATCH_SIZE']
+        self.new_ids = new_ids
+        # Exported user id -> local user id
+        self.user_ids = {}
+        self.pending = {'user': [], 'persona': [], 'memory': [], 'message': []}
+        # Rows written per type; 'skipped' messages were already there and
+        # 'renumbered' ones were inserted with a fresh id
+        self.counts = {**dict.fromkeys(self.pending, 0), 'skipped': 0, 'renumbered': 0}
+        # Local ids of the users with renumbered messages
+        self.renumbered_users = set()
+
+    def add(self, record):
+        kind = record.get('type')
+        if kind not in self.pending:
+            raise ValueError(f"Unknown record type: {kind!r}")
+        if kind != 'user':
+            # Users come first in an export; resolve them before their rows
+            self.flush('user')
+        self.pending[kind].append(record)
+        if len(self.pending[kind]) >= self.batch_size:
+            self.flush(kind)
+
+    def run(self, lines):
+        for number, line in enumerate(lines, 1):
+            try:
+                self.add(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"Line {number}: {e}") from e
+        self.finish()
+        if self.renumbered_users:
+            logger.warning(
+                "Import gave %d messages fresh ids (their ids belong to other messages); users: %s",
+                self.counts['renumbered'], ", ".join(map(str, sorted(self.renumbered_users))),
+            )
+        return self.counts
+
+    def finish(self):
+        for kind in self.pending:
+            self.flush(kind)
+        if not self.new_ids and self.counts['message']:
+            # Explicit ids leave the id sequence behind on e.g. Postgres
+            for alias in all_shards():
+                connection = connections[alias or DEFAULT_DB_ALIAS]
+                with connection.cursor() as cursor:
+                    for sql in connection.ops.sequence_reset_sql(no_style(), [Message]):
+                        cursor.execute(sql)
+
+    def flush(self, kind):
+        records = self.pending[kind]
+        if records:
+            self.pending[kind] = []
+            getattr(self, f'_write_{kind}')(records)
+            # With DEBUG on, every bulk insert's SQL would stay in connection.queries
+            reset_queries()
+
+    def user(self, exported_id):
+        try:
+            return self.user_ids[exported_id]
+        except KeyError:
+            raise KeyError(f"user {exported_id} is not in the import") from None
+
+    def _write_user(self, records):
+        usernames = {record['username'] for record in records}
+        existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        User.objects.bulk_create(
+            [User(username=username, password=make_password(None)) for username in usernames - existing],
+            ignore_conflicts=True,
+        )
+        place_users(User.objects.filter(username__in=usernames - existing).only('id', 'username'))
+        local = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+        for record in records:
+            self.user_ids[record['id']] = local[record['username']]
+        self.counts['user'] += len(records)
+
+    def _write_persona(self, records):
+        personas = [
+            Persona(user_id=self.user(record['user']), **{f: record.get(f) for f in PERSONA_FIELDS}) for record in records
+        ]
+        for alias, group in by_shard(personas).items():
+            Persona.objects.using(alias).bulk_create(
+                group, update_conflicts=True, unique_fields=['user'], update_fields=list(PERSONA_FIELDS),
+            )
+        self.counts['persona'] += len(personas)
+
+    def _write_memory(self, records):
+        memories = [
+            Memory(user_id=self.user(record['user']), key=record['key'], value=record['value']) for record in records
+        ]
+        for alias, group in by_shard(memories).items():
+            Memory.objects.using(alias).bulk_create(
+                group, update_conflicts=True, unique_fields=['user', 'key'], update_fields=['value'],
+            )
+        self.counts['memory'] += len(memories)
+
+    def _write_message(self, records):
+        messages = []
+        for record in records:
+            message = Message(
+                user_id=self.user(record['user']), sender=record['sender'], message=record['message'],
+                created_at=parse_datetime(record['created_at']),
+            )
+            if not self.new_ids:
+                message.id = record['id']
+            messages.append(message)
+        for alias, group in by_shard(messages).items():
+            if not self.new_ids:
+                group = self._unseen(alias, group)
+            Message.objects.using(alias).bulk_create(group)
+            self.counts['message'] += len(group)
+
+    def _unseen(self, alias, messages):
+        """The messages not imported yet; those whose id is taken lose it"""
+        present = set(
+            Message.objects.using(alias)
+            .filter(user_id__in={message.user_id for message in messages},
+                    created_at__in={message.created_at for message in messages})
+            .values_list('user_id', 'created_at', 'sender')
+        )
+        taken = set(
+            Message.objects.using(alias).filter(id__in=[message.id for message in messages])
+            .values_list('id', flat=True)
+        )
+        unseen = []
+        for message in messages:
+            if (message.user_id, message.created_at, message.sender) in present:
+                self.counts['skipped'] += 1
+                continue
+            if message.id in taken:
+                message.id = None
+                self.counts['renumbered'] += 1
+                self.renumbered_users.add(message.user_id)
+            else:
+                # Also taken for the rest of this batch
+                taken.add(message.id)
+            unseen.append(message)
+        return unseen
+
+
+def import_ndjson(stream, batch_size=None, new_ids=False):
+    """Import an export stream; returns Importer.counts (rows written per type)"""
+    return Importer(batch_size, new_ids).run(open_ndjson(stream))
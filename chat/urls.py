@@ -8,6 +8,9 @@ router.register(r'users', views.UserViewSet, basename='user')
 router.register(r'chat', views.ChatViewSet, basename='chat')
 
 urlpatterns = [
+    path('chat/async/', views.async_chat, name='chat-async'),
+    path('admin/export/', views.export_conversations, name='conversation-export'),
+    path('admin/import/', views.import_conversations, name='conversation-import'),
     path('', include(router.urls)),
     path('user/', views.UserViewSet.as_view({'post': 'create'}), name='user-create'),
     path('messages/<int:user_id>/', views.MessageViewSet.as_view({'get': 'list'}), name='message-history'),
@@ -1,38 +1,211 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
-from .models import Persona, Message, Memory
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db import DatabaseError, connections
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import json
+import math
+import time
+from .api import bearer_token, issue_token, token_denial
+from .models import ChatJob, Persona, Message, Memory
 from .serializers import (
     PersonaSerializer, MessageSerializer, ChatRequestSerializer,
-    ChatResponseSerializer, UserSerializer
+    ChatResponseSerializer, UserSerializer, BulkProvisionSerializer,
+    ChatJobSerializer
 )
-from .gemini_service import GeminiService
+from .gemini_service import GeminiService, chat_users
+from .jobs import QueueFull, enqueue_chat_job
+from .metrics import render_metrics
+from .archive import archived_after, archived_before
+from .pagination import decode_cursor, encode_cursor, newer_than, older_than
+from .provisioning import provision_user, provision_users
+from .resilience import UpstreamError
+from .sharding import ause_shard, use_shard
+from .transfer import export_ndjson_gz, import_ndjson
+from .warmup import warm_up
+
+
+# Placeholder stored under an Idempotency-Key while its turn is running
+IDEMPOTENCY_PENDING = "__pending__"
+
+
+def sse_event(data, event=None):
+    """Format one server-sent event frame"""
+    frame = f"event: {event}\n" if event else ""
+    return f"{frame}data: {json.dumps(data)}\n\n"
+
+
+def upstream_error_body(error):
+    """503 payload and Retry-After value for a failed model call"""
+    retry_after = str(max(1, math.ceil(error.retry_after or 1)))
+    return {"detail": "The AI service is temporarily unavailable", "error": error.kind}, retry_after
+
+
+def sse_stream(chunks):
+    """Relay reply chunks as SSE frames, ending with a 'done' event
+    
+    An upstream failure ends the stream with an 'error' event instead.
+    """
+    reply = []
+    try:
+        for chunk in chunks:
+            reply.append(chunk)
+            yield sse_event({"chunk": chunk})
+        yield sse_event({"reply": "".join(reply)}, event="done")
+    except UpstreamError as e:
+        body, retry_after = upstream_error_body(e)
+        yield sse_event({**body, "retry_after": int(retry_after)}, event="error")
+    finally:
+        # Propagate client disconnects so the service can close upstream
+        chunks.close()
+
+
+_DONE = object()
+
+
+def _next_chunk(iterator):
+    return next(iterator, _DONE)
+
+
+def _close(iterator):
+    try:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+    finally:
+        # The thread ends with the stream; nothing else closes its connections
+        connections.close_all()
+
+
+async def aiterate(iterator):
+    """Relay a sync iterator from a thread of its own, one item at a time
+
+    Under ASGI, Django collects a sync StreamingHttpResponse iterator into
+    a list before sending anything. Every step runs on the same thread
+    (database cursors and connections are per thread), in the caller's
+    context. Closing this generator, e.g. on a client disconnect, closes
+    the iterator once the step in flight has finished.
+    """
+    iterator = iter(iterator)
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stream')
+    step = sync_to_async(_next_chunk, thread_sensitive=False, executor=executor)
+    pending = None
+    try:
+        while True:
+            pending = asyncio.ensure_future(step(iterator))
+            # Shielded: a generator cannot be closed while a step runs it
+            item = await asyncio.shield(pending)
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        if pending is not None and not pending.done():
+            await asyncio.wait([pending])
+        try:
+            await sync_to_async(_close, thread_sensitive=False, executor=executor)(iterator)
+        finally:
+            executor.shutdown(wait=False)
+
+
+def streaming_response(request, chunks, **kwargs):
+    """StreamingHttpResponse over a sync iterator that streams under WSGI and ASGI"""
+    if isinstance(request, ASGIRequest):
+        chunks = aiterate(chunks)
+    return StreamingHttpResponse(chunks, **kwargs)
 
 
 class UserViewSet(viewsets.ViewSet):
     """Simple user creation endpoint"""
     
     def create(self, request):
-        # Create anonymous user
-        user = User.objects.create_user(
-            username=f"user_{User.objects.count() + 1}"
-        )
+        # Create anonymous user (random handle + default persona)
+        user = provision_user()
         serializer = UserSerializer(user)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
+    
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Provision many anonymous users at once (load testing)"""
+        if not settings.CHAT_BULK_PROVISIONING:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        
+        serializer = BulkProvisionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        users = provision_users(serializer.validated_data['count'])
+        return Response(
+            {
+                "count": len(users),
+                "ids": [user.id for user in users],
+                "tokens": [issue_token(user.id) for user in users],
+            },
+            status=status.HTTP_201_CREATED
+        )
 
 
 class PersonaViewSet(viewsets.ModelViewSet):
-    """CRUD operations for Personas"""
+    """CRUD operations for Personas
+    
+    Detail routes are keyed by user id (/api/personas/<user_id>/), which
+    also names the shard the persona lives on.
+    """
     queryset = Persona.objects.all()
     serializer_class = PersonaSerializer
+    # Columns PersonaSerializer renders
+    fields = ('id', 'name', 'role', 'personality', 'tone', 'likes', 'dislikes', 'created_at')
+    
+    def get_object(self):
+        user_id = self.kwargs['pk']
+        try:
+            with use_shard(user_id):
+                persona = self.get_queryset().get(user_id=user_id)
+        except (Persona.DoesNotExist, ValueError):
+            raise Http404("Persona not found")
+        self.check_object_permissions(self.request, persona)
+        return persona
+    
+    def list(self, request):
+        """The persona of the token's user (other users' are never listed)"""
+        if request.auth is None:
+            return Response([])
+        with use_shard(request.auth):
+            personas = list(self.get_queryset().filter(user_id=request.auth))
+        return Response(self.get_serializer(personas, many=True).data)
+    
+    def perform_create(self, serializer):
+        with use_shard(serializer.validated_data['user_id']):
+            serializer.save()
+    
+    def perform_update(self, serializer):
+        with use_shard(serializer.instance.user_id):
+            serializer.save()
+    
+    def perform_destroy(self, instance):
+        with use_shard(instance.user_id):
+            instance.delete()
     
     def retrieve(self, request, pk=None):
         """Get persona by user_id"""
         try:
-            persona = Persona.objects.get(user_id=pk)
-            serializer = self.get_serializer(persona)
-            return Response(serializer.data)
+            with use_shard(pk):
+                persona = Persona.objects.only(*self.fields, 'user').get(user_id=pk)
+            self.check_object_permissions(request, persona)
+            # Same output as PersonaSerializer without building its fields per request
+            return Response({field: getattr(persona, field) for field in self.fields})
         except Persona.DoesNotExist:
             return Response(
                 {"detail": "Persona not found"},
@@ -43,53 +216,332 @@ class PersonaViewSet(viewsets.ModelViewSet):
 class ChatViewSet(viewsets.ViewSet):
     """Handle chat interactions"""
     
-    def create(self, request):
-        """Send a chat message and get AI response"""
+    def _validate_chat_request(self, request):
+        """Return (user, validated_data, None) or (None, None, error_response)"""
         serializer = ChatRequestSerializer(data=request.data)
         if not serializer.is_valid():
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            return None, None, Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         user_id = serializer.validated_data['user_id']
-        user_message = serializer.validated_data['message']
         
         try:
-            user = User.objects.get(id=user_id)
+            # One query: the persona comes along for the prompt prefix
+            with use_shard(user_id):
+                user = chat_users().get(id=user_id)
         except User.DoesNotExist:
-            return Response(
+            return None, None, Response(
                 {"detail": "User not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
+        return user, serializer.validated_data, None
+    
+    def create(self, request):
+        """Send a chat message and get AI response
+        
+        With ``"mode": "queued"`` the turn is handed to the background job
+        queue instead and 202 with the job is returned at once (429 when the
+        queue is full); poll /api/chat/jobs/<id>/ for the reply.
+        
+        Clients may send an Idempotency-Key header: a retry with the same key
+        replays the stored response instead of running (and billing) the turn
+        again, and a duplicate arriving while the first is still running gets
+        409 Conflict.
+        """
+        user, data, error = self._validate_chat_request(request)
+        if error:
+            return error
+        
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            cache_key = f"chat:idempotency:{user.id}:{idempotency_key}"
+            if not cache.add(cache_key, IDEMPOTENCY_PENDING, settings.CHAT_IDEMPOTENCY_TTL):
+                stored = cache.get(cache_key)
+                if stored is None or stored == IDEMPOTENCY_PENDING:
+                    return Response(
+                        {"detail": "A request with this Idempotency-Key is already in progress"},
+                        status=status.HTTP_409_CONFLICT
+                    )
+                response = Response(stored['data'], status=stored['status'])
+                response['Idempotent-Replayed'] = 'true'
+                return response
+        
+        try:
+            response = self._run_turn(user, data)
+        except Exception:
+            if idempotency_key:
+                cache.delete(cache_key)
+            raise
+        
+        if idempotency_key:
+            if response.status_code < 400:
+                stored = {"status": response.status_code, "data": response.data}
+                cache.set(cache_key, stored, settings.CHAT_IDEMPOTENCY_TTL)
+            else:
+                cache.delete(cache_key)
+        return response
+    
+    def _run_turn(self, user, data):
+        """Run the turn inline, or enqueue it in queued mode"""
+        if data['mode'] == 'queued':
+            try:
+                job = enqueue_chat_job(user, data['message'])
+            except QueueFull:
+                response = Response(
+                    {"detail": "Chat queue is full, please retry later"},
+                    status=status.HTTP_429_TOO_MANY_REQUESTS
+                )
+                response['Retry-After'] = str(settings.CHAT_JOB_QUEUE['RETRY_BACKOFF'])
+                return response
+            return Response(
+                ChatJobSerializer(job).data,
+                status=status.HTTP_202_ACCEPTED,
+                headers={'Location': f"/api/chat/jobs/{job.id}/"}
+            )
         
         # Get AI response
         gemini_service = GeminiService()
-        ai_reply = gemini_service.chat(user, user_message)
+        try:
+            ai_reply = gemini_service.chat(user, data['message'])
+        except UpstreamError as e:
+            body, retry_after = upstream_error_body(e)
+            return Response(
+                body, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': retry_after}
+            )
         
         response_serializer = ChatResponseSerializer({"reply": ai_reply})
         return Response(response_serializer.data)
+    
+    @action(detail=False, methods=['get'], url_path=r'jobs/(?P<job_id>[0-9]+)')
+    def job(self, request, job_id=None):
+        """Status and reply of a queued chat turn
+        
+        ``?wait=<seconds>`` (max 30) long-polls until the job finishes.
+        """
+        try:
+            wait = min(float(request.query_params.get('wait', 0)), 30.0)
+        except ValueError:
+            return Response({"wait": "Must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        deadline = time.monotonic() + wait
+        while True:
+            try:
+                job = ChatJob.objects.get(id=job_id)
+            except ChatJob.DoesNotExist:
+                return Response({"detail": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+            self.check_object_permissions(request, job)
+            if job.status in (ChatJob.DONE, ChatJob.FAILED) or time.monotonic() >= deadline:
+                return Response(ChatJobSerializer(job).data)
+            time.sleep(0.25)
+    
+    @action(detail=False, methods=['post'])
+    def stream(self, request):
+        """Send a chat message and stream the AI response as server-sent events"""
+        user, data, error = self._validate_chat_request(request)
+        if error:
+            return error
+        
+        gemini_service = GeminiService()
+        response = streaming_response(
+            request._request,
+            sse_stream(gemini_service.stream_chat(user, data['message'])),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Stop reverse proxies from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+@csrf_exempt
+@require_POST
+async def async_chat(request):
+    """Async chat endpoint for ASGI deployments
+    
+    Same contract as ChatViewSet.create, but the model call is awaited so
+    one worker process can hold many in-flight turns.
+    """
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"detail": "Invalid JSON"}, status=status.HTTP_400_BAD_REQUEST)
+    
+    serializer = ChatRequestSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    # Plain view: the token is checked here rather than by DRF
+    denied = token_denial(bearer_token(request), serializer.validated_data['user_id'])
+    if denied:
+        return JsonResponse({"detail": denied[1]}, status=denied[0])
+    
+    try:
+        async with ause_shard(serializer.validated_data['user_id']):
+            user = await chat_users().aget(id=serializer.validated_data['user_id'])
+    except User.DoesNotExist:
+        return JsonResponse({"detail": "User not found"}, status=status.HTTP_404_NOT_FOUND)
+    
+    gemini_service = GeminiService()
+    try:
+        ai_reply = await gemini_service.achat(user, serializer.validated_data['message'])
+    except UpstreamError as e:
+        body, retry_after = upstream_error_body(e)
+        response = JsonResponse(body, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = retry_after
+        return response
+    
+    response_serializer = ChatResponseSerializer({"reply": ai_reply})
+    return JsonResponse(response_serializer.data)
+
+
+def metrics(request):
+    """Prometheus scrape endpoint (404 unless CHAT_METRICS_ENABLED)"""
+    if not settings.CHAT_METRICS['ENABLED']:
+        raise Http404
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def ready(request):
+    """Readiness probe: 200 once this process is warm and the database answers, else 503
+
+    A process that was not warmed at boot (chat/warmup.py) warms on its
+    first probe.
+    """
+    state = warm_up()
+    try:
+        connections['default'].ensure_connection()
+    except DatabaseError as e:
+        state['ready'] = False
+        state['errors']['database'] = str(e)
+    return JsonResponse(state, status=200 if state['ready'] else 503)
+
+
+def _staff_only(request):
+    if not request.user.is_staff:
+        return JsonResponse({"detail": "Staff only"}, status=status.HTTP_403_FORBIDDEN)
+    return None
+
+
+@require_GET
+def export_conversations(request):
+    """Stream users, personas, memories and messages as gzipped NDJSON
+    
+    Staff only, by bearer token on the lean API path (chat/api.py);
+    ``?user_id=`` (repeatable) limits the export to those users.
+    """
+    denied = _staff_only(request)
+    if denied:
+        return denied
+    try:
+        user_ids = [int(user_id) for user_id in request.GET.getlist('user_id')] or None
+    except ValueError:
+        return JsonResponse({"detail": "user_id must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    response = streaming_response(request, export_ndjson_gz(user_ids), content_type='application/gzip')
+    response['Content-Disposition'] = 'attachment; filename="conversations.ndjson.gz"'
+    return response
+
+
+@require_POST
+def import_conversations(request):
+    """Import an export (gzipped or plain NDJSON request body); staff only
+
+    The body is read as a stream, so uploads are not held in memory. Like
+    the export, staff authenticate with a bearer token on the lean API path.
+    """
+    denied = _staff_only(request)
+    if denied:
+        return denied
+    try:
+        counts = import_ndjson(request)
+    except ValueError as e:
+        return JsonResponse({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return JsonResponse({"imported": counts})
 
 
 class MessageViewSet(viewsets.ReadOnlyModelViewSet):
-    """Retrieve chat history"""
+    """Retrieve chat history
+    
+    Keyset-paginated on (created_at, id). Without a cursor the newest page
+    is returned; ``before``/``after`` take the cursors from a previous page.
+    Pages are always ordered oldest first.
+    """
     serializer_class = MessageSerializer
+    fields = ('id', 'sender', 'message', 'created_at')
+    default_limit = 50
+    max_limit = 200
     
     def get_queryset(self):
         user_id = self.kwargs.get('user_id')
-        return Message.objects.filter(user_id=user_id).order_by('created_at')
+        return Message.objects.filter(user_id=user_id)
+    
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except ValueError:
+            raise ValidationError({"limit": "Must be an integer"})
+        return max(1, min(limit, self.max_limit))
+    
+    def get_page(self, before, after, limit):
+        """Fetch limit + 1 rows to learn whether more exist beyond the page
+        
+        Archived messages (chat/archive.py) are older than every live one:
+        pages continue into the archive once the live rows run out.
+        """
+        user_id = self.kwargs.get('user_id')
+        queryset = self.get_queryset().values(*self.fields)
+        try:
+            if after:
+                rows = archived_after(user_id, decode_cursor(after), limit + 1)
+                if len(rows) <= limit:
+                    live = queryset.filter(newer_than(after)).order_by('created_at', 'id')
+                    rows += live[:limit + 1 - len(rows)]
+                return rows[:limit], False, len(rows) > limit
+            if before:
+                queryset = queryset.filter(older_than(before))
+        except ValueError as e:
+            raise ValidationError({"detail": str(e)})
+        rows = list(queryset.order_by('-created_at', '-id')[:limit + 1])
+        if len(rows) <= limit:
+            oldest = (rows[-1]['created_at'], rows[-1]['id']) if rows else (decode_cursor(before) if before else None)
+            rows += archived_before(user_id, oldest, limit + 1 - len(rows))
+        return rows[:limit][::-1], len(rows) > limit, False
     
     def list(self, request, user_id=None):
         """Get chat history for a user"""
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
+        with use_shard(user_id):
+            return self._list(request, user_id)
+    
+    def _list(self, request, user_id):
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        limit = self.get_limit(request)
         
-        # Format for frontend
-        formatted_messages = [
-            {
-                "id": msg['id'],
-                "sender": msg['sender'],
-                "message": msg['message'],
-                "created_at": msg['created_at']
-            }
-            for msg in serializer.data
-        ]
-        
-        return Response(formatted_messages)
+        # Newest message versions the whole history: one indexed lookup lets
+        # unchanged histories answer 304 without reading the page
+        newest = (
+            self.get_queryset().order_by('-created_at', '-id')
+            .values_list('id', 'created_at').first()
+        )
+        last_modified = newest[1] if newest else None
+        etag = '"{}"'.format(hashlib.md5(
+            f"{user_id}|{newest}|{before}|{after}|{limit}".encode()
+        ).hexdigest())
+        not_modified = get_conditional_response(
+            request,
+            etag=etag,
+            last_modified=int(last_modified.timestamp()) if last_modified else None,
+        )
+        if not_modified is not None:
+            return not_modified
+        
+        rows, has_older, has_newer = self.get_page(before, after, limit)
+        response = Response({
+            "results": rows,
+            "before": encode_cursor(rows[0]['created_at'], rows[0]['id']) if rows and has_older else None,
+            "after": encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if rows else after,
+            "has_newer": has_newer,
+        })
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        response['Cache-Control'] = 'private, no-cache'
+        return response
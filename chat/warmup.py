@@ -0,0 +1,129 @@
+"""Warm-up for fast cold starts
+
+The web process runs gunicorn with config/gunicorn_conf.py: the app is
+loaded once in the master (preload_app) and warm_up() runs there before
+the workers are forked. Each worker then starts with the views, DRF,
+google.genai and numpy imported, the URLconf and templates compiled and
+the shared genai client built. Without this, the first request on every
+worker pays for all of it.
+
+Nothing in the master may hold a socket a worker would inherit, so
+database connections are closed after warming. The genai client is
+built but never used before the fork, so it has no open connections yet.
+after_fork() lets each worker adopt it (see
+gemini_service.adopt_shared_client) instead of building its own.
+
+The /ready probe (views.ready) reports this process's warm status. A
+process that was not preloaded, such as runserver or a plain gunicorn,
+warms itself on the first probe. Steps that failed are retried on every
+later probe until they succeed.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_state = {'warm': False, 'pid': None, 'warmed_in_ms': None, 'steps': {}, 'errors': {}}
+
+
+def _genai_client():
+    from .gemini_service import get_shared_client
+
+    get_shared_client()
+
+
+def _urls():
+    from django.urls import get_resolver, resolve
+
+    # Imports chat.views (and with it DRF, the serializers and orjson)
+    # and compiles every pattern on the way to the chat endpoint
+    get_resolver().url_patterns
+    resolve(f"{settings.CHAT_API['PREFIX']}chat/")
+
+
+def _templates():
+    from django.template.loader import get_template
+
+    for name in ('index.html', 'login.html'):
+        get_template(name)
+
+
+def _memory_index():
+    from .memory_index import get_memory_index
+
+    # First embedding loads numpy's linalg and ufunc machinery
+    get_memory_index().embedder(["warm up"])
+
+
+def _database():
+    connections['default'].ensure_connection()
+
+
+# Run in order; a failing step is recorded and the rest still run
+STEPS = (
+    ('genai_client', _genai_client),
+    ('urls', _urls),
+    ('templates', _templates),
+    ('memory_index', _memory_index),
+    ('database', _database),
+)
+
+
+def _run(steps):
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning("Warm-up step %s failed", name, exc_info=True)
+            _state['errors'][name] = str(e)
+        else:
+            _state['errors'].pop(name, None)
+        _state['steps'][name] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def warm_up():
+    """Run the warm-up steps once per process tree; returns warm_status()
+
+    Once warm, each call re-runs only the steps that failed, so a process
+    becomes ready when e.g. the database comes back.
+    """
+    with _lock:
+        if not _state['warm']:
+            started = time.perf_counter()
+            _run(STEPS)
+            # Forked workers must open their own connections
+            connections.close_all()
+            _state.update(
+                warm=True, pid=os.getpid(), warmed_in_ms=round((time.perf_counter() - started) * 1000, 1),
+            )
+        elif _state['errors']:
+            _run([(name, step) for name, step in STEPS if name in _state['errors']])
+    return warm_status()
+
+
+def warm_status():
+    """This process's warm-up state; preloaded means warmed in a parent before fork"""
+    return {
+        'warm': _state['warm'],
+        'ready': _state['warm'] and not _state['errors'],
+        'pid': os.getpid(),
+        'preloaded': _state['warm'] and _state['pid'] != os.getpid(),
+        'warmed_in_ms': _state['warmed_in_ms'],
+        'steps': dict(_state['steps']),
+        'errors': dict(_state['errors']),
+    }
+
+
+def after_fork():
+    """Per-worker setup after forking a warmed master (gunicorn post_fork)"""
+    from .gemini_service import adopt_shared_client
+
+    adopt_shared_client()
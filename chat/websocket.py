@@ -0,0 +1,300 @@
+"""WebSocket chat transport (served by config/asgi.py)
+
+One socket per browser tab at CHAT_WEBSOCKET['PATH']?user_id=<id>. The
+connection loads the user, the compiled prompt prefix and the newest
+history once and keeps them in a ChatSession, so a turn only renders the
+prompt from memory, calls the model and inserts the two messages.
+
+Frames are JSON objects with a "type":
+
+    client -> server   {"type": "message", "message": "..."}, ping, pong
+    server -> client   ready {messages, complete}, chunk {chunk},
+                       done {reply, messages}, error {...}, ping, pong
+
+The user's API token goes in &token=<token> (chat/api.py); it is required
+when CHAT_API['REQUIRE_TOKEN'] is set.
+
+Reconnecting with ?after=<last message id> replays only the messages the
+client has not seen; complete=false means older ones may be missing and
+the client should page them in over HTTP. The server pings after
+HEARTBEAT idle seconds and closes sockets silent for IDLE_TIMEOUT.
+
+Turns on the same socket run one at a time, in order. The session's
+history only sees its own turns: messages written by another tab or the
+HTTP API show up after a reconnect.
+"""
+from collections import deque
+from urllib.parse import parse_qs
+import asyncio
+import json
+import logging
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+from django.core import signals
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .api import token_denial
+from .resilience import UpstreamError
+from .sharding import ause_shard
+
+
+logger = logging.getLogger(__name__)
+
+# Application close codes (4000-4999)
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_NOT_FOUND = 4404
+CLOSE_IDLE = 4408
+
+_DONE = object()
+
+
+class ChatSession:
+    """Per-connection state: the user and a rolling window of their history"""
+
+    def __init__(self, user, service, messages=()):
+        self.user = user
+        self.service = service
+        # Newest last; bounded like the HTTP path's history query
+        self.history = deque(messages, maxlen=service.history_limit)
+
+    @classmethod
+    async def open(cls, user_id, service=None, replay_limit=None):
+        """Load the session and the messages to replay on connect
+
+        Returns (session, newest) where newest holds up to replay_limit
+        messages, oldest first. Raises User.DoesNotExist or
+        Persona.DoesNotExist.
+        """
+        from .gemini_service import GeminiService, chat_users
+        from .models import Message
+
+        service = service or GeminiService()
+        async with ause_shard(user_id):
+            user = await chat_users().aget(pk=user_id)
+            # Warms the prefix cache and memory index; fails early without a persona
+            await service.aget_prompt_prefix(user)
+            await service.aget_memory_block(user, None)
+            limit = max(replay_limit or 0, service.history_limit)
+            newest = [msg async for msg in Message.objects.filter(user=user).order_by('-created_at', '-id')[:limit]]
+        newest.reverse()
+        return cls(user, service, newest[-service.history_limit:]), newest
+
+    def window(self):
+        """History for the next prompt, oldest first, within the token budget"""
+        newest = list(reversed(self.history))
+        window = self.service._trim_window(newest, self.service.history_token_budget)
+        self.service._fold_older_turns(self.user, newest, window, self.service.history_limit)
+        return window
+
+    async def prompt(self, user_message):
+        """Render the prompt from memory; only cache misses touch the DB"""
+        prefix = await self.service.aget_prompt_prefix(self.user)
+        memory_block = await self.service.aget_memory_block(self.user, user_message)
+        return self.service.render_prompt(prefix, self.window(), memory_block)
+
+    async def turn(self, user_message, emit, cancelled=lambda: False):
+        """Stream one reply through emit(chunk) and persist the turn
+
+        Returns the saved (user, ai) messages, or None if nothing was
+        delivered. Raises UpstreamError (nothing saved) and
+        Persona.DoesNotExist. If cancelled() turns true mid-stream, the
+        upstream stream is closed and the delivered part is saved, like
+        GeminiService.stream_chat on a client disconnect.
+        """
+        async with ause_shard(self.user.pk):
+            return await self._turn(user_message, emit, cancelled)
+
+    async def _turn(self, user_message, emit, cancelled):
+        prompt = await self.prompt(user_message)
+        upstream = self.service.stream_response(prompt, user_message)
+        chunks = []
+        try:
+            while not cancelled():
+                # The router blocks (retries, sync client); keep it off the loop
+                chunk = await sync_to_async(next, thread_sensitive=False)(upstream, _DONE)
+                if chunk is _DONE:
+                    break
+                chunks.append(chunk)
+                await emit(chunk)
+        finally:
+            await sync_to_async(upstream.close, thread_sensitive=False)()
+
+        if not chunks:
+            return None
+        messages = await self.service.asave_turn(self.user, user_message, "".join(chunks))
+        self.history.extend(messages)
+        return messages
+
+
+def serialize_messages(messages):
+    from .serializers import MessageSerializer
+
+    return MessageSerializer(messages, many=True).data
+
+
+class ChatConnection:
+    """Drives one WebSocket: handshake, heartbeats and the turn queue"""
+
+    def __init__(self, scope, receive, send, service=None):
+        config = settings.CHAT_WEBSOCKET
+        self.scope = scope
+        self.receive = receive
+        self._send = send
+        self.service = service
+        self.heartbeat = config['HEARTBEAT']
+        self.idle_timeout = config['IDLE_TIMEOUT']
+        self.replay_limit = config['REPLAY_LIMIT']
+        self.closed = False
+        self.session = None
+        self.turns = asyncio.Queue()
+
+    async def send(self, frame):
+        if self.closed:
+            return
+        try:
+            await self._send({'type': 'websocket.send', 'text': json.dumps(frame, cls=DjangoJSONEncoder)})
+        except OSError:
+            # Peer went away; the receive loop sees the disconnect
+            self.closed = True
+
+    async def close(self, code=1000):
+        if not self.closed:
+            self.closed = True
+            await self._send({'type': 'websocket.close', 'code': code})
+
+    async def run(self):
+        message = await self.receive()
+        if message['type'] != 'websocket.connect':
+            return
+        await self._send({'type': 'websocket.accept'})
+        await sync_to_async(signals.request_started.send)(sender=self.__class__, scope=self.scope)
+        try:
+            if await self.open():
+                await self.serve()
+        finally:
+            await sync_to_async(signals.request_finished.send)(sender=self.__class__)
+
+    async def open(self):
+        from django.contrib.auth.models import User
+        from .models import Persona
+
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            user_id = int(params['user_id'][0])
+            after = int(params['after'][0]) if 'after' in params else None
+            denied = token_denial(params['token'][0] if 'token' in params else None, user_id)
+            if denied:
+                await self.send({'type': 'error', 'detail': denied[1]})
+                await self.close(CLOSE_UNAUTHORIZED)
+                return False
+            self.session, newest = await ChatSession.open(user_id, self.service, self.replay_limit)
+        except (KeyError, ValueError, User.DoesNotExist):
+            await self.send({'type': 'error', 'detail': 'Unknown user'})
+            await self.close(CLOSE_NOT_FOUND)
+            return False
+        except Persona.DoesNotExist:
+            await self.send({'type': 'error', 'detail': 'Please set up your persona first!'})
+            await self.close(CLOSE_NOT_FOUND)
+            return False
+
+        replay, complete = self.replay(newest, after)
+        await self.send({'type': 'ready', 'messages': serialize_messages(replay), 'complete': complete})
+        return True
+
+    def replay(self, newest, after):
+        """Messages to send on connect and whether they reach back to `after`
+
+        A fresh connection (after=None) gets the newest page.
+        """
+        if after is None:
+            return newest[-self.replay_limit:], True
+        unseen = [msg for msg in newest if msg.pk > after]
+        # If every loaded message is unseen, older unseen ones may not have been loaded
+        reached = len(unseen) < len(newest) or len(newest) < max(self.replay_limit, self.session.history.maxlen)
+        return unseen[-self.replay_limit:], reached and len(unseen) <= self.replay_limit
+
+    async def serve(self):
+        worker = asyncio.ensure_future(self.run_turns())
+        try:
+            idle = 0.0
+            while not self.closed:
+                try:
+                    message = await asyncio.wait_for(self.receive(), timeout=self.heartbeat)
+                except asyncio.TimeoutError:
+                    idle += self.heartbeat
+                    if idle >= self.idle_timeout:
+                        await self.close(CLOSE_IDLE)
+                        break
+                    await self.send({'type': 'ping'})
+                    continue
+
+                if message['type'] == 'websocket.disconnect':
+                    self.closed = True
+                    break
+                idle = 0.0
+                await self.handle(message)
+        finally:
+            self.closed = True
+            await self.turns.put(None)
+            # A running turn stops at its next chunk and saves what was delivered
+            await worker
+
+    async def handle(self, message):
+        try:
+            frame = json.loads(message.get('text') or message.get('bytes') or '')
+            kind = frame['type']
+        except (ValueError, TypeError, KeyError):
+            await self.send({'type': 'error', 'detail': 'Frames must be JSON objects with a type'})
+            return
+
+        if kind == 'ping':
+            await self.send({'type': 'pong'})
+        elif kind == 'message':
+            text = frame.get('message')
+            if not isinstance(text, str) or not text.strip():
+                await self.send({'type': 'error', 'detail': 'message must be a non-empty string'})
+                return
+            await self.turns.put(text.strip())
+        elif kind != 'pong':
+            await self.send({'type': 'error', 'detail': f'Unknown frame type: {kind}'})
+
+    async def run_turns(self):
+        from .models import Persona
+        from .views import upstream_error_body
+
+        while (text := await self.turns.get()) is not None:
+            if self.closed:
+                continue
+            try:
+                messages = await self.session.turn(
+                    text, lambda chunk: self.send({'type': 'chunk', 'chunk': chunk}), lambda: self.closed
+                )
+            except UpstreamError as e:
+                body, retry_after = upstream_error_body(e)
+                await self.send({'type': 'error', **body, 'retry_after': int(retry_after)})
+            except Persona.DoesNotExist:
+                await self.send({'type': 'error', 'detail': 'Please set up your persona first!'})
+            except Exception:
+                logger.exception("WebSocket turn for user %s failed", self.session.user.pk)
+                await self.send({'type': 'error', 'detail': 'Internal error'})
+            else:
+                if messages:
+                    await self.send({
+                        'type': 'done',
+                        'reply': messages[-1].message,
+                        'messages': serialize_messages(messages),
+                    })
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI app for websocket scopes; unknown paths are rejected (HTTP 403)"""
+    if scope['path'] != settings.CHAT_WEBSOCKET['PATH']:
+        await receive()
+        await send({'type': 'websocket.close'})
+        return
+    # Like Django's ASGIHandler per request: the connection's ORM calls get a
+    # thread (and DB connection) of their own instead of sharing one with
+    # every other socket
+    async with ThreadSensitiveContext():
+        await ChatConnection(scope, receive, send).run()
@@ -0,0 +1,145 @@
+"""Write-behind buffer for chat messages
+
+Batches Message inserts across requests and writes them with one
+bulk_create per flush, triggered when the batch reaches max_batch rows or
+every flush_interval seconds. Pending rows are drained on interpreter exit
+(worker shutdown); a hard kill of the process loses at most one batch
+window, which is the trade-off for taking the insert off the turn.
+
+A batch that fails to insert is put back and retried by the next flushes.
+Once it has failed max_retries times it is split in halves until the
+rows that fail on their own (e.g. their user was deleted) are found;
+those are dropped with a logged error instead of blocking the shard.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBuffer:
+    """Thread-safe buffer of unsaved Message instances"""
+
+    def __init__(self, max_batch=200, flush_interval=0.5, max_retries=3):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._pending = []
+        # id(message) -> failed flushes, for messages put back in _pending
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+        if flush_interval:
+            self._thread = threading.Thread(target=self._run, name="message-write-buffer", daemon=True)
+            self._thread.start()
+
+    def add(self, messages):
+        """Queue messages; flushes inline once a full batch is waiting"""
+        with self._lock:
+            self._pending.extend(messages)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self.flush()
+
+    def pending_for(self, user_id):
+        """Unflushed messages for a user, oldest first"""
+        with self._lock:
+            return [msg for msg in self._pending if msg.user_id == user_id]
+
+    def flush(self):
+        """Write everything pending, one transaction per shard; returns rows written"""
+        from .sharding import by_shard
+
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            written = 0
+            # A single group unless sharding is enabled
+            for alias, rows in by_shard(batch).items():
+                try:
+                    self._write(alias, rows)
+                except Exception:
+                    failures = 1 + max(self._failures.get(id(msg), 0) for msg in rows)
+                    if failures < self.max_retries:
+                        # Keep the rows so the next flush (or shutdown drain) retries them
+                        logger.exception("Flushing %d buffered messages failed", len(rows))
+                        for msg in rows:
+                            self._failures[id(msg)] = failures
+                        with self._lock:
+                            self._pending = rows + self._pending
+                        continue
+                    written += self._write_apart(alias, rows)
+                else:
+                    written += len(rows)
+                for msg in rows:
+                    self._failures.pop(id(msg), None)
+            return written
+
+    def _write(self, alias, rows):
+        from .models import Message
+
+        with transaction.atomic(using=alias):
+            Message.objects.using(alias).bulk_create(rows)
+
+    def _write_apart(self, alias, rows):
+        """Write a batch that keeps failing in halves, dropping the rows that
+        fail on their own; returns the rows written"""
+        if len(rows) == 1:
+            msg = rows[0]
+            logger.error(
+                "Dropping a buffered message that cannot be written (user %s, %s at %s)",
+                msg.user_id, msg.sender, msg.created_at, exc_info=True,
+            )
+            return 0
+        written = 0
+        middle = len(rows) // 2
+        for part in (rows[:middle], rows[middle:]):
+            try:
+                self._write(alias, part)
+            except Exception:
+                written += self._write_apart(alias, part)
+            else:
+                written += len(part)
+        return written
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+            close_old_connections()
+
+    def close(self):
+        """Stop the flusher thread and drain what is left"""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.flush()
+
+
+_write_buffer = None
+_write_buffer_lock = threading.Lock()
+
+
+def get_write_buffer():
+    """Process-wide buffer, or None when CHAT_WRITE_BEHIND is disabled"""
+    global _write_buffer
+
+    config = settings.CHAT_WRITE_BEHIND
+    if not config['ENABLED']:
+        return None
+    if _write_buffer is None:
+        with _write_buffer_lock:
+            if _write_buffer is None:
+                _write_buffer = MessageWriteBuffer(
+                    max_batch=config['MAX_BATCH'],
+                    flush_interval=config['FLUSH_INTERVAL'],
+                    max_retries=config['MAX_RETRIES'],
+                )
+                atexit.register(_write_buffer.close)
+    return _write_buffer
@@ -0,0 +1,35 @@
+"""gunicorn settings for the web process (Procfile)
+
+The app is loaded once in the master and warmed there (chat/warmup.py)
+before the workers are forked, so every worker serves its first request
+warm. Migrations run in the release phase (`manage.py release`), not on
+every boot. gunicorn reads the worker count from WEB_CONCURRENCY and the
+port from PORT.
+"""
+import gc
+
+worker_class = 'uvicorn.workers.UvicornWorker'
+preload_app = True
+
+
+def when_ready(server):
+    # Master, after loading the app and before the first fork
+    from chat.metrics import clear_process_metrics
+    from chat.warmup import warm_up
+
+    # Metrics files left by the previous run's workers (CHAT_METRICS_DIR)
+    clear_process_metrics()
+
+    state = warm_up()
+    server.log.info("Warmed up in %s ms (%s)", state['warmed_in_ms'], state['steps'])
+    for step, error in state['errors'].items():
+        server.log.warning("Warm-up step %s failed: %s", step, error)
+    # Everything loaded so far lives as long as the workers; keeping it out
+    # of the collector stops gc passes from copying those pages into each one
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from chat.warmup import after_fork
+
+    after_fork()
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
+from corsheaders.defaults import default_headers
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -48,16 +49,21 @@ INSTALLED_APPS = [
     'chat',
 ]
 
+# The chat.api.Browser* middleware let /api/ requests through untouched
+# (chat/api.py); those use bearer tokens instead of sessions and CSRF
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',  # No-op unless CHAT_METRICS_ENABLED
+    'chat.recording.TrafficRecorderMiddleware',  # No-op unless CHAT_RECORDING_ENABLED
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware', # WhiteNoise
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'chat.api.BrowserStaticMiddleware', # WhiteNoise
+    'chat.api.BrowserSessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
-    'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'chat.api.BrowserCommonMiddleware',
+    'chat.api.BrowserCsrfViewMiddleware',
+    'chat.api.BrowserAuthenticationMiddleware',
+    'chat.api.TokenUserMiddleware',
+    'chat.api.BrowserMessageMiddleware',
+    'chat.api.BrowserXFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -93,6 +99,65 @@ DATABASES = {
     )
 }
 
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # File-backed test database: threaded tests need real SQLite locking,
+    # which the shared in-memory test database does not provide
+    DATABASES['default']['TEST'] = {'NAME': BASE_DIR / 'test_db.sqlite3'}
+
+# Optional read replica: history and persona reads go to DATABASE_REPLICA_URL
+# (chat/db_routers.py); writes and migrations stay on default
+if os.getenv('DATABASE_REPLICA_URL'):
+    DATABASES['replica'] = dj_database_url.config(env='DATABASE_REPLICA_URL', conn_max_age=600)
+    # Tests read the default test database through the replica alias
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+
+# Optional user shards (chat/sharding.py): DATABASE_SHARD_URLS is a
+# comma-separated list of database URLs, aliased shard_0, shard_1, ...
+# Each user's chat rows live on one of them; `manage.py release` migrates them all
+SHARD_ALIASES = []
+for index, url in enumerate(filter(None, os.getenv('DATABASE_SHARD_URLS', '').split(','))):
+    DATABASES[f'shard_{index}'] = dj_database_url.parse(url.strip(), conn_max_age=600)
+    if DATABASES[f'shard_{index}']['ENGINE'] == 'django.db.backends.sqlite3':
+        DATABASES[f'shard_{index}']['TEST'] = {'NAME': BASE_DIR / f'test_shard_{index}.sqlite3'}
+    SHARD_ALIASES.append(f'shard_{index}')
+
+DATABASE_ROUTERS = ['chat.db_routers.ShardRouter', 'chat.db_routers.ReplicaRouter']
+
+# Shared by every worker process: Idempotency-Key replies and shard
+# assignments must not be per process.
+# The default is a table on the default database, created by `manage.py
+# release`; CACHE_BACKEND/CACHE_LOCATION select e.g. Redis instead
+# (django.core.cache.backends.redis.RedisCache, redis://...)
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'chat_cache'),
+        # Idempotency keys are kept for a day; cull rarely
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 100_000))},
+    },
+}
+
+CHAT_READ_REPLICA = {
+    'ALIAS': 'replica',
+    'MODELS': ['chat.message', 'chat.messagearchive', 'chat.persona'],
+}
+
+# New users are placed on ALIASES by a hash of their id; the alias of each
+# user is cached for ASSIGNMENT_TTL seconds, and rebalance_shards waits
+# MOVE_SETTLE seconds (more than the TTL plus the longest turn and the
+# write-behind FLUSH_INTERVAL) mid-move. The Nth alias hands out Message ids
+# from N * ID_BLOCK, so only append to DATABASE_SHARD_URLS.
+CHAT_SHARDING = {
+    'ALIASES': SHARD_ALIASES,
+    'MODELS': [
+        'chat.persona', 'chat.message', 'chat.messagearchive', 'chat.memory',
+        'chat.conversationsummary', 'chat.memoryextractionstate',
+    ],
+    'ASSIGNMENT_TTL': int(os.getenv('CHAT_SHARD_ASSIGNMENT_TTL', 30)),
+    'MOVE_SETTLE': float(os.getenv('CHAT_SHARD_MOVE_SETTLE', 90)),
+    'ID_BLOCK': 2 ** 48,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -140,21 +205,23 @@ LOGOUT_REDIRECT_URL = 'login'
 # REST Framework Configuration
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',
+        'chat.api.FastJSONRenderer',
     ],
     'DEFAULT_PARSER_CLASSES': [
         'rest_framework.parsers.JSONParser',
     ],
-    'DEFAULT_AUTHENTICATION_CLASSES': [],
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'chat.api.TokenAuthentication',
+    ],
     'DEFAULT_PERMISSION_CLASSES': [
-        'rest_framework.permissions.AllowAny',
+        'chat.api.TokenMatchesUser',
     ],
 }
 
 # CORS Configuration
 CORS_ALLOW_ALL_ORIGINS = True  # For development only
 CORS_ALLOW_CREDENTIALS = True
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
 
 # CSRF Configuration for Railway
 CSRF_TRUSTED_ORIGINS = [
@@ -166,3 +233,201 @@ CSRF_TRUSTED_ORIGINS = [
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Chat Configuration
+# 'genai' calls Gemini; 'fake' uses chat.fake_llm for local load tests
+GEMINI_BACKEND = os.getenv('GEMINI_BACKEND', 'genai')
+GEMINI_FAKE_LATENCY = float(os.getenv('GEMINI_FAKE_LATENCY', 0))
+# Traffic log whose recorded upstream durations the fake model's latency follows
+GEMINI_FAKE_LATENCY_LOG = os.getenv('GEMINI_FAKE_LATENCY_LOG', '')
+
+# Only the newest messages are fed back into each prompt: at most
+# CHAT_HISTORY_LIMIT rows, trimmed to CHAT_HISTORY_TOKEN_BUDGET estimated tokens
+CHAT_HISTORY_LIMIT = int(os.getenv('CHAT_HISTORY_LIMIT', 50))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv('CHAT_HISTORY_TOKEN_BUDGET', 2000)) or None
+
+# Turns that fall out of the window are folded into a per-user rolling
+# summary in the background (costs one model call per folded batch), once
+# at least MIN_MESSAGES of them are waiting
+CHAT_ROLLING_SUMMARY = {
+    'ENABLED': os.getenv('CHAT_ROLLING_SUMMARY', 'false').lower() == 'true',
+    'SUMMARIZER': os.getenv('CHAT_SUMMARIZER', 'chat.context.GeminiSummarizer'),
+    'BATCH_SIZE': int(os.getenv('CHAT_SUMMARY_BATCH_SIZE', 200)),
+    'MIN_MESSAGES': int(os.getenv('CHAT_SUMMARY_MIN_MESSAGES', 20)),
+}
+
+# Compiled persona + memory prompt prefix, invalidated by model signals.
+# 'lru' is per-process (other workers catch up after TTL seconds);
+# 'django' uses the CACHES framework and is shared across workers.
+CHAT_PROMPT_CACHE = {
+    'BACKEND': os.getenv('CHAT_PROMPT_CACHE_BACKEND', 'lru'),
+    'MAX_SIZE': int(os.getenv('CHAT_PROMPT_CACHE_SIZE', 10000)),
+    'TTL': int(os.getenv('CHAT_PROMPT_CACHE_TTL', 60)),
+}
+
+# Identical in-flight prompts share one upstream call; TTL > 0 also caches
+# replies for that many seconds
+CHAT_RESPONSE_CACHE = {
+    'TTL': int(os.getenv('CHAT_RESPONSE_CACHE_TTL', 0)),
+    'MAX_ENTRIES': int(os.getenv('CHAT_RESPONSE_CACHE_SIZE', 1000)),
+}
+
+# Replies to POST /api/chat/ with an Idempotency-Key header are kept this long
+CHAT_IDEMPOTENCY_TTL = int(os.getenv('CHAT_IDEMPOTENCY_TTL', 24 * 60 * 60))
+
+# Write-behind batching of chat message inserts across requests
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.getenv('CHAT_WRITE_BEHIND', 'false').lower() == 'true',
+    'MAX_BATCH': int(os.getenv('CHAT_WRITE_BEHIND_BATCH', 200)),
+    'FLUSH_INTERVAL': float(os.getenv('CHAT_WRITE_BEHIND_INTERVAL', 0.5)),
+    # Failed flushes before a batch is split up and its bad rows dropped
+    'MAX_RETRIES': int(os.getenv('CHAT_WRITE_BEHIND_RETRIES', 3)),
+}
+
+# POST /api/users/bulk/ provisions many users at once; load testing only
+CHAT_BULK_PROVISIONING = os.getenv('CHAT_BULK_PROVISIONING', 'false').lower() == 'true'
+
+# Background chat jobs ("mode": "queued" on POST /api/chat/)
+CHAT_JOB_QUEUE = {
+    'WORKERS': int(os.getenv('CHAT_JOB_WORKERS', 4)),
+    'MAX_DEPTH': int(os.getenv('CHAT_JOB_QUEUE_MAX_DEPTH', 1000)),
+    'MAX_ATTEMPTS': int(os.getenv('CHAT_JOB_MAX_ATTEMPTS', 3)),
+    'RETRY_BACKOFF': float(os.getenv('CHAT_JOB_RETRY_BACKOFF', 2)),
+    'JOB_TIMEOUT': int(os.getenv('CHAT_JOB_TIMEOUT', 300)),
+}
+
+# Upstream protection for model calls (chat/resilience.py). Rate limit
+# buckets are rows on the default database, so all workers draw from one
+# quota.
+CHAT_UPSTREAM = {
+    'REQUESTS_PER_MINUTE': int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', 1000)),
+    'TOKENS_PER_MINUTE': int(os.getenv('GEMINI_TOKENS_PER_MINUTE', 4_000_000)),
+    'MAX_WAIT': float(os.getenv('GEMINI_RATE_LIMIT_MAX_WAIT', 2)),
+    'MAX_ATTEMPTS': int(os.getenv('GEMINI_MAX_ATTEMPTS', 3)),
+    'BASE_DELAY': float(os.getenv('GEMINI_RETRY_BASE_DELAY', 0.5)),
+    'MAX_DELAY': float(os.getenv('GEMINI_RETRY_MAX_DELAY', 8)),
+    'TIMEOUT': float(os.getenv('GEMINI_TIMEOUT', 30)),
+    'FAILURE_THRESHOLD': int(os.getenv('GEMINI_CIRCUIT_FAILURES', 5)),
+    'RECOVERY_TIMEOUT': float(os.getenv('GEMINI_CIRCUIT_RECOVERY', 30)),
+}
+
+# Model routing (chat/routing.py). Disabled: every turn goes to
+# GeminiService.model_name. Enabled: short turns go to 'fast', long prompts
+# and complex questions to 'strong', each failing over to the other, and a
+# call slower than the route's p95 is hedged with the fallback.
+CHAT_MODEL_ROUTING = {
+    'ENABLED': os.getenv('CHAT_MODEL_ROUTING', 'false').lower() == 'true',
+    'PROVIDERS': {
+        'gemini': 'chat.routing.GenAIProvider',
+    },
+    'ROUTES': {
+        'fast': {
+            'PROVIDER': 'gemini',
+            'MODEL': os.getenv('CHAT_FAST_MODEL', 'gemini-2.5-flash-lite'),
+            'COST_PER_1K_INPUT': 0.0001,
+            'COST_PER_1K_OUTPUT': 0.0004,
+        },
+        'strong': {
+            'PROVIDER': 'gemini',
+            'MODEL': os.getenv('CHAT_STRONG_MODEL', 'gemini-2.5-flash'),
+            'COST_PER_1K_INPUT': 0.0003,
+            'COST_PER_1K_OUTPUT': 0.0025,
+        },
+    },
+    'POLICY': {
+        'DEFAULT': 'fast',
+        'LONG_ROUTE': 'strong',
+        'LONG_PROMPT_TOKENS': int(os.getenv('CHAT_LONG_PROMPT_TOKENS', 3000)),
+        'COMPLEX_ROUTE': 'strong',
+        'COMPLEX_PATTERN': r"\b(explain|analy[sz]e|compare|step by step|pros and cons|plan)\b",
+        'FALLBACKS': {'fast': ['strong'], 'strong': ['fast']},
+        'HEDGE': {
+            'ENABLED': os.getenv('CHAT_HEDGE_REQUESTS', 'true').lower() == 'true',
+            'PERCENTILE': float(os.getenv('CHAT_HEDGE_PERCENTILE', 95)),
+            'MIN_SAMPLES': 20,
+            # Threads per process for hedged sync calls (two per hedged
+            # turn); a turn finding none free is not hedged
+            'MAX_WORKERS': int(os.getenv('CHAT_HEDGE_WORKERS', 64)),
+        },
+    },
+}
+
+# Per-turn semantic memory retrieval (chat/memory_index.py): only the TOP_K
+# memories most similar to the user's message go into the prompt
+CHAT_MEMORY_RETRIEVAL = {
+    'ENABLED': os.getenv('CHAT_MEMORY_RETRIEVAL', 'true').lower() == 'true',
+    'TOP_K': int(os.getenv('CHAT_MEMORY_TOP_K', 8)),
+    'EMBEDDER': os.getenv('CHAT_MEMORY_EMBEDDER', 'chat.memory_index.HashedNgramEmbedder'),
+    'MAX_USERS': int(os.getenv('CHAT_MEMORY_INDEX_MAX_USERS', 1000)),
+    'TTL': int(os.getenv('CHAT_MEMORY_INDEX_TTL', 300)),
+}
+
+# Background memory extraction from user messages (chat/extraction.py).
+# Runs after the turn is saved; MIN_MESSAGES batches calls for the
+# LLM-backed 'chat.extraction.GeminiExtractor'.
+CHAT_MEMORY_EXTRACTION = {
+    'ENABLED': os.getenv('CHAT_MEMORY_EXTRACTION', 'false').lower() == 'true',
+    'EXTRACTOR': os.getenv('CHAT_MEMORY_EXTRACTOR', 'chat.extraction.RuleBasedExtractor'),
+    'BATCH_SIZE': int(os.getenv('CHAT_MEMORY_EXTRACTION_BATCH_SIZE', 50)),
+    'MIN_MESSAGES': int(os.getenv('CHAT_MEMORY_EXTRACTION_MIN_MESSAGES', 1)),
+}
+
+# Per-stage latency/query metrics (chat/metrics.py), exported at /metrics
+CHAT_METRICS = {
+    'ENABLED': os.getenv('CHAT_METRICS_ENABLED', 'false').lower() == 'true',
+    'LOG_REQUESTS': os.getenv('CHAT_METRICS_LOG', 'true').lower() == 'true',
+    'PATH_PREFIX': '/api/',
+    # Shared by the worker processes so /metrics covers all of them; unset,
+    # each process (and so each scrape) only reports its own requests
+    'MULTIPROCESS_DIR': os.getenv('CHAT_METRICS_DIR', ''),
+    'DUMP_INTERVAL': float(os.getenv('CHAT_METRICS_DUMP_INTERVAL', 1)),
+}
+
+# WebSocket chat transport (chat/websocket.py, served by config/asgi.py).
+# The server pings after HEARTBEAT idle seconds and drops sockets silent
+# for IDLE_TIMEOUT; REPLAY_LIMIT caps the messages sent on (re)connect.
+CHAT_WEBSOCKET = {
+    'PATH': '/ws/chat/',
+    'HEARTBEAT': float(os.getenv('CHAT_WEBSOCKET_HEARTBEAT', 20)),
+    'IDLE_TIMEOUT': float(os.getenv('CHAT_WEBSOCKET_IDLE_TIMEOUT', 60)),
+    'REPLAY_LIMIT': int(os.getenv('CHAT_WEBSOCKET_REPLAY_LIMIT', 50)),
+}
+
+# Message archiving (chat/archive.py, `manage.py archive_messages`): messages
+# older than HORIZON_DAYS move into compressed per-user blocks of BATCH_SIZE;
+# each user's newest KEEP_RECENT (at least CHAT_HISTORY_LIMIT) stay live
+CHAT_ARCHIVE = {
+    'HORIZON_DAYS': float(os.getenv('CHAT_ARCHIVE_HORIZON_DAYS', 90)),
+    'BATCH_SIZE': int(os.getenv('CHAT_ARCHIVE_BATCH_SIZE', 1000)),
+    'KEEP_RECENT': int(os.getenv('CHAT_ARCHIVE_KEEP_RECENT', 200)),
+}
+
+# Conversation export/import (chat/transfer.py): rows fetched per
+# server-side cursor round trip, and rows per bulk_create on import
+CHAT_TRANSFER = {
+    'CHUNK_SIZE': int(os.getenv('CHAT_TRANSFER_CHUNK_SIZE', 2000)),
+    'BATCH_SIZE': int(os.getenv('CHAT_TRANSFER_BATCH_SIZE', 1000)),
+}
+
+# Lean /api/ path and bearer tokens (chat/api.py). Without REQUIRE_TOKEN,
+# requests with no token still work; a token that is sent must match
+CHAT_API = {
+    'LEAN_PATH': os.getenv('CHAT_API_LEAN_PATH', 'true').lower() == 'true',
+    'PREFIX': '/api/',
+    'REQUIRE_TOKEN': os.getenv('CHAT_API_REQUIRE_TOKEN', 'false').lower() == 'true',
+    # Seconds; 0 means tokens do not expire
+    'TOKEN_MAX_AGE': int(os.getenv('CHAT_API_TOKEN_MAX_AGE', 0)) or None,
+}
+
+# Traffic recording (chat/recording.py): SAMPLE_RATE of the requests under
+# PATHS are appended to LOG, one compact JSON line each, for
+# `manage.py replay_traffic`. REDACT keeps only the length of body strings;
+# each worker stops writing once LOG reaches MAX_BYTES
+CHAT_RECORDING = {
+    'ENABLED': os.getenv('CHAT_RECORDING_ENABLED', 'false').lower() == 'true',
+    'LOG': os.getenv('CHAT_RECORDING_LOG', str(BASE_DIR / 'traffic.log')),
+    'SAMPLE_RATE': float(os.getenv('CHAT_RECORDING_SAMPLE_RATE', 0.1)),
+    'PATHS': ['/api/chat/', '/api/messages/', '/api/personas/'],
+    'REDACT': os.getenv('CHAT_RECORDING_REDACT', 'true').lower() == 'true',
+    'MAX_BYTES': int(os.getenv('CHAT_RECORDING_MAX_BYTES', 100 * 1024 * 1024)),
+}
@@ -21,6 +21,8 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import render
 import os
 
+from chat.views import metrics, ready
+
 @login_required
 def home(request):
     return render(request, 'index.html')
@@ -31,4 +33,6 @@ urlpatterns = [
     path('login/', auth_views.LoginView.as_view(template_name='login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
     path('api/', include('chat.urls')),
+    path('metrics', metrics, name='metrics'),
+    path('ready', ready, name='ready'),
 ]
@@ -1,7 +1,23 @@
 // API Configuration
 const API_BASE = '/api';
+const WS_PATH = '/ws/chat/';
 let currentUser = null;
 
+// Chat socket state; HTTP streaming is the fallback while it is down
+let socket = null;
+let socketReady = false;
+let lastMessageId = null;
+let reconnectDelay = 1000;
+let replyBubble = null;
+let pendingMessage = null;
+
+// Request headers, with the user's API token once we have one
+function apiHeaders(json = false) {
+    const headers = json ? { 'Content-Type': 'application/json' } : {};
+    if (currentUser && currentUser.token) headers['Authorization'] = `Bearer ${currentUser.token}`;
+    return headers;
+}
+
 // DOM Elements
 const setupScreen = document.getElementById('setupScreen');
 const chatScreen = document.getElementById('chatScreen');
@@ -42,7 +58,7 @@ function setupEventListeners() {
 function checkExistingUser() {
     const userId = localStorage.getItem('userId');
     if (userId) {
-        currentUser = { id: parseInt(userId) };
+        currentUser = { id: parseInt(userId), token: localStorage.getItem('userToken') };
         loadPersona();
     }
 }
@@ -57,6 +73,7 @@ async function createUser() {
         const data = await response.json();
         currentUser = data;
         localStorage.setItem('userId', data.id);
+        localStorage.setItem('userToken', data.token);
         return data;
     } catch (error) {
         console.error('Error creating user:', error);
@@ -103,14 +120,14 @@ async function handlePersonaSubmit(e) {
     try {
         const response = await fetch(`${API_BASE}/personas/`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(true),
             body: JSON.stringify(personaData)
         });
 
         if (response.ok) {
             const persona = await response.json();
             showChatScreen(persona);
-            loadChatHistory();
+            connectChat();
         } else {
             alert('Failed to create persona. Please try again.');
         }
@@ -123,11 +140,11 @@ async function handlePersonaSubmit(e) {
 // Load existing persona
 async function loadPersona() {
     try {
-        const response = await fetch(`${API_BASE}/personas/${currentUser.id}/`);
+        const response = await fetch(`${API_BASE}/personas/${currentUser.id}/`, { headers: apiHeaders() });
         if (response.ok) {
             const persona = await response.json();
             showChatScreen(persona);
-            loadChatHistory();
+            connectChat();
         }
     } catch (error) {
         console.error('Error loading persona:', error);
@@ -143,14 +160,104 @@ function showChatScreen(persona) {
     personaAvatar.textContent = persona.name.charAt(0).toUpperCase();
 }
 
+// Open the chat socket; the server replays history (or what we missed) on connect
+function connectChat() {
+    if (!('WebSocket' in window) || !currentUser) {
+        loadChatHistory();
+        return;
+    }
+
+    const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+    let url = `${scheme}://${window.location.host}${WS_PATH}?user_id=${currentUser.id}`;
+    if (currentUser.token) url += `&token=${encodeURIComponent(currentUser.token)}`;
+    if (lastMessageId) url += `&after=${lastMessageId}`;
+
+    socket = new WebSocket(url);
+    socket.onmessage = (event) => handleSocketFrame(JSON.parse(event.data));
+    socket.onclose = (event) => {
+        socketReady = false;
+        socket = null;
+        replyBubble = null;
+        typingIndicator.classList.remove('active');
+        // 4401: missing or wrong token; 4404: unknown user or no persona.
+        // Reconnecting will not help with either
+        if (event.code === 4401 || event.code === 4404 || !currentUser) return;
+        setTimeout(connectChat, reconnectDelay);
+        reconnectDelay = Math.min(reconnectDelay * 2, 30000);
+    };
+}
+
+function handleSocketFrame(frame) {
+    switch (frame.type) {
+        case 'ready':
+            socketReady = true;
+            reconnectDelay = 1000;
+            if (!lastMessageId) messagesContainer.innerHTML = '';
+            if (!frame.complete) {
+                // Too much was missed to replay; start over from the newest page
+                loadChatHistory();
+                break;
+            }
+            frame.messages.forEach(msg => {
+                // Already on screen if the socket dropped during its turn
+                if (msg.sender === 'user' && msg.message === pendingMessage) return;
+                displayMessage(msg.message, msg.sender);
+            });
+            pendingMessage = null;
+            rememberMessages(frame.messages);
+            break;
+        case 'chunk':
+            if (!replyBubble) {
+                typingIndicator.classList.remove('active');
+                replyBubble = displayMessage('', 'ai');
+            }
+            replyBubble.textContent += frame.chunk;
+            messagesContainer.scrollTop = messagesContainer.scrollHeight;
+            break;
+        case 'done':
+            replyBubble = null;
+            pendingMessage = null;
+            typingIndicator.classList.remove('active');
+            rememberMessages(frame.messages);
+            break;
+        case 'error':
+            replyBubble = null;
+            pendingMessage = null;
+            typingIndicator.classList.remove('active');
+            if (socketReady) displayMessage('Sorry, I had trouble responding. Please try again.', 'ai');
+            break;
+        case 'ping':
+            socket.send(JSON.stringify({ type: 'pong' }));
+            break;
+    }
+}
+
+function rememberMessages(messages) {
+    messages.forEach(msg => {
+        if (msg.id && (!lastMessageId || msg.id > lastMessageId)) lastMessageId = msg.id;
+    });
+}
+
+function closeChat() {
+    if (socket) {
+        socket.onclose = null;
+        socket.close();
+    }
+    socket = null;
+    socketReady = false;
+    lastMessageId = null;
+}
+
 // Load chat history
 async function loadChatHistory() {
     try {
-        const response = await fetch(`${API_BASE}/messages/${currentUser.id}/`);
+        // Newest page only; the API is cursor-paginated
+        const response = await fetch(`${API_BASE}/messages/${currentUser.id}/?limit=50`, { headers: apiHeaders() });
         if (response.ok) {
-            const messages = await response.json();
+            const page = await response.json();
             messagesContainer.innerHTML = '';
-            messages.forEach(msg => displayMessage(msg.message, msg.sender));
+            page.results.forEach(msg => displayMessage(msg.message, msg.sender));
+            rememberMessages(page.results);
         }
     } catch (error) {
         console.error('Error loading chat history:', error);
@@ -171,10 +278,16 @@ async function handleChatSubmit(e) {
     // Show typing indicator
     typingIndicator.classList.add('active');
 
+    if (socketReady) {
+        pendingMessage = message;
+        socket.send(JSON.stringify({ type: 'message', message: message }));
+        return;
+    }
+
     try {
-        const response = await fetch(`${API_BASE}/chat/`, {
+        const response = await fetch(`${API_BASE}/chat/stream/`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(true),
             body: JSON.stringify({
                 user_id: currentUser.id,
                 message: message
@@ -182,9 +295,7 @@ async function handleChatSubmit(e) {
         });
 
         if (response.ok) {
-            const data = await response.json();
-            typingIndicator.classList.remove('active');
-            displayMessage(data.reply, 'ai');
+            await readReplyStream(response);
         } else {
             typingIndicator.classList.remove('active');
             displayMessage('Sorry, I had trouble responding. Please try again.', 'ai');
@@ -196,6 +307,40 @@ async function handleChatSubmit(e) {
     }
 }
 
+// Render server-sent reply chunks into one bubble as they arrive
+async function readReplyStream(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let bubble = null;
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+
+        events.forEach(event => {
+            const dataLine = event.split('\n').find(line => line.startsWith('data: '));
+            if (!dataLine) return;
+
+            const data = JSON.parse(dataLine.slice(6));
+            if (data.chunk === undefined) return;
+
+            if (!bubble) {
+                typingIndicator.classList.remove('active');
+                bubble = displayMessage('', 'ai');
+            }
+            bubble.textContent += data.chunk;
+            messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        });
+    }
+
+    typingIndicator.classList.remove('active');
+}
+
 // Display message in chat
 function displayMessage(text, sender) {
     const messageDiv = document.createElement('div');
@@ -210,6 +355,8 @@ function displayMessage(text, sender) {
 
     // Scroll to bottom
     messagesContainer.scrollTop = messagesContainer.scrollHeight;
+
+    return bubble;
 }
 
 // Show Reset Modal
@@ -224,7 +371,9 @@ function hideResetModal() {
 
 // Handle Reset
 function handleReset() {
+    closeChat();
     localStorage.removeItem('userId');
+    localStorage.removeItem('userToken');
     currentUser = null;
     chatScreen.classList.remove('active');
     setupScreen.classList.add('active');
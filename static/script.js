@@ -3,8 +3,21 @@ const API_BASE_URL = window.location.origin;
 
 // State Management
 let currentUserId = null;
+let currentUserToken = null;
 let currentPersona = null;
 
+// Chat socket (HTTP is used while it is not open)
+let chatSocket = null;
+let lastMessageId = null;
+let streamingContent = null;
+
+// Request headers, with the user's API token once we have one
+function apiHeaders(json = false) {
+    const headers = json ? { 'Content-Type': 'application/json' } : {};
+    if (currentUserToken) headers['Authorization'] = `Bearer ${currentUserToken}`;
+    return headers;
+}
+
 // DOM Elements
 const setupScreen = document.getElementById('setupScreen');
 const chatScreen = document.getElementById('chatScreen');
@@ -23,9 +36,10 @@ async function initApp() {
 
     if (savedUserId && savedPersona) {
         currentUserId = parseInt(savedUserId);
+        currentUserToken = localStorage.getItem('userToken');
         currentPersona = JSON.parse(savedPersona);
         showChatScreen();
-        await loadChatHistory();
+        connectChat();
     } else {
         // Create a new user
         await createNewUser();
@@ -46,7 +60,9 @@ async function createNewUser() {
 
         const data = await response.json();
         currentUserId = data.id;
+        currentUserToken = data.token;
         localStorage.setItem('userId', currentUserId);
+        localStorage.setItem('userToken', currentUserToken);
         console.log('User created with ID:', currentUserId);
     } catch (error) {
         console.error('Error creating user:', error);
@@ -71,7 +87,7 @@ personaForm.addEventListener('submit', async (e) => {
     try {
         const response = await fetch(`${API_BASE_URL}/api/personas/`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(true),
             body: JSON.stringify(personaData)
         });
 
@@ -79,6 +95,7 @@ personaForm.addEventListener('submit', async (e) => {
             currentPersona = await response.json();
             localStorage.setItem('persona', JSON.stringify(currentPersona));
             showChatScreen();
+            connectChat();
         } else {
             alert('Failed to create persona. Please try again.');
         }
@@ -104,11 +121,78 @@ function showChatScreen() {
     }
 }
 
+// Chat Socket: history replay, streamed replies and resume after reconnects
+function connectChat() {
+    if (!('WebSocket' in window)) {
+        loadChatHistory();
+        return;
+    }
+
+    const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+    let url = `${scheme}://${window.location.host}/ws/chat/?user_id=${currentUserId}`;
+    if (currentUserToken) url += `&token=${encodeURIComponent(currentUserToken)}`;
+    if (lastMessageId) url += `&after=${lastMessageId}`;
+    const socket = new WebSocket(url);
+
+    socket.onmessage = (event) => {
+        const frame = JSON.parse(event.data);
+        if (frame.type === 'ready') {
+            chatSocket = socket;
+            if (!frame.complete) {
+                loadChatHistory();
+                return;
+            }
+            if (!lastMessageId) {
+                messagesContainer.innerHTML = frame.messages.length
+                    ? '' : '<div class="welcome-message"><p>Start chatting! 💬</p></div>';
+            }
+            frame.messages.forEach(msg => addMessageToUI(msg.sender, msg.message, false));
+            trackMessages(frame.messages);
+        } else if (frame.type === 'chunk') {
+            if (!streamingContent) {
+                typingIndicator.style.display = 'none';
+                addMessageToUI('ai', '');
+                streamingContent = messagesContainer.lastElementChild.querySelector('.message-content');
+            }
+            streamingContent.textContent += frame.chunk;
+            scrollToBottom();
+        } else if (frame.type === 'done' || frame.type === 'error') {
+            typingIndicator.style.display = 'none';
+            if (frame.type === 'error' && chatSocket) {
+                addMessageToUI('ai', '❌ Sorry, I encountered an error. Please try again.');
+            }
+            streamingContent = null;
+            trackMessages(frame.messages || []);
+        } else if (frame.type === 'ping') {
+            socket.send(JSON.stringify({ type: 'pong' }));
+        }
+    };
+
+    socket.onclose = (event) => {
+        chatSocket = null;
+        streamingContent = null;
+        typingIndicator.style.display = 'none';
+        // 4401: missing or wrong token; 4404: unknown user or no persona
+        if (event.code !== 4401 && event.code !== 4404) setTimeout(connectChat, 2000);
+    };
+}
+
+function trackMessages(messages) {
+    messages.forEach(msg => {
+        if (msg.id && (!lastMessageId || msg.id > lastMessageId)) lastMessageId = msg.id;
+    });
+}
+
 // Load Chat History
 async function loadChatHistory() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/messages/${currentUserId}/`);
-        const messages = await response.json();
+        // Newest page only; the API is cursor-paginated
+        const response = await fetch(`${API_BASE_URL}/api/messages/${currentUserId}/?limit=50`, {
+            headers: apiHeaders()
+        });
+        const page = await response.json();
+        const messages = page.results;
+        trackMessages(messages);
 
         // Clear existing messages
         messagesContainer.innerHTML = '';
@@ -146,11 +230,16 @@ chatForm.addEventListener('submit', async (e) => {
     typingIndicator.style.display = 'flex';
     scrollToBottom();
 
+    if (chatSocket) {
+        chatSocket.send(JSON.stringify({ type: 'message', message: message }));
+        return;
+    }
+
     // Send message to API
     try {
         const response = await fetch(`${API_BASE_URL}/api/chat/`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(true),
             body: JSON.stringify({
                 user_id: currentUserId,
                 message: message